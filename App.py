@@ -1,20 +1,447 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file, g, has_app_context, has_request_context, jsonify, Response, stream_with_context, before_render_template, template_rendered, stream_template, get_flashed_messages
+from flask.sessions import SessionInterface, SessionMixin
+import base64
+import click
+import csv
+import functools
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import queue
+import re
+import secrets
 import sqlite3
-from datetime import datetime
-import pandas as pd
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.datastructures import CallbackDict
 from werkzeug.security import generate_password_hash, check_password_hash
+try:
+    import brotli
+except ImportError:  # brotli é opcional; sem ele as respostas usam gzip
+    brotli = None
+try:
+    import psycopg2
+    import psycopg2.extras
+except ImportError:  # necessário só com DB_BACKEND=postgres
+    psycopg2 = None
 
-app = Flask(__name__)
+app = Flask(__name__, template_folder='Templates')
 app.secret_key = 'sua_chave_secreta'  # Substitua por uma chave segura
-DATABASE = 'carretas.db'
+DATABASE = os.environ.get('DATABASE', 'carretas.db')
+# 'sqlite' (padrão, arquivo DATABASE, um único servidor) ou 'postgres' (DATABASE_URL; vários
+# servidores atrás do balanceador compartilham o mesmo banco)
+DB_BACKEND = os.environ.get('DB_BACKEND', 'sqlite')
+DATABASE_URL = os.environ.get('DATABASE_URL', '')
+
+# ---------------------- Política de Senhas ----------------------
+# Método do werkzeug para novos hashes (ex.: "scrypt", "pbkdf2:sha256:600000"). Hashes
+# gravados com outro método/custo são refeitos no próximo login bem-sucedido.
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+
+def hash_password(senha):
+    return generate_password_hash(senha, method=PASSWORD_HASH_METHOD)
+
+# Prefixo completo (com os parâmetros padrão) que hash_password() produz hoje; calculado no
+# primeiro uso, para não gastar um hash na inicialização de cada worker
+@functools.lru_cache(maxsize=1)
+def password_hash_prefix():
+    return hash_password('').split('$', 1)[0]
+
+def password_needs_rehash(senha_hash):
+    return senha_hash.split('$', 1)[0] != password_hash_prefix()
+
+# ---------------------- Pool de Conexões ----------------------
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))  # segundos aguardando uma conexão livre
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+DB_LOCK_RETRIES = int(os.environ.get('DB_LOCK_RETRIES', 3))
+PROFILING_ENABLED = os.environ.get('PROFILING') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+DB_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",  # seguro com WAL, evita fsync a cada commit
+    f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}",
+    "PRAGMA cache_size = -16000",  # ~16 MB de cache de páginas por conexão
+    "PRAGMA mmap_size = 134217728",  # 128 MB de leitura via mmap
+    "PRAGMA temp_store = MEMORY",
+)
+
+def _is_lock_error(exc):
+    message = str(exc).lower()
+    return 'locked' in message or 'busy' in message
+
+def _retry_on_lock(operation, *args):
+    """Executa a operação repetindo-a se o SQLite ainda estiver bloqueado após o busy_timeout."""
+    for tentativa in range(DB_LOCK_RETRIES + 1):
+        try:
+            return operation(*args)
+        except sqlite3.OperationalError as e:
+            if not _is_lock_error(e) or tentativa == DB_LOCK_RETRIES:
+                raise
+            db_pool.count_lock_retry()
+            time.sleep(0.05 * (2 ** tentativa))
+
+class RetryingCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        return _retry_on_lock(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return _retry_on_lock(super().executemany, sql, seq_of_parameters)
+
+def _current_profile():
+    return g.get('profile') if has_app_context() else None
+
+def _parameters_shape(parameters, many=False):
+    # Só os tipos: os valores podem conter dados pessoais
+    if many:
+        first = parameters[0] if parameters else ()
+        return f"{len(parameters)} x {_parameters_shape(first)}"
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f"{k}: {type(v).__name__}" for k, v in parameters.items()) + '}'
+    return '(' + ', '.join(type(v).__name__ for v in parameters) + ')'
+
+def record_query(sql, parameters, duration, many=False):
+    profile = _current_profile()
+    if profile is not None:
+        profile['sql_ms'] += duration * 1000
+        profile['consultas'] += 1
+    if duration * 1000 >= SLOW_QUERY_MS:
+        app.logger.warning("Consulta lenta (%.1f ms) em %s: %s | parâmetros %s", duration * 1000,
+                           request.endpoint if has_request_context() else '-',
+                           ' '.join(sql.split()), _parameters_shape(parameters, many))
+
+def record_rows(count):
+    profile = _current_profile()
+    if profile is not None:
+        profile['linhas'] += count
+
+class ProfilingCursor(RetryingCursor):
+    """Cursor usado com PROFILING=1: mede cada consulta e conta as linhas lidas."""
+
+    def execute(self, sql, parameters=()):
+        inicio = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, parameters, time.perf_counter() - inicio)
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(sql, seq_of_parameters, time.perf_counter() - inicio, many=True)
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            record_rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        record_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        record_rows(len(rows))
+        return rows
+
+    def __next__(self):
+        row = super().__next__()
+        record_rows(1)
+        return row
+
+class PooledConnection(sqlite3.Connection):
+    """Conexão que volta para o pool no close() em vez de ser fechada."""
+
+    def cursor(self, factory=None):
+        if factory is None:
+            factory = ProfilingCursor if PROFILING_ENABLED else RetryingCursor
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        return _retry_on_lock(super().commit)
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+        # Conexões ligadas ao contexto da aplicação são devolvidas no teardown
+        if not self.request_scoped:
+            db_pool.release(self)
+
+    def discard(self):
+        sqlite3.Connection.close(self)
+
+class ConnectionPool:
+    Error = sqlite3.Error
+    OperationalError = sqlite3.OperationalError
+
+    def __init__(self, database, size, timeout):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._stats = {
+            'checkouts': 0,
+            'conexoes_abertas': 0,
+            'espera_total_s': 0.0,
+            'espera_max_s': 0.0,
+            'lock_retries': 0,
+            'timeouts': 0,
+        }
+
+    def _check_fork(self):
+        # Após o fork dos workers do gunicorn (--preload) as conexões herdadas não podem ser reaproveitadas
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, factory=PooledConnection, check_same_thread=False)
+        conn.row_factory = sqlite3.Row  # Permite acessar os dados por nome da coluna
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        with self._lock:
+            self._stats['conexoes_abertas'] += 1
+        return conn
+
+    def checkout(self):
+        self._check_fork()
+        inicio = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise self.OperationalError("Nenhuma conexão livre no pool de banco de dados")
+        espera = time.perf_counter() - inicio
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                conn = self._connect()
+            except Exception:
+                self._slots.release()
+                raise
+        conn.checked_out = True
+        conn.request_scoped = False
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['espera_total_s'] += espera
+            self._stats['espera_max_s'] = max(self._stats['espera_max_s'], espera)
+        return conn
+
+    def release(self, conn):
+        if not getattr(conn, 'checked_out', False):
+            return
+        conn.checked_out = False
+        conn.request_scoped = False
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except self.Error:
+            # Conexão em estado inválido: descarta e libera a vaga
+            conn.discard()
+            with self._lock:
+                self._stats['conexoes_abertas'] -= 1
+            self._slots.release()
+            return
+        self._idle.put(conn)
+        self._slots.release()
+
+    def count_lock_retry(self):
+        with self._lock:
+            self._stats['lock_retries'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['tamanho'] = self.size
+        stats['conexoes_ociosas'] = self._idle.qsize()
+        stats['espera_media_s'] = stats['espera_total_s'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
+
+# O SQL do app é escrito para o SQLite; no PostgreSQL os parâmetros "?" e ":nome" viram
+# %s e %(nome)s, e CROSS JOIN (que no SQLite só fixa a ordem das tabelas) vira JOIN.
+# Textos entre aspas e comentários são copiados como estão ('?' num literal não é parâmetro)
+_SQLITE_PARAMETER = re.compile(r"'(?:[^']|'')*'|--[^\n]*|(\?)|(?<![:\w]):(\w+)")
+
+def _postgres_parameter(match):
+    if match.group(1):
+        return '%s'
+    if match.group(2):
+        return f"%({match.group(2)})s"
+    return match.group(0)
+
+@functools.lru_cache(maxsize=512)
+def postgres_sql(sql):
+    sql = sql.replace('%', '%%').replace('CROSS JOIN', 'JOIN')
+    return _SQLITE_PARAMETER.sub(_postgres_parameter, sql)
+
+_POSTGRES_VALUES = re.compile(r'^\s*INSERT\b.*?\bVALUES\s*(\((?:%s,\s*)*%s\))', re.IGNORECASE | re.DOTALL)
+
+class PostgresCursor:
+    """Cursor do psycopg2 com a interface dos cursores SQLite do app (linhas por nome ou posição)."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, parameters=()):
+        inicio = time.perf_counter()
+        try:
+            self._cursor.execute(postgres_sql(sql), parameters)
+        finally:
+            if PROFILING_ENABLED:
+                record_query(sql, parameters, time.perf_counter() - inicio)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        inicio = time.perf_counter()
+        try:
+            sql = postgres_sql(sql)
+            valores = _POSTGRES_VALUES.search(sql)
+            if valores:
+                # INSERT de várias linhas por página: os triggers por comando (contagem_frota)
+                # rodam uma vez por página, e não uma vez por linha
+                psycopg2.extras.execute_values(self._cursor, sql[:valores.start(1)] + '%s' + sql[valores.end(1):],
+                                               seq_of_parameters, template=valores.group(1), page_size=500)
+            else:
+                # Várias linhas por ida ao servidor, em vez de uma
+                psycopg2.extras.execute_batch(self._cursor, sql, seq_of_parameters, page_size=500)
+        finally:
+            if PROFILING_ENABLED:
+                record_query(sql, seq_of_parameters, time.perf_counter() - inicio, many=True)
+        return self
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def _rows(self, rows):
+        if PROFILING_ENABLED:
+            record_rows(len(rows))
+        return rows
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None and PROFILING_ENABLED:
+            record_rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        return self._rows(self._cursor.fetchmany(self._cursor.arraysize if size is None else size))
+
+    def fetchall(self):
+        return self._rows(self._cursor.fetchall())
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(1000)
+            if not rows:
+                return
+            yield from rows
+
+    def close(self):
+        self._cursor.close()
+
+class PostgresConnection:
+    """Conexão psycopg2 com a interface de PooledConnection."""
+
+    def __init__(self, dsn):
+        self._conn = psycopg2.connect(dsn)
+
+    def cursor(self, name=None):
+        # Com nome, o cursor fica no servidor e as linhas chegam aos poucos (exportações)
+        return PostgresCursor(self._conn.cursor(name, cursor_factory=psycopg2.extras.DictCursor))
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    @property
+    def in_transaction(self):
+        return self._conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+        if not self.request_scoped:
+            db_pool.release(self)
+
+    def discard(self):
+        self._conn.close()
+
+class PostgresConnectionPool(ConnectionPool):
+    """Mesmo pool (limite de conexões, espera e métricas) com conexões ao DATABASE_URL."""
+
+    def __init__(self, database, size, timeout):
+        if psycopg2 is None:
+            raise RuntimeError("DB_BACKEND=postgres requer o pacote psycopg2")
+        self.Error = psycopg2.Error
+        self.OperationalError = psycopg2.OperationalError
+        super().__init__(database, size, timeout)
+
+    def _connect(self):
+        conn = PostgresConnection(self.database)
+        with self._lock:
+            self._stats['conexoes_abertas'] += 1
+        return conn
+
+if DB_BACKEND == 'postgres':
+    db_pool = PostgresConnectionPool(DATABASE_URL, DB_POOL_SIZE, DB_POOL_TIMEOUT)
+else:
+    db_pool = ConnectionPool(DATABASE, DB_POOL_SIZE, DB_POOL_TIMEOUT)
 
 def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row  # Permite acessar os dados por nome da coluna
-    return conn
+    # Dentro de uma requisição a mesma conexão é reutilizada e devolvida no teardown
+    if has_app_context():
+        if 'db' not in g:
+            g.db = db_pool.checkout()
+            g.db.request_scoped = True
+        return g.db
+    return db_pool.checkout()
 
-def init_db():
-    conn = get_db_connection()
+@app.teardown_appcontext
+def release_db_connection(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        db_pool.release(conn)
+
+def create_schema(conn):
     cursor = conn.cursor()
     # Tabela de veículos (incluindo campo "empresa")
     cursor.execute('''
@@ -67,22 +494,2078 @@ def init_db():
         )
     ''')
     conn.commit()
-    # Criação dos usuários master (se não existirem)
-    for login_val, empresa in [('JTD', 'JTD'), ('PCM', 'PCM')]:
-        cursor.execute("SELECT * FROM usuarios WHERE login = ?", (login_val,))
-        if cursor.fetchone() is None:
-            senha_hash = generate_password_hash("123")
-            cursor.execute("INSERT INTO usuarios (login, senha, role, empresa) VALUES (?, ?, ?, ?)",
-                           (login_val, senha_hash, "admin", empresa))
+    migrate_db(conn)
+
+# ---------------------- Migrações de Esquema ----------------------
+# Recalcula os totais de utilização a partir do histórico (migração 3 e bancos gerados fora do app)
+UTILIZATION_REBUILD = [
+    "DELETE FROM utilizacao_veiculos",
+    "DELETE FROM utilizacao_empresas",
+    '''
+    INSERT OR REPLACE INTO utilizacao_veiculos (veiculo_id, empresa, alugueis, dias_alugado, primeira_locacao, ativo_desde)
+    SELECT v.id, v.empresa, COUNT(*),
+           COALESCE(SUM(CASE WHEN a.status = 'Finalizado' THEN
+               MAX(0, CAST(julianday(a.data_devolucao) - julianday(a.data_locacao) AS INTEGER)) END), 0),
+           MIN(a.data_locacao),
+           MAX(CASE WHEN a.status = 'Ativo' THEN a.data_locacao END)
+    FROM alugueis a
+    JOIN veiculos v ON v.id = a.veiculo_id
+    GROUP BY v.id
+    ''',
+    '''
+    INSERT OR REPLACE INTO utilizacao_empresas
+    SELECT empresa, SUM(alugueis), SUM(dias_alugado),
+           COUNT(julianday(ativo_desde)), COALESCE(SUM(julianday(ativo_desde)), 0),
+           COUNT(julianday(primeira_locacao)), COALESCE(SUM(julianday(primeira_locacao)), 0)
+    FROM utilizacao_veiculos
+    GROUP BY empresa
+    ''',
+]
+
+# Mesma normalização de normalize_placa() para as placas guardadas no índice de busca
+PLACA_NORMALIZADA_SQL = "replace(replace(replace(upper({0}.placa), '-', ''), ' ', ''), '.', '')"
+
+# Log de alterações (tabela alteracoes): colunas registradas de cada tabela (a senha dos
+# usuários nunca entra) e a empresa dona da linha; empresas é um cadastro compartilhado
+CHANGE_LOG_COLUMNS = {
+    'veiculos': ['id', 'frota', 'placa', 'eixos', 'piso', 'tipo_carreta', 'comprimento', 'documento', 'empresa'],
+    'alugueis': ['id', 'veiculo_id', 'possuidor', 'local', 'data_locacao', 'data_devolucao', 'status'],
+    'empresas': ['id', 'cnpj', 'razao_social', 'inscricao_estadual', 'local', 'numero', 'telefone', 'email'],
+    'usuarios': ['id', 'login', 'role', 'empresa'],
+}
+# Atualizações só de colunas fora do log (a senha dos usuários, as marcas da importação dos
+# veículos, a empresa copiada nos aluguéis) não entram nele
+CHANGE_LOG_UPDATE_OF = ('usuarios', 'veiculos', 'alugueis')
+CHANGE_LOG_TENANT_SQL = {
+    'veiculos': '{0}.empresa',
+    'alugueis': '(SELECT empresa FROM veiculos WHERE id = {0}.veiculo_id)',
+    'empresas': 'NULL',
+    'usuarios': '{0}.empresa',
+}
+
+def _change_log_trigger(tabela, evento, condicao=None):
+    linha = 'old' if evento == 'delete' else 'new'
+    colunas = CHANGE_LOG_COLUMNS[tabela]
+    # Exclusões registram só o id
+    dados = 'NULL' if evento == 'delete' else \
+        'json_object(' + ', '.join(f"'{c}', new.{c}" for c in colunas) + ')'
+    alvo = f"UPDATE OF {', '.join(colunas[1:])}" if evento == 'update' and tabela in CHANGE_LOG_UPDATE_OF \
+        else evento.upper()
+    return f'''
+        CREATE TRIGGER IF NOT EXISTS alteracoes_{tabela}_{evento} AFTER {alvo} ON {tabela}{' WHEN ' + condicao if condicao else ''} BEGIN
+            INSERT INTO alteracoes (tabela, operacao, registro_id, empresa, dados, criado_em)
+            VALUES ('{tabela}', '{evento.upper()}', {linha}.id, {CHANGE_LOG_TENANT_SQL[tabela].format(linha)}, {dados},
+                    datetime('now'));
+        END
+        '''
+
+# Contagens da frota por empresa (tabela contagem_frota, página /resumo): total e por valor de
+# cada dimensão, com quantos desses veículos têm aluguel ativo. Mantidas por triggers.
+FLEET_COUNTER_DIMENSIONS = ('tipo_carreta', 'eixos', 'piso', 'documento')
+
+def _fleet_counter_values(v):
+    """(dimensão, valor) de cada contagem de um veículo; valores ausentes viram ''."""
+    return [("'total'", "''")] + [(f"'{d}'", f"COALESCE(CAST({v}.{d} AS TEXT), '')") for d in FLEET_COUNTER_DIMENSIONS]
+
+def fleet_counter_upsert(v, veiculos, alugados, origem='', condicao='true'):
+    """Soma `veiculos` e `alugados` às contagens do veículo `v` (uma linha por dimensão)."""
+    linhas = ' UNION ALL '.join(f"SELECT {v}.empresa AS empresa, {dimensao} AS dimensao, {valor} AS valor{origem}"
+                                for dimensao, valor in _fleet_counter_values(v))
+    return f'''
+            INSERT INTO contagem_frota (empresa, dimensao, valor, veiculos, alugados)
+            SELECT empresa, dimensao, valor, {veiculos}, {alugados} FROM ({linhas}) AS linhas
+            WHERE empresa IS NOT NULL AND {condicao}
+            ON CONFLICT (empresa, dimensao, valor) DO UPDATE SET
+                veiculos = contagem_frota.veiculos + excluded.veiculos,
+                alugados = contagem_frota.alugados + excluded.alugados;'''
+
+# Recontagem completa, usada na migração e por "flask check-fleet-counters"
+FLEET_COUNTER_RECOUNT_QUERY = ' UNION ALL '.join(f'''
+    SELECT v.empresa, {dimensao} AS dimensao, {valor} AS valor, COUNT(*) AS veiculos, COUNT(a.id) AS alugados
+    FROM veiculos v
+    LEFT JOIN alugueis a ON a.veiculo_id = v.id AND a.status = 'Ativo'
+    WHERE v.empresa IS NOT NULL
+    GROUP BY 1, 3''' for dimensao, valor in _fleet_counter_values('v'))
+FLEET_COUNTER_REBUILD = [
+    "DELETE FROM contagem_frota",
+    f"INSERT INTO contagem_frota (empresa, dimensao, valor, veiculos, alugados) {FLEET_COUNTER_RECOUNT_QUERY}",
+]
+ACTIVE_RENTALS_OF_SQL = "(SELECT COUNT(*) FROM alugueis WHERE veiculo_id = {0}.id AND status = 'Ativo')"
+
+# Placas são gravadas em maiúsculas (cadastro, edição e importação); a migração converte as
+# antigas. Placas que só diferem nas maiúsculas de outra ficam como estão: juntá-las é manual.
+PLACA_UPPERCASE_MIGRATION = [
+    "CREATE INDEX IF NOT EXISTS idx_veiculos_placa_upper ON veiculos (UPPER(placa))",
+    '''
+    UPDATE veiculos SET placa = UPPER(placa)
+    WHERE placa <> UPPER(placa)
+      AND NOT EXISTS (SELECT 1 FROM veiculos o WHERE UPPER(o.placa) = UPPER(veiculos.placa) AND o.id <> veiculos.id)
+    ''',
+]
+
+# Cada migração é aplicada uma única vez; a versão atual fica em PRAGMA user_version.
+SCHEMA_MIGRATIONS = [
+    (1, [
+        # Lista de veículos por empresa ordenada por frota
+        "CREATE INDEX IF NOT EXISTS idx_veiculos_empresa_frota ON veiculos (empresa, frota)",
+        # Histórico de aluguéis de um veículo
+        "CREATE INDEX IF NOT EXISTS idx_alugueis_veiculo_status ON alugueis (veiculo_id, status)",
+        # Aluguéis ativos: JOIN de status em index() e verificações de rent/delete
+        "CREATE INDEX IF NOT EXISTS idx_alugueis_ativos ON alugueis (veiculo_id) WHERE status = 'Ativo'",
+        # Histórico de fechamento ordenado por data de devolução
+        "CREATE INDEX IF NOT EXISTS idx_alugueis_status_devolucao ON alugueis (status, data_devolucao)",
+        "CREATE INDEX IF NOT EXISTS idx_usuarios_empresa_login ON usuarios (empresa, login)",
+    ]),
+    (2, [
+        # Importações e exportações executadas em segundo plano
+        '''
+        CREATE TABLE IF NOT EXISTS tarefas (
+            id TEXT PRIMARY KEY,
+            tipo TEXT,
+            empresa TEXT,
+            status TEXT,
+            progresso INTEGER DEFAULT 0,
+            mensagem TEXT,
+            artefato TEXT,
+            nome_download TEXT,
+            criado_em TEXT,
+            atualizado_em TEXT
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_tarefas_criado_em ON tarefas (criado_em)",
+    ]),
+    (3, [
+        # Totais de utilização por veículo, mantidos por rent_vehicle/finish_rental
+        '''
+        CREATE TABLE IF NOT EXISTS utilizacao_veiculos (
+            veiculo_id INTEGER PRIMARY KEY,
+            empresa TEXT,
+            alugueis INTEGER DEFAULT 0,
+            dias_alugado INTEGER DEFAULT 0,
+            primeira_locacao TEXT,
+            ativo_desde TEXT
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_utilizacao_veiculos_empresa ON utilizacao_veiculos (empresa)",
+        # Somas por empresa; as datas entram como julianday para o relatório calcular os dias sem varrer a frota
+        '''
+        CREATE TABLE IF NOT EXISTS utilizacao_empresas (
+            empresa TEXT PRIMARY KEY,
+            alugueis INTEGER DEFAULT 0,
+            dias_alugado INTEGER DEFAULT 0,
+            ativos INTEGER DEFAULT 0,
+            soma_inicio_ativos REAL DEFAULT 0,
+            veiculos_com_historico INTEGER DEFAULT 0,
+            soma_primeira_locacao REAL DEFAULT 0
+        )
+        ''',
+        *UTILIZATION_REBUILD,
+    ]),
+    (4, [
+        # Busca por trecho de placa/frota e de possuidor: o tokenizador trigram indexa cada
+        # sequência de 3 caracteres, então '%termo%' vira uma consulta ao índice.
+        # Placas entram normalizadas (maiúsculas, sem hífen/espaço), como em normalize_placa().
+        "CREATE VIRTUAL TABLE IF NOT EXISTS busca_veiculos USING fts5(placa, frota, tokenize='trigram')",
+        f'''
+        CREATE TRIGGER IF NOT EXISTS veiculos_busca_insert AFTER INSERT ON veiculos BEGIN
+            INSERT INTO busca_veiculos (rowid, placa, frota) VALUES (new.id, {PLACA_NORMALIZADA_SQL.format('new')}, new.frota);
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS veiculos_busca_update AFTER UPDATE OF placa, frota ON veiculos BEGIN
+            UPDATE busca_veiculos SET placa = {PLACA_NORMALIZADA_SQL.format('new')}, frota = new.frota WHERE rowid = old.id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS veiculos_busca_delete AFTER DELETE ON veiculos BEGIN
+            DELETE FROM busca_veiculos WHERE rowid = old.id;
+        END
+        ''',
+        f"INSERT INTO busca_veiculos (rowid, placa, frota) SELECT id, {PLACA_NORMALIZADA_SQL.format('veiculos')}, frota FROM veiculos",
+        # Só os aluguéis ativos, que são os filtrados em rentals()
+        "CREATE VIRTUAL TABLE IF NOT EXISTS busca_alugueis USING fts5(possuidor, tokenize='trigram')",
+        '''
+        CREATE TRIGGER IF NOT EXISTS alugueis_busca_insert AFTER INSERT ON alugueis WHEN new.status = 'Ativo' BEGIN
+            INSERT INTO busca_alugueis (rowid, possuidor) VALUES (new.id, new.possuidor);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS alugueis_busca_update AFTER UPDATE OF status, possuidor ON alugueis BEGIN
+            DELETE FROM busca_alugueis WHERE rowid = old.id;
+            INSERT INTO busca_alugueis (rowid, possuidor) SELECT new.id, new.possuidor WHERE new.status = 'Ativo';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS alugueis_busca_delete AFTER DELETE ON alugueis BEGIN
+            DELETE FROM busca_alugueis WHERE rowid = old.id;
+        END
+        ''',
+        "INSERT INTO busca_alugueis (rowid, possuidor) SELECT id, possuidor FROM alugueis WHERE status = 'Ativo'",
+    ]),
+    (5, [
+        # Versão dos dados de cada empresa: qualquer escrita em veiculos/alugueis incrementa,
+        # e a API responde 304 comparando o ETag com ela
+        '''
+        CREATE TABLE IF NOT EXISTS versoes_empresas (
+            empresa TEXT PRIMARY KEY,
+            versao INTEGER DEFAULT 0,
+            atualizado_em TEXT
+        )
+        ''',
+        *[f'''
+        CREATE TRIGGER IF NOT EXISTS versao_{tabela}_{evento} AFTER {evento} ON {tabela} BEGIN
+            INSERT INTO versoes_empresas (empresa, versao, atualizado_em)
+            SELECT {empresa}, 1, datetime('now') WHERE true
+            ON CONFLICT(empresa) DO UPDATE SET versao = versao + 1, atualizado_em = excluded.atualizado_em;
+        END
+        ''' for tabela, evento, empresa in [
+            ('veiculos', 'insert', 'new.empresa'),
+            ('veiculos', 'update', 'new.empresa'),
+            ('veiculos', 'delete', 'old.empresa'),
+            ('alugueis', 'insert', '(SELECT empresa FROM veiculos WHERE id = new.veiculo_id)'),
+            ('alugueis', 'update', '(SELECT empresa FROM veiculos WHERE id = new.veiculo_id)'),
+            ('alugueis', 'delete', '(SELECT empresa FROM veiculos WHERE id = old.veiculo_id)'),
+        ]],
+        "INSERT OR IGNORE INTO versoes_empresas SELECT DISTINCT empresa, 1, datetime('now') FROM veiculos",
+        # Tokens de integração; só o hash SHA-256 é guardado
+        '''
+        CREATE TABLE IF NOT EXISTS api_tokens (
+            token_hash TEXT PRIMARY KEY,
+            empresa TEXT,
+            descricao TEXT,
+            criado_em TEXT
+        )
+        ''',
+    ]),
+    (6, [
+        # Um único aluguel ativo por veículo, garantido pelo banco. Aluguéis ativos duplicados
+        # (gravados antes da restrição) são finalizados, ficando o mais recente.
+        '''
+        UPDATE alugueis SET status = 'Finalizado', data_devolucao = date('now', 'localtime')
+        WHERE status = 'Ativo'
+          AND id NOT IN (SELECT MAX(id) FROM alugueis WHERE status = 'Ativo' GROUP BY veiculo_id)
+        ''',
+        "DROP INDEX IF EXISTS idx_alugueis_ativos",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_alugueis_ativo_unico ON alugueis (veiculo_id) WHERE status = 'Ativo'",
+        *UTILIZATION_REBUILD,
+    ]),
+    (7, [
+        # Sessões no servidor (SESSION_BACKEND=database); id = SHA-256 do valor do cookie
+        '''
+        CREATE TABLE IF NOT EXISTS sessoes (
+            id TEXT PRIMARY KEY,
+            usuario_id INTEGER,
+            dados TEXT,
+            expira_em REAL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_sessoes_usuario ON sessoes (usuario_id)",
+        "CREATE INDEX IF NOT EXISTS idx_sessoes_expira_em ON sessoes (expira_em)",
+    ]),
+    (8, [
+        # Log de alterações somente de inclusão: cada escrita em veiculos, alugueis, empresas e
+        # usuarios gera uma linha com seq crescente, lida por /api/v1/alteracoes?desde=<seq>.
+        # AUTOINCREMENT: um seq nunca é reutilizado, nem depois de apagar as linhas mais novas.
+        '''
+        CREATE TABLE IF NOT EXISTS alteracoes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tabela TEXT NOT NULL,
+            operacao TEXT NOT NULL,
+            registro_id INTEGER,
+            empresa TEXT,
+            dados TEXT,
+            criado_em TEXT
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_alteracoes_empresa_seq ON alteracoes (empresa, seq)",
+        *[_change_log_trigger(tabela, evento) for tabela in CHANGE_LOG_COLUMNS
+          for evento in ('insert', 'update', 'delete')],
+    ]),
+    (9, [
+        # Arquivo dos aluguéis finalizados: uma tabela por ano de devolução, criada por
+        # "flask archive-rentals" e registrada aqui para as consultas saberem onde procurar
+        '''
+        CREATE TABLE IF NOT EXISTS arquivos_alugueis (
+            ano INTEGER PRIMARY KEY,
+            tabela TEXT NOT NULL
+        )
+        ''',
+        # Só tem linha durante a transação do arquivamento: as exclusões em alugueis são então
+        # movimentação para o arquivo e não entram no log de alterações
+        "CREATE TABLE IF NOT EXISTS arquivamento (em_andamento INTEGER)",
+        "DROP TRIGGER IF EXISTS alteracoes_alugueis_delete",
+        _change_log_trigger('alugueis', 'delete', "NOT EXISTS (SELECT 1 FROM arquivamento)"),
+    ]),
+    (10, [
+        # Contagens da frota por empresa; a página /resumo lê só as linhas da empresa
+        '''
+        CREATE TABLE IF NOT EXISTS contagem_frota (
+            empresa TEXT NOT NULL,
+            dimensao TEXT NOT NULL,
+            valor TEXT NOT NULL,
+            veiculos INTEGER DEFAULT 0,
+            alugados INTEGER DEFAULT 0,
+            PRIMARY KEY (empresa, dimensao, valor)
+        ) WITHOUT ROWID
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS contagem_veiculos_insert AFTER INSERT ON veiculos BEGIN
+            {fleet_counter_upsert('new', 1, 0)}
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS contagem_veiculos_update
+        AFTER UPDATE OF {', '.join(FLEET_COUNTER_DIMENSIONS)}, empresa ON veiculos BEGIN
+            {fleet_counter_upsert('old', -1, '-' + ACTIVE_RENTALS_OF_SQL.format('old'))}
+            {fleet_counter_upsert('new', 1, ACTIVE_RENTALS_OF_SQL.format('new'))}
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS contagem_veiculos_delete AFTER DELETE ON veiculos BEGIN
+            {fleet_counter_upsert('old', -1, '-' + ACTIVE_RENTALS_OF_SQL.format('old'))}
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS contagem_alugueis_insert AFTER INSERT ON alugueis WHEN new.status = 'Ativo' BEGIN
+            {fleet_counter_upsert('v', 0, 1, " FROM veiculos v WHERE v.id = new.veiculo_id")}
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS contagem_alugueis_update AFTER UPDATE OF status, veiculo_id ON alugueis BEGIN
+            {fleet_counter_upsert('v', 0, -1, " FROM veiculos v WHERE v.id = old.veiculo_id", "old.status = 'Ativo'")}
+            {fleet_counter_upsert('v', 0, 1, " FROM veiculos v WHERE v.id = new.veiculo_id", "new.status = 'Ativo'")}
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS contagem_alugueis_delete AFTER DELETE ON alugueis WHEN old.status = 'Ativo' BEGIN
+            {fleet_counter_upsert('v', 0, -1, " FROM veiculos v WHERE v.id = old.veiculo_id")}
+        END
+        ''',
+        *FLEET_COUNTER_REBUILD,
+    ]),
+    (11, [
+        # Importação em modo de sincronização: hash do conteúdo da linha da planilha que gravou
+        # o veículo e data da sincronização em que ele não estava na planilha
+        "ALTER TABLE veiculos ADD COLUMN hash_importacao TEXT",
+        "ALTER TABLE veiculos ADD COLUMN ausente_importacao TEXT",
+        "DROP TRIGGER IF EXISTS alteracoes_veiculos_update",
+        _change_log_trigger('veiculos', 'update'),
+    ]),
+    (12, PLACA_UPPERCASE_MIGRATION),
+    (13, [
+        # Empresa do aluguel gravada na própria linha (a dona do veículo quando foi alugado), como
+        # nas tabelas de arquivo: o histórico entra pelo índice da empresa, e não pelo de todas
+        "ALTER TABLE alugueis ADD COLUMN empresa TEXT",
+        "DROP TRIGGER IF EXISTS alteracoes_alugueis_update",
+        _change_log_trigger('alugueis', 'update'),
+        "UPDATE alugueis SET empresa = (SELECT empresa FROM veiculos WHERE id = alugueis.veiculo_id)",
+        "CREATE INDEX IF NOT EXISTS idx_alugueis_empresa_status_devolucao "
+        "ON alugueis (empresa, status, data_devolucao, id)",
+    ]),
+]
+
+# Tabela de arquivo de um ano; as consultas filtram pela empresa gravada na própria linha
+ARCHIVE_TABLE_SQL = [
+    '''
+    CREATE TABLE IF NOT EXISTS {tabela} (
+        id INTEGER PRIMARY KEY,
+        veiculo_id INTEGER,
+        possuidor TEXT,
+        local TEXT,
+        data_locacao TEXT,
+        data_devolucao TEXT,
+        status TEXT,
+        empresa TEXT
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_{tabela}_empresa_devolucao ON {tabela} (empresa, data_devolucao, id)",
+]
+
+def migrate_db(conn):
+    versao_atual = conn.execute("PRAGMA user_version").fetchone()[0]
+    for versao, comandos in SCHEMA_MIGRATIONS:
+        if versao <= versao_atual:
+            continue
+        for comando in comandos:
+            conn.execute(comando)
+        conn.execute(f"PRAGMA user_version = {versao}")
+        conn.commit()
+
+# ---------------------- Esquema no PostgreSQL ----------------------
+# Mesmas tabelas do SQLite. A busca por trecho usa LIKE/ILIKE (com índices trigram quando a
+# extensão pg_trgm está disponível) em vez das tabelas FTS5, e a versão do esquema fica na
+# tabela versao_esquema. Sem FOREIGN KEY em alugueis: como no SQLite (foreign_keys desligado),
+# o histórico de um veículo excluído é mantido.
+POSTGRES_MIGRATION_LOCK = 7212  # pg_advisory_lock: um único servidor aplica as migrações por vez
+
+POSTGRES_CHANGE_LOG_LOCK = 7213  # ordem do log de alterações (ver registra_alteracao)
+POSTGRES_ARCHIVING_SETTING = 'sitepcm.arquivando'  # 'on' na transação que move aluguéis para o arquivo
+POSTGRES_NOT_ARCHIVING = f"current_setting('{POSTGRES_ARCHIVING_SETTING}', true) IS DISTINCT FROM 'on'"
+
+def _postgres_change_log_trigger(tabela, condicao=None):
+    colunas = CHANGE_LOG_COLUMNS[tabela]
+    alvo = f"UPDATE OF {', '.join(colunas[1:])}" if tabela in CHANGE_LOG_UPDATE_OF else 'UPDATE'
+    return (f"CREATE TRIGGER alteracoes_{tabela} AFTER INSERT OR DELETE OR {alvo} ON {tabela} FOR EACH ROW "
+            f"{'WHEN (' + condicao + ') ' if condicao else ''}"
+            f"EXECUTE FUNCTION registra_alteracao({', '.join(repr(c) for c in colunas)})")
+
+def postgres_fleet_counter_upsert(origem, veiculos, alugados):
+    """Versão por comando de fleet_counter_upsert: soma de uma vez as contagens de todas as
+    linhas de `origem` (tabelas de transição do trigger, com os veículos no alias v)."""
+    linhas = ' UNION ALL '.join(f"SELECT v.empresa AS empresa, {dimensao} AS dimensao, {valor} AS valor, "
+                                f"{veiculos} AS veiculos, {alugados} AS alugados FROM {origem}"
+                                for dimensao, valor in _fleet_counter_values('v'))
+    return f'''
+                    INSERT INTO contagem_frota (empresa, dimensao, valor, veiculos, alugados)
+                    SELECT empresa, dimensao, valor, SUM(veiculos), SUM(alugados) FROM ({linhas}) AS linhas
+                    WHERE empresa IS NOT NULL
+                    GROUP BY 1, 2, 3
+                    HAVING SUM(veiculos) <> 0 OR SUM(alugados) <> 0
+                    ON CONFLICT (empresa, dimensao, valor) DO UPDATE SET
+                        veiculos = contagem_frota.veiculos + excluded.veiculos,
+                        alugados = contagem_frota.alugados + excluded.alugados;'''
+
+# Linhas de uma atualização de veiculos (v e a outra versão em o) que mudam as contagens
+POSTGRES_FLEET_COUNTER_CHANGED = '(' + ', '.join(f'v.{c}' for c in (*FLEET_COUNTER_DIMENSIONS, 'empresa')) + \
+    ') IS DISTINCT FROM (' + ', '.join(f'o.{c}' for c in (*FLEET_COUNTER_DIMENSIONS, 'empresa')) + ')'
+
+# Dias desde uma data fixa; faz o papel do julianday() nas somas de utilização
+POSTGRES_DAY_SQL = "(NULLIF({0}, '')::date - DATE '2000-01-01')"
+
+POSTGRES_UTILIZATION_REBUILD = [
+    "DELETE FROM utilizacao_veiculos",
+    "DELETE FROM utilizacao_empresas",
+    f'''
+    INSERT INTO utilizacao_veiculos (veiculo_id, empresa, alugueis, dias_alugado, primeira_locacao, ativo_desde)
+    SELECT v.id, v.empresa, COUNT(*),
+           COALESCE(SUM(CASE WHEN a.status = 'Finalizado' THEN
+               GREATEST(0, {POSTGRES_DAY_SQL.format('a.data_devolucao')} - {POSTGRES_DAY_SQL.format('a.data_locacao')})
+           END), 0),
+           MIN(a.data_locacao),
+           MAX(CASE WHEN a.status = 'Ativo' THEN a.data_locacao END)
+    FROM alugueis a
+    JOIN veiculos v ON v.id = a.veiculo_id
+    GROUP BY v.id, v.empresa
+    ''',
+    f'''
+    INSERT INTO utilizacao_empresas
+    SELECT empresa, SUM(alugueis), SUM(dias_alugado),
+           COUNT(ativo_desde), COALESCE(SUM({POSTGRES_DAY_SQL.format('ativo_desde')}), 0),
+           COUNT(primeira_locacao), COALESCE(SUM({POSTGRES_DAY_SQL.format('primeira_locacao')}), 0)
+    FROM utilizacao_veiculos
+    WHERE empresa IS NOT NULL
+    GROUP BY empresa
+    ''',
+]
+
+POSTGRES_SCHEMA_MIGRATIONS = [
+    (1, [
+        '''
+        CREATE TABLE IF NOT EXISTS veiculos (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            frota TEXT,
+            placa TEXT UNIQUE,
+            eixos INTEGER,
+            piso TEXT,
+            tipo_carreta TEXT,
+            comprimento DOUBLE PRECISION,
+            documento TEXT DEFAULT 'Não',
+            empresa TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS empresas (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            cnpj TEXT UNIQUE,
+            razao_social TEXT UNIQUE,
+            inscricao_estadual TEXT,
+            local TEXT,
+            numero TEXT,
+            telefone TEXT,
+            email TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS alugueis (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            veiculo_id BIGINT,
+            possuidor TEXT,
+            local TEXT,
+            data_locacao TEXT,
+            data_devolucao TEXT,
+            status TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS usuarios (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            login TEXT UNIQUE,
+            senha TEXT,
+            role TEXT,
+            empresa TEXT
+        )
+        ''',
+        # NULLS FIRST: mesma ordem do SQLite, usada pela paginação por chave
+        "CREATE INDEX IF NOT EXISTS idx_veiculos_empresa_frota ON veiculos (empresa, frota NULLS FIRST, id)",
+        "CREATE INDEX IF NOT EXISTS idx_alugueis_veiculo_status ON alugueis (veiculo_id, status)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_alugueis_ativo_unico ON alugueis (veiculo_id) WHERE status = 'Ativo'",
+        "CREATE INDEX IF NOT EXISTS idx_alugueis_status_devolucao ON alugueis (status, data_devolucao NULLS FIRST, id)",
+        "CREATE INDEX IF NOT EXISTS idx_usuarios_empresa_login ON usuarios (empresa, login)",
+        '''
+        CREATE TABLE IF NOT EXISTS tarefas (
+            id TEXT PRIMARY KEY,
+            tipo TEXT,
+            empresa TEXT,
+            status TEXT,
+            progresso INTEGER DEFAULT 0,
+            mensagem TEXT,
+            artefato TEXT,
+            nome_download TEXT,
+            criado_em TEXT,
+            atualizado_em TEXT
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_tarefas_criado_em ON tarefas (criado_em)",
+        '''
+        CREATE TABLE IF NOT EXISTS utilizacao_veiculos (
+            veiculo_id BIGINT PRIMARY KEY,
+            empresa TEXT,
+            alugueis INTEGER DEFAULT 0,
+            dias_alugado INTEGER DEFAULT 0,
+            primeira_locacao TEXT,
+            ativo_desde TEXT
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_utilizacao_veiculos_empresa ON utilizacao_veiculos (empresa)",
+        '''
+        CREATE TABLE IF NOT EXISTS utilizacao_empresas (
+            empresa TEXT PRIMARY KEY,
+            alugueis INTEGER DEFAULT 0,
+            dias_alugado INTEGER DEFAULT 0,
+            ativos INTEGER DEFAULT 0,
+            soma_inicio_ativos DOUBLE PRECISION DEFAULT 0,
+            veiculos_com_historico INTEGER DEFAULT 0,
+            soma_primeira_locacao DOUBLE PRECISION DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS versoes_empresas (
+            empresa TEXT PRIMARY KEY,
+            versao INTEGER DEFAULT 0,
+            atualizado_em TEXT
+        )
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION incrementa_versao_empresa() RETURNS trigger AS $$
+        DECLARE
+            empresa_alterada TEXT;
+        BEGIN
+            IF TG_TABLE_NAME = 'veiculos' THEN
+                empresa_alterada := CASE WHEN TG_OP = 'DELETE' THEN OLD.empresa ELSE NEW.empresa END;
+            ELSE
+                SELECT empresa INTO empresa_alterada FROM veiculos
+                WHERE id = CASE WHEN TG_OP = 'DELETE' THEN OLD.veiculo_id ELSE NEW.veiculo_id END;
+            END IF;
+            IF empresa_alterada IS NOT NULL THEN
+                INSERT INTO versoes_empresas (empresa, versao, atualizado_em)
+                VALUES (empresa_alterada, 1, to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS'))
+                ON CONFLICT (empresa) DO UPDATE SET versao = versoes_empresas.versao + 1,
+                                                    atualizado_em = excluded.atualizado_em;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        *[f"CREATE TRIGGER versao_{tabela} AFTER INSERT OR UPDATE OR DELETE ON {tabela} "
+          "FOR EACH ROW EXECUTE FUNCTION incrementa_versao_empresa()" for tabela in ('veiculos', 'alugueis')],
+        '''
+        CREATE TABLE IF NOT EXISTS api_tokens (
+            token_hash TEXT PRIMARY KEY,
+            empresa TEXT,
+            descricao TEXT,
+            criado_em TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS sessoes (
+            id TEXT PRIMARY KEY,
+            usuario_id BIGINT,
+            dados TEXT,
+            expira_em DOUBLE PRECISION
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_sessoes_usuario ON sessoes (usuario_id)",
+        "CREATE INDEX IF NOT EXISTS idx_sessoes_expira_em ON sessoes (expira_em)",
+        # Índices trigram para LIKE '%trecho%' (placa normalizada, frota e possuidor dos ativos);
+        # sem a extensão as buscas continuam corretas, percorrendo a frota da empresa
+        '''
+        DO $$
+        BEGIN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        EXCEPTION WHEN OTHERS THEN
+            RAISE NOTICE 'pg_trgm indisponível; buscas por trecho sem índice trigram';
+        END
+        $$
+        ''',
+        f'''
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+                CREATE INDEX IF NOT EXISTS idx_veiculos_busca_placa
+                    ON veiculos USING gin (({PLACA_NORMALIZADA_SQL.format('veiculos')}) gin_trgm_ops);
+                CREATE INDEX IF NOT EXISTS idx_veiculos_busca_frota ON veiculos USING gin (frota gin_trgm_ops);
+                CREATE INDEX IF NOT EXISTS idx_alugueis_busca_possuidor
+                    ON alugueis USING gin (possuidor gin_trgm_ops) WHERE status = 'Ativo';
+            END IF;
+        END
+        $$
+        ''',
+    ]),
+    (2, [
+        '''
+        CREATE TABLE IF NOT EXISTS alteracoes (
+            seq BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+            tabela TEXT NOT NULL,
+            operacao TEXT NOT NULL,
+            registro_id BIGINT,
+            empresa TEXT,
+            dados TEXT,
+            criado_em TEXT
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_alteracoes_empresa_seq ON alteracoes (empresa, seq)",
+        # No PostgreSQL várias transações gravam ao mesmo tempo, e um seq menor poderia ficar
+        # visível depois de um maior já lido pelo cliente. A trava de transação (exclusiva por
+        # empresa; compartilhada por todas contra as linhas sem empresa) faz o seq seguir a
+        # ordem de commit dentro do que cada empresa enxerga.
+        f'''
+        CREATE OR REPLACE FUNCTION registra_alteracao() RETURNS trigger AS $$
+        DECLARE
+            linha JSONB;
+            dados JSONB;
+            empresa_alterada TEXT;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                linha := to_jsonb(OLD);
+            ELSE
+                linha := to_jsonb(NEW);
+            END IF;
+            -- Só as colunas de CHANGE_LOG_COLUMNS, recebidas como argumentos do trigger
+            SELECT jsonb_object_agg(chave, valor) INTO dados FROM jsonb_each(linha) AS c (chave, valor)
+            WHERE chave = ANY (TG_ARGV);
+            IF TG_TABLE_NAME = 'alugueis' THEN
+                SELECT empresa INTO empresa_alterada FROM veiculos WHERE id = (linha->>'veiculo_id')::bigint;
+            ELSE
+                empresa_alterada := linha->>'empresa';
+            END IF;
+            IF empresa_alterada IS NULL THEN
+                PERFORM pg_advisory_xact_lock({POSTGRES_CHANGE_LOG_LOCK});
+            ELSE
+                PERFORM pg_advisory_xact_lock_shared({POSTGRES_CHANGE_LOG_LOCK});
+                PERFORM pg_advisory_xact_lock({POSTGRES_CHANGE_LOG_LOCK}, hashtext(empresa_alterada));
+            END IF;
+            INSERT INTO alteracoes (tabela, operacao, registro_id, empresa, dados, criado_em)
+            VALUES (TG_TABLE_NAME, TG_OP, (linha->>'id')::bigint, empresa_alterada,
+                    CASE WHEN TG_OP = 'DELETE' THEN NULL ELSE dados::text END,
+                    to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS'));
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        *[_postgres_change_log_trigger(tabela) for tabela in CHANGE_LOG_COLUMNS],
+    ]),
+    (3, [
+        '''
+        CREATE TABLE IF NOT EXISTS arquivos_alugueis (
+            ano INTEGER PRIMARY KEY,
+            tabela TEXT NOT NULL
+        )
+        ''',
+        # O arquivamento liga POSTGRES_ARCHIVING_SETTING só na própria transação
+        "DROP TRIGGER IF EXISTS alteracoes_alugueis ON alugueis",
+        _postgres_change_log_trigger('alugueis', POSTGRES_NOT_ARCHIVING),
+    ]),
+    (4, [
+        '''
+        CREATE TABLE IF NOT EXISTS contagem_frota (
+            empresa TEXT NOT NULL,
+            dimensao TEXT NOT NULL,
+            valor TEXT NOT NULL,
+            veiculos BIGINT DEFAULT 0,
+            alugados BIGINT DEFAULT 0,
+            PRIMARY KEY (empresa, dimensao, valor)
+        )
+        ''',
+        # Mesmas somas dos triggers do SQLite (migração 10), numa função para as duas tabelas
+        f'''
+        CREATE OR REPLACE FUNCTION atualiza_contagem_frota() RETURNS trigger AS $$
+        BEGIN
+            IF TG_TABLE_NAME = 'veiculos' THEN
+                IF TG_OP <> 'INSERT' THEN
+                    {fleet_counter_upsert('old', -1, '-' + ACTIVE_RENTALS_OF_SQL.format('old'))}
+                END IF;
+                IF TG_OP <> 'DELETE' THEN
+                    {fleet_counter_upsert('new', 1, ACTIVE_RENTALS_OF_SQL.format('new'))}
+                END IF;
+            ELSE
+                IF TG_OP <> 'INSERT' AND OLD.status = 'Ativo' THEN
+                    {fleet_counter_upsert('v', 0, -1, " FROM veiculos v WHERE v.id = old.veiculo_id")}
+                END IF;
+                IF TG_OP <> 'DELETE' AND NEW.status = 'Ativo' THEN
+                    {fleet_counter_upsert('v', 0, 1, " FROM veiculos v WHERE v.id = new.veiculo_id")}
+                END IF;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        f"CREATE TRIGGER contagem_veiculos AFTER INSERT OR DELETE OR UPDATE OF {', '.join(FLEET_COUNTER_DIMENSIONS)}, "
+        "empresa ON veiculos FOR EACH ROW EXECUTE FUNCTION atualiza_contagem_frota()",
+        "CREATE TRIGGER contagem_alugueis AFTER INSERT OR DELETE OR UPDATE OF status, veiculo_id ON alugueis "
+        "FOR EACH ROW EXECUTE FUNCTION atualiza_contagem_frota()",
+        *FLEET_COUNTER_REBUILD,
+    ]),
+    (5, [
+        "ALTER TABLE veiculos ADD COLUMN IF NOT EXISTS hash_importacao TEXT",
+        "ALTER TABLE veiculos ADD COLUMN IF NOT EXISTS ausente_importacao TEXT",
+        "DROP TRIGGER IF EXISTS alteracoes_veiculos ON veiculos",
+        _postgres_change_log_trigger('veiculos'),
+    ]),
+    (6, [
+        # Triggers por linha atualizavam as mesmas linhas de contagem_frota uma vez por veículo:
+        # numa importação grande (uma transação) o PostgreSQL percorre a cadeia de versões da
+        # linha a cada atualização. Por comando, com tabelas de transição, é uma soma por comando.
+        "DROP TRIGGER IF EXISTS contagem_veiculos ON veiculos",
+        "DROP TRIGGER IF EXISTS contagem_alugueis ON alugueis",
+        f'''
+        CREATE OR REPLACE FUNCTION atualiza_contagem_frota() RETURNS trigger AS $$
+        BEGIN
+            IF TG_TABLE_NAME = 'veiculos' THEN
+                IF TG_OP = 'INSERT' THEN
+                    {postgres_fleet_counter_upsert('novas v', 1, ACTIVE_RENTALS_OF_SQL.format('v'))}
+                ELSIF TG_OP = 'DELETE' THEN
+                    {postgres_fleet_counter_upsert('antigas v', -1, '-' + ACTIVE_RENTALS_OF_SQL.format('v'))}
+                ELSE
+                    {postgres_fleet_counter_upsert(
+                        f'antigas v JOIN novas o ON o.id = v.id WHERE {POSTGRES_FLEET_COUNTER_CHANGED}',
+                        -1, '-' + ACTIVE_RENTALS_OF_SQL.format('v'))}
+                    {postgres_fleet_counter_upsert(
+                        f'novas v JOIN antigas o ON o.id = v.id WHERE {POSTGRES_FLEET_COUNTER_CHANGED}',
+                        1, ACTIVE_RENTALS_OF_SQL.format('v'))}
+                END IF;
+            ELSE
+                IF TG_OP = 'INSERT' THEN
+                    {postgres_fleet_counter_upsert(
+                        "novas a JOIN veiculos v ON v.id = a.veiculo_id WHERE a.status = 'Ativo'", 0, 1)}
+                ELSIF TG_OP = 'DELETE' THEN
+                    {postgres_fleet_counter_upsert(
+                        "antigas a JOIN veiculos v ON v.id = a.veiculo_id WHERE a.status = 'Ativo'", 0, -1)}
+                ELSE
+                    {postgres_fleet_counter_upsert(
+                        "antigas a JOIN novas n ON n.id = a.id JOIN veiculos v ON v.id = a.veiculo_id "
+                        "WHERE a.status = 'Ativo' AND (a.status, a.veiculo_id) IS DISTINCT FROM (n.status, n.veiculo_id)",
+                        0, -1)}
+                    {postgres_fleet_counter_upsert(
+                        "novas a JOIN antigas o ON o.id = a.id JOIN veiculos v ON v.id = a.veiculo_id "
+                        "WHERE a.status = 'Ativo' AND (a.status, a.veiculo_id) IS DISTINCT FROM (o.status, o.veiculo_id)",
+                        0, 1)}
+                END IF;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        # Tabelas de transição só valem para triggers de um único evento e sem lista de colunas
+        *[f"CREATE TRIGGER contagem_{tabela}_{evento} AFTER {evento.upper()} ON {tabela} REFERENCING {transicao} "
+          "FOR EACH STATEMENT EXECUTE FUNCTION atualiza_contagem_frota()"
+          for tabela in ('veiculos', 'alugueis')
+          for evento, transicao in (('insert', 'NEW TABLE AS novas'),
+                                    ('update', 'OLD TABLE AS antigas NEW TABLE AS novas'),
+                                    ('delete', 'OLD TABLE AS antigas'))],
+    ]),
+    (7, PLACA_UPPERCASE_MIGRATION),
+    (8, [
+        "ALTER TABLE alugueis ADD COLUMN IF NOT EXISTS empresa TEXT",
+        "DROP TRIGGER IF EXISTS alteracoes_alugueis ON alugueis",
+        _postgres_change_log_trigger('alugueis', POSTGRES_NOT_ARCHIVING),
+        # Sem os triggers no preenchimento: a versão de cada empresa seria atualizada uma vez por
+        # aluguel na mesma transação
+        "ALTER TABLE alugueis DISABLE TRIGGER USER",
+        "UPDATE alugueis a SET empresa = v.empresa FROM veiculos v WHERE v.id = a.veiculo_id",
+        "ALTER TABLE alugueis ENABLE TRIGGER USER",
+        "CREATE INDEX IF NOT EXISTS idx_alugueis_empresa_status_devolucao "
+        "ON alugueis (empresa, status, data_devolucao NULLS FIRST, id)",
+    ]),
+]
+
+POSTGRES_ARCHIVE_TABLE_SQL = [
+    '''
+    CREATE TABLE IF NOT EXISTS {tabela} (
+        id BIGINT PRIMARY KEY,
+        veiculo_id BIGINT,
+        possuidor TEXT,
+        local TEXT,
+        data_locacao TEXT,
+        data_devolucao TEXT,
+        status TEXT,
+        empresa TEXT
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_{tabela}_empresa_devolucao ON {tabela} (empresa, data_devolucao NULLS FIRST, id)",
+]
+
+def migrate_postgres(conn):
+    conn.execute("SELECT pg_advisory_lock(?)", (POSTGRES_MIGRATION_LOCK,))
+    try:
+        conn.execute("CREATE TABLE IF NOT EXISTS versao_esquema (versao INTEGER NOT NULL)")
+        versao_atual = conn.execute("SELECT COALESCE(MAX(versao), 0) FROM versao_esquema").fetchone()[0]
+        for versao, comandos in POSTGRES_SCHEMA_MIGRATIONS:
+            if versao <= versao_atual:
+                continue
+            for comando in comandos:
+                conn.execute(comando)
+            conn.execute("INSERT INTO versao_esquema (versao) VALUES (?)", (versao,))
             conn.commit()
-    conn.close()
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute("SELECT pg_advisory_unlock(?)", (POSTGRES_MIGRATION_LOCK,))
+        conn.commit()
+
+# ---------------------- Consultas das Rotas ----------------------
+# Mantidas em constantes para que check-query-plans valide exatamente o SQL usado nas rotas.
+VEHICLES_COLUMNS = "SELECT v.*, COALESCE(a.status, 'Livre') as status"
+VEHICLES_QUERY = VEHICLES_COLUMNS + '''
+    FROM veiculos v
+    LEFT JOIN alugueis a ON v.id = a.veiculo_id AND a.status = 'Ativo'
+    WHERE v.empresa = ?
+'''
+# Com busca, o índice FTS conduz a consulta e só os veículos encontrados são ordenados
+VEHICLES_SEARCH_QUERY = VEHICLES_COLUMNS + '''
+    FROM busca_veiculos
+    CROSS JOIN veiculos v ON v.id = busca_veiculos.rowid
+    LEFT JOIN alugueis a ON v.id = a.veiculo_id AND a.status = 'Ativo'
+    WHERE busca_veiculos MATCH ? AND v.empresa = ?
+'''
+USER_BY_LOGIN_QUERY = "SELECT * FROM usuarios WHERE login = ?"
+USER_QUERY = "SELECT * FROM usuarios WHERE id = ?"
+TENANT_USERS_QUERY = "SELECT * FROM usuarios WHERE empresa = ? ORDER BY login"
+VEHICLE_QUERY = "SELECT * FROM veiculos WHERE id = ?"
+TENANT_VEHICLES_IN_QUERY = "SELECT id FROM veiculos WHERE empresa = ? AND id IN ({0})"
+ACTIVE_RENTAL_COUNT_QUERY = "SELECT COUNT(*) FROM alugueis WHERE veiculo_id = ? AND status = 'Ativo'"
+ACTIVE_RENTAL_QUERY = "SELECT veiculo_id, data_locacao FROM alugueis WHERE id = ? AND status = 'Ativo'"
+INSERT_RENTAL_SQL = '''
+    INSERT INTO alugueis (veiculo_id, possuidor, local, data_locacao, status, empresa)
+    SELECT id, ?, ?, ?, 'Ativo', empresa FROM veiculos WHERE id = ?
+'''
+FINISH_RENTAL_SQL = "UPDATE alugueis SET status = 'Finalizado', data_devolucao = ? WHERE id = ? AND status = 'Ativo'"
+RENTALS_COLUMNS = '''
+    SELECT a.*, v.frota, v.placa, a.data_locacao,
+           COALESCE(CAST(julianday('now', 'localtime') - julianday(a.data_locacao) AS INTEGER), 0) AS dias_uso
+'''
+RENTALS_FROM = '''
+    FROM veiculos v
+    CROSS JOIN alugueis a ON a.veiculo_id = v.id
+    WHERE a.status = 'Ativo' AND v.empresa = ?
+'''
+RENTALS_QUERY = RENTALS_COLUMNS + RENTALS_FROM
+RENTALS_PLACA_SEARCH_QUERY = RENTALS_COLUMNS + '''
+    FROM busca_veiculos
+    CROSS JOIN veiculos v ON v.id = busca_veiculos.rowid
+    CROSS JOIN alugueis a ON a.veiculo_id = v.id
+    WHERE busca_veiculos MATCH ? AND a.status = 'Ativo' AND v.empresa = ?
+'''
+RENTALS_POSSUIDOR_SEARCH_QUERY = RENTALS_COLUMNS + '''
+    FROM busca_alugueis
+    CROSS JOIN alugueis a ON a.id = busca_alugueis.rowid
+    CROSS JOIN veiculos v ON v.id = a.veiculo_id
+    WHERE busca_alugueis MATCH ? AND a.status = 'Ativo' AND v.empresa = ?
+'''
+# Termos curtos demais para o índice trigram continuam com LIKE
+PLACA_FILTER = " AND v.placa LIKE ?"
+RENTALS_POSSUIDOR_FILTER = " AND a.possuidor LIKE ?"
+RENTALS_POSSUIDOR_SEARCH_FILTER = " AND a.id IN (SELECT rowid FROM busca_alugueis WHERE busca_alugueis MATCH ?)"
+TYPEAHEAD_LIMIT = 10
+TYPEAHEAD_SEARCH_QUERY = '''
+    SELECT v.id, v.frota, v.placa
+    FROM busca_veiculos
+    CROSS JOIN veiculos v ON v.id = busca_veiculos.rowid
+    WHERE busca_veiculos MATCH ? AND v.empresa = ?
+    ORDER BY v.placa
+    LIMIT ?
+'''
+TYPEAHEAD_FROTA_PREFIX_QUERY = '''
+    SELECT id, frota, placa
+    FROM veiculos
+    WHERE empresa = ? AND frota >= ? AND frota < ?
+    ORDER BY frota
+    LIMIT ?
+'''
+HISTORY_QUERY = '''
+    SELECT a.*, v.frota, v.placa 
+    FROM alugueis a
+    JOIN veiculos v ON a.veiculo_id = v.id
+    WHERE a.status = 'Finalizado' AND a.empresa = ?
+'''
+HISTORY_PERIOD_FILTER = " AND a.data_devolucao BETWEEN ? AND ?"
+# Aluguéis finalizados antigos ficam em tabelas de arquivo por ano de devolução (archive-rentals)
+ARCHIVE_TABLE = 'alugueis_arquivo_{ano}'
+ARCHIVE_HISTORY_QUERY = '''
+    SELECT a.id, a.veiculo_id, a.possuidor, a.local, a.data_locacao, a.data_devolucao, a.status, v.frota, v.placa
+    FROM {tabela} a
+    JOIN veiculos v ON a.veiculo_id = v.id
+    WHERE a.empresa = ?
+'''
+ARCHIVE_CANDIDATES_QUERY = '''
+    SELECT id, data_devolucao
+    FROM alugueis
+    WHERE status = 'Finalizado' AND data_devolucao >= '1000-01-01' AND data_devolucao < ?
+    ORDER BY data_devolucao
+    LIMIT ?
+'''
+ARCHIVE_INSERT_SQL = '''
+    INSERT INTO {tabela} (id, veiculo_id, possuidor, local, data_locacao, data_devolucao, status, empresa)
+    SELECT a.id, a.veiculo_id, a.possuidor, a.local, a.data_locacao, a.data_devolucao, a.status,
+           COALESCE(a.empresa, v.empresa)
+    FROM alugueis a
+    LEFT JOIN veiculos v ON v.id = a.veiculo_id
+    WHERE a.id IN ({ids})
+'''
+TENANT_VERSION_QUERY = "SELECT versao, atualizado_em FROM versoes_empresas WHERE empresa = ?"
+# Dados compartilhados (empresas) não têm versão própria: a última alteração sem empresa no log
+SHARED_DATA_VERSION_QUERY = "SELECT COALESCE(MAX(seq), 0) FROM alteracoes WHERE empresa IS NULL"
+API_TOKEN_QUERY = "SELECT empresa FROM api_tokens WHERE token_hash = ?"
+# Linhas sem empresa (cadastro de empresas) valem para todas
+CHANGES_QUERY = '''
+    SELECT seq, tabela, operacao, registro_id, dados, criado_em
+    FROM alteracoes
+    WHERE (empresa = ? OR empresa IS NULL) AND seq > ?
+    ORDER BY seq
+    LIMIT ?
+'''
+COMPANIES_QUERY = "SELECT id, razao_social FROM empresas ORDER BY razao_social"
+ALL_COMPANIES_QUERY = "SELECT * FROM empresas"
+# Algumas dezenas de linhas por empresa, qualquer que seja o tamanho da frota
+FLEET_COUNTS_QUERY = "SELECT dimensao, valor, veiculos, alugados FROM contagem_frota WHERE empresa = ? AND veiculos > 0"
+# Dias de uso contam até hoje; o período de cada veículo começa na primeira locação
+UTILIZATION_TENANT_QUERY = '''
+    SELECT alugueis, ativos, veiculos_com_historico,
+           dias_alugado + CAST(ROUND(ativos * julianday(date('now', 'localtime')) - soma_inicio_ativos) AS INTEGER)
+               AS dias_alugado,
+           CAST(ROUND(veiculos_com_historico * julianday(date('now', 'localtime')) - soma_primeira_locacao) AS INTEGER)
+               AS dias_periodo
+    FROM utilizacao_empresas
+    WHERE empresa = ?
+'''
+UTILIZATION_VEHICLES_QUERY = '''
+    SELECT v.id, v.frota, v.placa, COALESCE(u.alugueis, 0) AS alugueis, u.primeira_locacao, u.ativo_desde,
+           COALESCE(u.dias_alugado, 0)
+               + COALESCE(CAST(julianday(date('now', 'localtime')) - julianday(u.ativo_desde) AS INTEGER), 0)
+               AS dias_alugado,
+           CAST(julianday(date('now', 'localtime')) - julianday(u.primeira_locacao) AS INTEGER) AS dias_periodo
+    FROM veiculos v
+    LEFT JOIN utilizacao_veiculos u ON u.veiculo_id = v.id
+    WHERE v.empresa = ?
+'''
+ACTIVE_RENTALS_IN_QUERY = "SELECT veiculo_id FROM alugueis WHERE status = 'Ativo' AND veiculo_id IN ({0})"
+TENANT_ACTIVE_RENTALS_IN_QUERY = '''
+    SELECT a.id, a.veiculo_id, a.data_locacao
+    FROM alugueis a
+    JOIN veiculos v ON v.id = a.veiculo_id
+    WHERE a.id IN ({0}) AND a.status = 'Ativo' AND v.empresa = ?
+'''
+
+# Variantes do PostgreSQL: datas pela aritmética de date e busca por LIKE/ILIKE no lugar do FTS5
+POSTGRES_RENTALS_COLUMNS = '''
+    SELECT a.*, v.frota, v.placa, a.data_locacao,
+           COALESCE(CURRENT_DATE - NULLIF(a.data_locacao, '')::date, 0) AS dias_uso
+'''
+POSTGRES_PLACA_SEARCH_FILTER = f" AND {PLACA_NORMALIZADA_SQL.format('v')} LIKE ?"
+POSTGRES_PLACA_FILTER = " AND v.placa ILIKE ?"
+POSTGRES_POSSUIDOR_FILTER = " AND a.possuidor ILIKE ?"
+POSTGRES_TYPEAHEAD_SEARCH_QUERY = f'''
+    SELECT v.id, v.frota, v.placa
+    FROM veiculos v
+    WHERE v.empresa = ? AND ({PLACA_NORMALIZADA_SQL.format('v')} LIKE ? OR v.frota ILIKE ?)
+    ORDER BY v.placa
+    LIMIT ?
+'''
+POSTGRES_TODAY_SQL = "(CURRENT_DATE - DATE '2000-01-01')"
+POSTGRES_UTILIZATION_TENANT_QUERY = f'''
+    SELECT alugueis, ativos, veiculos_com_historico,
+           dias_alugado + CAST(ROUND(ativos * {POSTGRES_TODAY_SQL} - soma_inicio_ativos) AS INTEGER) AS dias_alugado,
+           CAST(ROUND(veiculos_com_historico * {POSTGRES_TODAY_SQL} - soma_primeira_locacao) AS INTEGER)
+               AS dias_periodo
+    FROM utilizacao_empresas
+    WHERE empresa = ?
+'''
+POSTGRES_UTILIZATION_VEHICLES_QUERY = '''
+    SELECT v.id, v.frota, v.placa, COALESCE(u.alugueis, 0) AS alugueis, u.primeira_locacao, u.ativo_desde,
+           COALESCE(u.dias_alugado, 0) + COALESCE(CURRENT_DATE - NULLIF(u.ativo_desde, '')::date, 0)
+               AS dias_alugado,
+           CURRENT_DATE - NULLIF(u.primeira_locacao, '')::date AS dias_periodo
+    FROM veiculos v
+    LEFT JOIN utilizacao_veiculos u ON u.veiculo_id = v.id
+    WHERE v.empresa = ?
+'''
+
+# ---------------------- Busca de Placas e Possuidores ----------------------
+SEARCH_MIN_CHARS = 3  # o tokenizador trigram só encontra trechos de 3 caracteres ou mais
+
+def normalize_placa(value):
+    return ''.join(ch for ch in value.upper() if ch.isalnum())
+
+def fts_match(columns, value):
+    """Expressão MATCH de um trecho literal (aspas escapadas) nas colunas informadas."""
+    return '{' + ' '.join(columns) + '} : "' + value.replace('"', '""') + '"'
+
+def like_contains(value):
+    """Padrão LIKE de um trecho literal (escapa %, _ e a barra, o caractere de escape padrão do PostgreSQL)."""
+    return '%' + re.sub(r'([\\%_])', r'\\\1', value) + '%'
+
+# ---------------------- Paginação por Chave (keyset) ----------------------
+# Cada listagem é ordenada por (chave, desempate); a página seguinte começa depois da
+# última linha exibida, então o custo não depende de quantas páginas já foram vistas.
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 50))
+MAX_PAGE_SIZE = 500
+
+Keyset = namedtuple('Keyset', 'coluna campo desempate campo_desempate descendente')
+VEHICLES_KEYSET = Keyset('v.frota', 'frota', 'v.id', 'id', False)
+# v.id como desempate mantém a ordem do índice (empresa, frota); há um aluguel ativo por veículo
+# (idx_alugueis_ativo_unico)
+RENTALS_KEYSET = Keyset('v.frota', 'frota', 'v.id', 'veiculo_id', False)
+HISTORY_KEYSET = Keyset('a.data_devolucao', 'data_devolucao', 'a.id', 'id', True)
+Page = namedtuple('Page', 'posicao para_tras limite')
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def decode_cursor(token):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != 2:
+        return None
+    # Cursor editado à mão: só chave escalar e id inteiro viram parâmetros da consulta
+    key, row_id = values
+    if isinstance(key, bool) or not isinstance(key, (str, int, float, type(None))) or \
+            isinstance(row_id, bool) or not isinstance(row_id, int):
+        return None
+    if any(isinstance(v, int) and not -2 ** 63 <= v < 2 ** 63 for v in values):
+        return None
+    return values
+
+def keyset_query(query, keyset, position=None, backward=False):
+    """Completa a consulta com o filtro de posição, ORDER BY e LIMIT da página."""
+    ascending = keyset.descendente == backward
+    params = []
+    if position is not None:
+        key, row_id = position
+        coluna, desempate = keyset.coluna, keyset.desempate
+        # NULL vem antes de qualquer valor e comparações com NULL nunca são verdadeiras
+        if ascending and key is None:
+            query += f" AND (({coluna} IS NULL AND {desempate} > ?) OR {coluna} IS NOT NULL)"
+            params = [row_id]
+        elif ascending:
+            query += f" AND ({coluna}, {desempate}) > (?, ?)"
+            params = [key, row_id]
+        elif key is None:
+            query += f" AND {coluna} IS NULL AND {desempate} < ?"
+            params = [row_id]
+        else:
+            query += f" AND (({coluna}, {desempate}) < (?, ?) OR {coluna} IS NULL)"
+            params = [key, row_id]
+    # NULLS FIRST/LAST explícito: o PostgreSQL ordena NULL ao contrário do SQLite
+    direction = 'ASC NULLS FIRST' if ascending else 'DESC NULLS LAST'
+    query += f" ORDER BY {keyset.coluna} {direction}, {keyset.desempate} {direction} LIMIT ?"
+    return query, params
+
+def merge_pages(partes, keyset, page):
+    """Junta as páginas da mesma listagem lidas de tabelas diferentes, na ordem da paginação."""
+    if len(partes) == 1:
+        return partes[0]
+    ascending = keyset.descendente == page.para_tras
+
+    def chave(row):
+        # NULL antes de qualquer valor, como no ORDER BY de keyset_query
+        valor = row[keyset.campo]
+        return (valor is not None, valor if valor is not None else '', row[keyset.campo_desempate])
+    rows = sorted((row for parte in partes for row in parte), key=chave, reverse=not ascending)
+    return rows[:page.limite]
+
+def get_page_size():
+    try:
+        size = int(request.args.get('por_pagina', PAGE_SIZE))
+    except ValueError:
+        size = PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+def fetch_page(load, keyset):
+    """Busca uma página conforme ?apos=/?antes= e devolve (linhas, links de navegação).
+
+    load(Page) devolve as linhas a partir da posição, até page.limite (uma a mais que a
+    página, para saber se há outra depois).
+    """
+    page_size = get_page_size()
+    before = request.args.get('antes')
+    after = request.args.get('apos')
+    position = decode_cursor(before) if before else decode_cursor(after) if after else None
+    backward = bool(before) and position is not None
+    rows = list(load(Page(position, backward, page_size + 1)))
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backward:
+        rows.reverse()
+    has_next = has_more if not backward else True
+    has_previous = has_more if backward else position is not None
+    args = {k: v for k, v in request.args.items() if k not in ('apos', 'antes')}
+    pagination = {'primeira': None, 'anterior': None, 'proxima': None}
+    if rows and has_previous:
+        first = rows[0]
+        pagination['primeira'] = url_for(request.endpoint, **args)
+        pagination['anterior'] = url_for(request.endpoint, antes=encode_cursor(
+            [first[keyset.campo], first[keyset.campo_desempate]]), **args)
+    if rows and has_next:
+        last = rows[-1]
+        pagination['proxima'] = url_for(request.endpoint, apos=encode_cursor(
+            [last[keyset.campo], last[keyset.campo_desempate]]), **args)
+    return rows, pagination
+
+# ---------------------- Cache por Empresa ----------------------
+# Leituras frequentes e raramente alteradas (status da frota, lista de empresas) ficam em
+# memória no processo. Cada entrada guarda a versão dos dados da empresa lida do banco
+# (versoes_empresas, incrementada pelos triggers). A versão só é relida quando a entrada não
+# foi conferida nos últimos CACHE_VERSION_CHECK_S segundos, então a maioria dos acertos não
+# vai ao banco: uma escrita feita por outro worker do gunicorn aparece em no máximo
+# CACHE_VERSION_CHECK_S segundos (e nunca depois de CACHE_TTL_S). As rotas de escrita
+# invalidam a empresa no próprio processo na hora.
+CACHE_TTL_S = float(os.environ.get('CACHE_TTL_S', 30))
+CACHE_VERSION_CHECK_S = float(os.environ.get('CACHE_VERSION_CHECK_S', 2))
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 1024))
+GLOBAL_CACHE_KEY = None  # dados compartilhados por todas as empresas (tabela empresas)
+
+def cache_version(empresa):
+    """Versão atual no banco dos dados da empresa (ou dos compartilhados, com GLOBAL_CACHE_KEY)."""
+    if empresa is GLOBAL_CACHE_KEY:
+        return repository.shared_data_version()
+    versao = repository.tenant_version(empresa)
+    return versao['versao'] if versao else 0
+
+class TenantCache:
+    def __init__(self, max_entries, ttl, version=None, version_check=0.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version_check = version_check
+        self._version = version
+        self._entries = OrderedDict()  # (empresa, chave) -> (expira_em, valor, versão, conferida_em)
+        # Geração de cada empresa, incrementada por invalidate(): um carregamento que começou
+        # antes da invalidação não grava o resultado (já desatualizado)
+        self._generations = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'expiradas': 0, 'desatualizadas': 0, 'removidas_lru': 0,
+                       'invalidacoes': 0, 'versoes_lidas': 0}
+
+    def _hit(self, entry_key, entry):
+        self._entries[entry_key] = entry
+        self._entries.move_to_end(entry_key)
+        self._stats['hits'] += 1
+        return entry[1]
+
+    def get_or_load(self, empresa, key, loader):
+        entry_key = (empresa, key)
+        agora = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            # Conferida há pouco: serve sem reler a versão
+            if entry is not None and entry[0] > agora and (not self._version or agora - entry[3] < self.version_check):
+                return self._hit(entry_key, entry)
+        versao = None
+        if self._version:
+            versao = self._version(empresa)
+            with self._lock:
+                self._stats['versoes_lidas'] += 1
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is not None:
+                if entry[0] > agora and entry[2] == versao:
+                    return self._hit(entry_key, entry[:3] + (agora,))
+                del self._entries[entry_key]
+                self._stats['expiradas' if entry[0] <= agora else 'desatualizadas'] += 1
+            self._stats['misses'] += 1
+            generation = self._generations.get(empresa, 0)
+        value = loader()
+        with self._lock:
+            if self._generations.get(empresa, 0) == generation:
+                self._entries[entry_key] = (agora + self.ttl, value, versao, agora)
+                self._entries.move_to_end(entry_key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self._stats['removidas_lru'] += 1
+        return value
+
+    def invalidate(self, empresa):
+        with self._lock:
+            self._generations[empresa] = self._generations.get(empresa, 0) + 1
+            for entry_key in [k for k in self._entries if k[0] == empresa]:
+                del self._entries[entry_key]
+            self._stats['invalidacoes'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entradas'] = len(self._entries)
+        consultas = stats['hits'] + stats['misses']
+        stats['taxa_acerto'] = stats['hits'] / consultas if consultas else 0.0
+        return stats
+
+tenant_cache = TenantCache(CACHE_MAX_ENTRIES, CACHE_TTL_S, version=cache_version, version_check=CACHE_VERSION_CHECK_S)
+
+# ---------------------- Utilização da Frota ----------------------
+# Os totais são atualizados junto com cada aluguel, na mesma transação: o relatório lê
+# uma linha por empresa (e uma por veículo) em vez de percorrer todo o histórico.
+# Soma (:s = 1) ou retira (:s = -1) a contribuição atual do veículo nos totais da empresa
+UTILIZATION_TENANT_DELTA_UPSERT = '''
+    ON CONFLICT(empresa) DO UPDATE SET
+        alugueis = utilizacao_empresas.alugueis + excluded.alugueis,
+        dias_alugado = utilizacao_empresas.dias_alugado + excluded.dias_alugado,
+        ativos = utilizacao_empresas.ativos + excluded.ativos,
+        soma_inicio_ativos = utilizacao_empresas.soma_inicio_ativos + excluded.soma_inicio_ativos,
+        veiculos_com_historico = utilizacao_empresas.veiculos_com_historico + excluded.veiculos_com_historico,
+        soma_primeira_locacao = utilizacao_empresas.soma_primeira_locacao + excluded.soma_primeira_locacao
+'''
+UTILIZATION_TENANT_DELTA_SQL = '''
+    INSERT INTO utilizacao_empresas (empresa, alugueis, dias_alugado, ativos, soma_inicio_ativos,
+                                     veiculos_com_historico, soma_primeira_locacao)
+    SELECT empresa, :s * alugueis, :s * dias_alugado,
+           :s * (julianday(ativo_desde) IS NOT NULL), :s * COALESCE(julianday(ativo_desde), 0),
+           :s * (julianday(primeira_locacao) IS NOT NULL), :s * COALESCE(julianday(primeira_locacao), 0)
+    FROM utilizacao_veiculos
+    WHERE veiculo_id = :id
+''' + UTILIZATION_TENANT_DELTA_UPSERT
+UTILIZATION_RENTAL_STARTED_SQL = '''
+    INSERT INTO utilizacao_veiculos (veiculo_id, empresa, alugueis, dias_alugado, primeira_locacao, ativo_desde)
+    SELECT id, empresa, 1, 0, :data, :data FROM veiculos WHERE id = :id
+    ON CONFLICT(veiculo_id) DO UPDATE SET
+        alugueis = utilizacao_veiculos.alugueis + 1,
+        primeira_locacao = MIN(COALESCE(utilizacao_veiculos.primeira_locacao, excluded.primeira_locacao),
+                               excluded.primeira_locacao),
+        ativo_desde = excluded.ativo_desde
+'''
+UTILIZATION_RENTAL_FINISHED_SQL = '''
+    UPDATE utilizacao_veiculos
+    SET dias_alugado = dias_alugado + MAX(0, COALESCE(CAST(julianday(?) - julianday(?) AS INTEGER), 0)),
+        ativo_desde = NULL
+    WHERE veiculo_id = ?
+'''
+# No PostgreSQL MIN/MAX de dois valores são LEAST/GREATEST, e empresa NULL não pode ser chave
+POSTGRES_UTILIZATION_TENANT_DELTA_SQL = f'''
+    INSERT INTO utilizacao_empresas (empresa, alugueis, dias_alugado, ativos, soma_inicio_ativos,
+                                     veiculos_com_historico, soma_primeira_locacao)
+    SELECT empresa, :s * alugueis, :s * dias_alugado,
+           :s * (CASE WHEN ativo_desde IS NULL THEN 0 ELSE 1 END),
+           :s * COALESCE({POSTGRES_DAY_SQL.format('ativo_desde')}, 0),
+           :s * (CASE WHEN primeira_locacao IS NULL THEN 0 ELSE 1 END),
+           :s * COALESCE({POSTGRES_DAY_SQL.format('primeira_locacao')}, 0)
+    FROM utilizacao_veiculos
+    WHERE veiculo_id = :id AND empresa IS NOT NULL
+''' + UTILIZATION_TENANT_DELTA_UPSERT
+POSTGRES_UTILIZATION_RENTAL_STARTED_SQL = UTILIZATION_RENTAL_STARTED_SQL.replace('MIN(', 'LEAST(')
+POSTGRES_UTILIZATION_RENTAL_FINISHED_SQL = f'''
+    UPDATE utilizacao_veiculos
+    SET dias_alugado = dias_alugado + GREATEST(0, COALESCE({POSTGRES_DAY_SQL.format('?')}
+                                                          - {POSTGRES_DAY_SQL.format('?')}, 0)),
+        ativo_desde = NULL
+    WHERE veiculo_id = ?
+'''
+
+# ---------------------- Camada de Acesso a Dados ----------------------
+# Todo o SQL das rotas, tarefas e comandos passa por `repository`. SQLiteRepository (padrão)
+# usa o arquivo DATABASE; PostgresRepository (DB_BACKEND=postgres) reaproveita o SQL
+# portável e sobrescreve só o que depende do banco: esquema, busca, datas e travas de linha.
+# As conexões vêm de db_pool; dentro de uma requisição a mesma conexão é reaproveitada.
+class SQLiteRepository:
+    IntegrityError = sqlite3.IntegrityError
+    Error = sqlite3.Error
+    BEGIN_WRITE = "BEGIN IMMEDIATE"
+    LOCK_ROWS = ''
+    RENTALS_COLUMNS = RENTALS_COLUMNS
+    UTILIZATION_TENANT_QUERY = UTILIZATION_TENANT_QUERY
+    UTILIZATION_VEHICLES_QUERY = UTILIZATION_VEHICLES_QUERY
+    UTILIZATION_REBUILD = UTILIZATION_REBUILD
+    UTILIZATION_TENANT_DELTA_SQL = UTILIZATION_TENANT_DELTA_SQL
+    UTILIZATION_RENTAL_STARTED_SQL = UTILIZATION_RENTAL_STARTED_SQL
+    UTILIZATION_RENTAL_FINISHED_SQL = UTILIZATION_RENTAL_FINISHED_SQL
+    ARCHIVE_TABLE_SQL = ARCHIVE_TABLE_SQL
+    ARCHIVING_START_SQL = "INSERT INTO arquivamento (em_andamento) VALUES (1)"
+    ARCHIVING_END_SQL = "DELETE FROM arquivamento"
+
+    @contextmanager
+    def connection(self):
+        conn = get_db_connection()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """Transação de escrita. No SQLite, BEGIN IMMEDIATE obtém a trava de escrita antes das
+        verificações, então nenhuma outra conexão grava entre a checagem e o INSERT; no
+        PostgreSQL as linhas verificadas são travadas com LOCK_ROWS."""
+        with self.connection() as conn:
+            if self.BEGIN_WRITE:
+                conn.execute(self.BEGIN_WRITE)
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    def _one(self, sql, params=()):
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def _all(self, sql, params=()):
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def _write(self, sql, params=()):
+        with self.connection() as conn:
+            try:
+                rowcount = conn.execute(sql, params).rowcount
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+        return rowcount
+
+    def _page(self, query, params, keyset, page):
+        query, extra_params = keyset_query(query, keyset, page.posicao, page.para_tras)
+        return self._all(query, list(params) + extra_params + [page.limite])
+
+    SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+    def schema_version(self):
+        return self._one("PRAGMA user_version")[0]
+
+    def init_schema(self):
+        with self.connection() as conn:
+            create_schema(conn)
+
+    # Usuários e empresas
+    def user_by_login(self, login):
+        return self._one(USER_BY_LOGIN_QUERY, (login,))
+
+    def user(self, user_id):
+        return self._one(USER_QUERY, (user_id,))
+
+    def users(self, empresa):
+        return self._all(TENANT_USERS_QUERY, (empresa,))
+
+    def user_context(self, user_id):
+        return self._one(USER_CONTEXT_QUERY, (user_id,))
+
+    def create_user(self, login, senha_hash, role, empresa):
+        self._write("INSERT INTO usuarios (login, senha, role, empresa) VALUES (?, ?, ?, ?)",
+                    (login, senha_hash, role, empresa))
+
+    def update_user(self, user_id, **campos):
+        assignments = ', '.join(f"{nome} = ?" for nome in campos)
+        self._write(f"UPDATE usuarios SET {assignments} WHERE id = ?", list(campos.values()) + [user_id])
+
+    def delete_user(self, user_id):
+        self._write("DELETE FROM usuarios WHERE id = ?", (user_id,))
+
+    def company_names(self):
+        return self._all(COMPANIES_QUERY)
+
+    def companies(self):
+        return self._all(ALL_COMPANIES_QUERY)
+
+    def create_company(self, cnpj, razao_social, inscricao_estadual, local, numero, telefone, email):
+        self._write("INSERT INTO empresas (cnpj, razao_social, inscricao_estadual, local, numero, telefone, email) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (cnpj, razao_social, inscricao_estadual, local, numero, telefone, email))
+
+    # Veículos
+    def vehicle(self, vehicle_id):
+        return self._one(VEHICLE_QUERY, (vehicle_id,))
+
+    def has_active_rental(self, vehicle_id):
+        return self._one(ACTIVE_RENTAL_COUNT_QUERY, (vehicle_id,))[0] > 0
+
+    def add_vehicle(self, frota, placa, eixos, piso, tipo_carreta, comprimento, documento, empresa):
+        self._write(INSERT_VEHICLE_SQL,
+                    (frota, placa.strip().upper(), eixos, piso, tipo_carreta, comprimento, documento, empresa))
+
+    def update_vehicle(self, vehicle_id, frota, placa, eixos, piso, tipo_carreta, comprimento, documento):
+        self._write('''
+            UPDATE veiculos
+            SET frota = ?, placa = ?, eixos = ?, piso = ?, tipo_carreta = ?, comprimento = ?, documento = ?,
+                hash_importacao = NULL
+            WHERE id = ?
+        ''', (frota, placa.strip().upper(), eixos, piso, tipo_carreta, comprimento, documento, vehicle_id))
+
+    def delete_vehicle(self, vehicle_id):
+        with self.transaction() as conn:
+            self._utilization_delta(conn, vehicle_id, -1)
+            conn.execute("DELETE FROM utilizacao_veiculos WHERE veiculo_id = ?", (vehicle_id,))
+            conn.execute("DELETE FROM veiculos WHERE id = ?", (vehicle_id,))
+
+    def existing_placas(self):
+        """Placas cadastradas, em maiúsculas como as da importação."""
+        with self.connection() as conn:
+            return {row[0] for row in conn.execute("SELECT UPPER(placa) FROM veiculos")}
+
+    def insert_vehicles(self, records):
+        """Grava um lote da importação numa transação."""
+        with self.connection() as conn:
+            conn.executemany(INSERT_VEHICLE_SQL, records)
+            conn.commit()
+
+    def import_sync_state(self, empresa):
+        """Placa em maiúsculas -> (hash da importação, marcado como ausente, placa gravada) dos
+        veículos da empresa."""
+        with self.connection() as conn:
+            return {row[0]: (row[1], row[2] is not None, row[3])
+                    for row in conn.execute(IMPORT_SYNC_STATE_QUERY, (empresa,))}
+
+    def upsert_vehicles(self, records):
+        """Grava um lote da sincronização numa transação: placas novas são inseridas e as da
+        mesma empresa, atualizadas."""
+        with self.connection() as conn:
+            conn.executemany(UPSERT_VEHICLE_SQL, records)
+            conn.commit()
+
+    def mark_import_absence(self, empresa, placas, ausente_desde):
+        """Marca (ou desmarca, com ausente_desde None) os veículos ausentes da planilha."""
+        with self.connection() as conn:
+            conn.executemany("UPDATE veiculos SET ausente_importacao = ? WHERE empresa = ? AND placa = ?",
+                             [(ausente_desde, empresa, placa) for placa in placas])
+            conn.commit()
+
+    def tenant_vehicles(self, empresa, ids):
+        marks = ', '.join('?' * len(ids))
+        return self._all(f"SELECT id, frota, placa FROM veiculos WHERE empresa = ? AND id IN ({marks}) "
+                         f"ORDER BY frota", [empresa] + ids)
+
+    def _vehicles_query(self, empresa, placa_search):
+        termo = normalize_placa(placa_search)
+        if len(termo) >= SEARCH_MIN_CHARS:
+            return VEHICLES_SEARCH_QUERY, [fts_match(['placa'], termo), empresa]
+        if placa_search:
+            return VEHICLES_QUERY + PLACA_FILTER, [empresa, '%' + placa_search + '%']
+        return VEHICLES_QUERY, [empresa]
+
+    def vehicles_page(self, empresa, placa_search, page):
+        query, params = self._vehicles_query(empresa, placa_search)
+        return self._page(query, params, VEHICLES_KEYSET, page)
+
+    def _typeahead_query(self, empresa, termo):
+        return TYPEAHEAD_SEARCH_QUERY, (fts_match(['placa', 'frota'], termo), empresa, TYPEAHEAD_LIMIT)
+
+    def vehicle_suggestions(self, empresa, termo):
+        if len(termo) >= SEARCH_MIN_CHARS:
+            return self._all(*self._typeahead_query(empresa, termo))
+        # Frotas curtas: prefixo pelo índice (empresa, frota)
+        return self._all(TYPEAHEAD_FROTA_PREFIX_QUERY, (empresa, termo, termo + '\uffff', TYPEAHEAD_LIMIT))
+
+    # Aluguéis
+    def rent_vehicle(self, vehicle_id, possuidor, local, data_locacao):
+        with self.transaction() as conn:
+            conn.execute(INSERT_RENTAL_SQL, (possuidor, local, data_locacao, vehicle_id))
+            self._record_rental_started(conn, vehicle_id, data_locacao)
+
+    def rent_vehicles(self, empresa, ids, possuidor, local, data_locacao):
+        """Aluga todos os veículos ou nenhum; devolve os ids recusados (fora da empresa ou já alugados)."""
+        marks = ', '.join('?' * len(ids))
+        with self.transaction() as conn:
+            encontrados = {r['id'] for r in conn.execute(
+                TENANT_VEHICLES_IN_QUERY.format(marks) + self.LOCK_ROWS, [empresa] + ids)}
+            alugados = {r['veiculo_id'] for r in conn.execute(ACTIVE_RENTALS_IN_QUERY.format(marks), ids)}
+            recusados = [i for i in ids if i not in encontrados or i in alugados]
+            if not recusados:
+                conn.executemany(INSERT_RENTAL_SQL, [(possuidor, local, data_locacao, i) for i in ids])
+                for vehicle_id in ids:
+                    self._record_rental_started(conn, vehicle_id, data_locacao)
+        return recusados
+
+    def finish_rental(self, rental_id, data_devolucao):
+        with self.transaction() as conn:
+            rental = conn.execute(ACTIVE_RENTAL_QUERY + self.LOCK_ROWS, (rental_id,)).fetchone()
+            # Um aluguel já finalizado não é contado de novo
+            if rental:
+                conn.execute(FINISH_RENTAL_SQL, (data_devolucao, rental_id))
+                self._record_rental_finished(conn, rental['veiculo_id'], rental['data_locacao'], data_devolucao)
+
+    def finish_rentals(self, empresa, ids, data_devolucao):
+        """Finaliza os aluguéis ativos da empresa entre os ids; devolve os ids finalizados."""
+        marks = ', '.join('?' * len(ids))
+        with self.transaction() as conn:
+            rentals = conn.execute(TENANT_ACTIVE_RENTALS_IN_QUERY.format(marks) + self.LOCK_ROWS,
+                                   ids + [empresa]).fetchall()
+            conn.executemany(FINISH_RENTAL_SQL, [(data_devolucao, r['id']) for r in rentals])
+            for rental in rentals:
+                self._record_rental_finished(conn, rental['veiculo_id'], rental['data_locacao'], data_devolucao)
+        return [r['id'] for r in rentals]
+
+    def _rentals_query(self, empresa, placa_search, possuidor_search):
+        placa_termo = normalize_placa(placa_search)
+        possuidor_termo = possuidor_search.strip()
+        # A consulta parte do índice mais seletivo disponível; os demais filtros entram no WHERE
+        if len(placa_termo) >= SEARCH_MIN_CHARS:
+            query, params = RENTALS_PLACA_SEARCH_QUERY, [fts_match(['placa'], placa_termo), empresa]
+        elif len(possuidor_termo) >= SEARCH_MIN_CHARS:
+            query, params = RENTALS_POSSUIDOR_SEARCH_QUERY, [fts_match(['possuidor'], possuidor_termo), empresa]
+        else:
+            query, params = RENTALS_QUERY, [empresa]
+        if placa_search and len(placa_termo) < SEARCH_MIN_CHARS:
+            query += PLACA_FILTER
+            params.append('%' + placa_search + '%')
+        if len(possuidor_termo) >= SEARCH_MIN_CHARS and len(placa_termo) >= SEARCH_MIN_CHARS:
+            query += RENTALS_POSSUIDOR_SEARCH_FILTER
+            params.append(fts_match(['possuidor'], possuidor_termo))
+        elif possuidor_search and len(possuidor_termo) < SEARCH_MIN_CHARS:
+            query += RENTALS_POSSUIDOR_FILTER
+            params.append('%' + possuidor_search + '%')
+        return query, params
+
+    def rentals_page(self, empresa, placa_search, possuidor_search, page):
+        query, params = self._rentals_query(empresa, placa_search, possuidor_search)
+        return self._page(query, params, RENTALS_KEYSET, page)
+
+    def history_page(self, empresa, data_inicial, data_final, page):
+        """Histórico da tabela de aluguéis e dos arquivos do período, cada um lido pelo próprio índice."""
+        if data_inicial and data_final:
+            filtro, params = HISTORY_PERIOD_FILTER, [empresa, data_inicial, data_final]
+        else:
+            filtro, params = '', [empresa]
+        partes = [self._page(HISTORY_QUERY + filtro, params, HISTORY_KEYSET, page)]
+        for tabela in self._archive_tables(data_inicial, data_final):
+            partes.append(self._page(ARCHIVE_HISTORY_QUERY.format(tabela=tabela) + filtro, params,
+                                     HISTORY_KEYSET, page))
+        return merge_pages(partes, HISTORY_KEYSET, page)
+
+    # Utilização da frota
+    def _utilization_delta(self, conn, vehicle_id, sign):
+        conn.execute(self.UTILIZATION_TENANT_DELTA_SQL, {'s': sign, 'id': vehicle_id})
+
+    def _record_rental_started(self, conn, vehicle_id, data_locacao):
+        self._utilization_delta(conn, vehicle_id, -1)
+        conn.execute(self.UTILIZATION_RENTAL_STARTED_SQL, {'id': vehicle_id, 'data': data_locacao})
+        self._utilization_delta(conn, vehicle_id, 1)
+
+    def _record_rental_finished(self, conn, vehicle_id, data_locacao, data_devolucao):
+        self._utilization_delta(conn, vehicle_id, -1)
+        conn.execute(self.UTILIZATION_RENTAL_FINISHED_SQL, (data_devolucao, data_locacao, vehicle_id))
+        self._utilization_delta(conn, vehicle_id, 1)
+
+    def utilization_summary(self, empresa):
+        return self._one(self.UTILIZATION_TENANT_QUERY, (empresa,))
+
+    def utilization_page(self, empresa, page):
+        return self._page(self.UTILIZATION_VEHICLES_QUERY, [empresa], VEHICLES_KEYSET, page)
+
+    def rebuild_utilization(self):
+        # Os aluguéis já arquivados continuam contando nos totais
+        fontes = ' UNION ALL '.join(f"SELECT veiculo_id, data_locacao, data_devolucao, status FROM {tabela}"
+                                    for tabela in ['alugueis'] + self._archive_tables())
+        with self.transaction() as conn:
+            for comando in self.UTILIZATION_REBUILD:
+                conn.execute(comando.replace('FROM alugueis a', f'FROM ({fontes}) a'))
+
+    # Contagens da frota
+    def fleet_counts(self, empresa):
+        return self._all(FLEET_COUNTS_QUERY, (empresa,))
+
+    def fleet_counter_differences(self):
+        """Contagens gravadas que não batem com a recontagem: [(chave, gravado, recontado)]."""
+        with self.connection() as conn:
+            gravadas = {(r['empresa'], r['dimensao'], r['valor']): (r['veiculos'], r['alugados'])
+                        for r in conn.execute("SELECT * FROM contagem_frota WHERE veiculos <> 0 OR alugados <> 0")}
+            recontadas = {(r['empresa'], r['dimensao'], r['valor']): (r['veiculos'], r['alugados'])
+                          for r in conn.execute(FLEET_COUNTER_RECOUNT_QUERY)}
+        return [(chave, gravadas.get(chave, (0, 0)), recontadas.get(chave, (0, 0)))
+                for chave in sorted(gravadas.keys() | recontadas.keys())
+                if gravadas.get(chave, (0, 0)) != recontadas.get(chave, (0, 0))]
+
+    def rebuild_fleet_counters(self):
+        with self.transaction() as conn:
+            for comando in FLEET_COUNTER_REBUILD:
+                conn.execute(comando)
+
+    # Arquivo de aluguéis finalizados
+    def rental_archives(self):
+        return self._all("SELECT ano, tabela FROM arquivos_alugueis ORDER BY ano DESC")
+
+    def _archive_tables(self, data_inicial='', data_final=''):
+        """Tabelas de arquivo que podem ter devoluções no período (todas, sem período)."""
+        arquivos = self.rental_archives()
+        if data_inicial and data_final:
+            try:
+                inicio, fim = int(data_inicial[:4]), int(data_final[:4])
+            except ValueError:
+                pass
+            else:
+                arquivos = [a for a in arquivos if inicio <= a['ano'] <= fim]
+        return [a['tabela'] for a in arquivos]
+
+    def archive_rentals(self, antes_de):
+        """Move os aluguéis finalizados com devolução anterior a `antes_de` para a tabela de arquivo
+        do ano da devolução; cada lote é uma transação curta. Devolve quantos foram movidos."""
+        movidos = 0
+        while True:
+            with self.transaction() as conn:
+                lote = conn.execute(ARCHIVE_CANDIDATES_QUERY, (antes_de, ARCHIVE_BATCH_SIZE)).fetchall()
+                if not lote:
+                    break
+                por_ano = {}
+                for row in lote:
+                    por_ano.setdefault(int(row['data_devolucao'][:4]), []).append(row['id'])
+                conn.execute(self.ARCHIVING_START_SQL)
+                for ano, ids in por_ano.items():
+                    tabela = ARCHIVE_TABLE.format(ano=ano)
+                    for comando in self.ARCHIVE_TABLE_SQL:
+                        conn.execute(comando.format(tabela=tabela))
+                    conn.execute("INSERT INTO arquivos_alugueis (ano, tabela) VALUES (?, ?) "
+                                 "ON CONFLICT (ano) DO NOTHING", (ano, tabela))
+                    marks = ', '.join('?' * len(ids))
+                    conn.execute(ARCHIVE_INSERT_SQL.format(tabela=tabela, ids=marks), ids)
+                    conn.execute(f"DELETE FROM alugueis WHERE id IN ({marks})", ids)
+                conn.execute(self.ARCHIVING_END_SQL)
+            movidos += len(lote)
+        return movidos
+
+    # API
+    def tenant_version(self, empresa):
+        return self._one(TENANT_VERSION_QUERY, (empresa,))
+
+    def shared_data_version(self):
+        return self._one(SHARED_DATA_VERSION_QUERY)[0]
+
+    def api_token_empresa(self, token_hash):
+        token = self._one(API_TOKEN_QUERY, (token_hash,))
+        return token['empresa'] if token else None
+
+    def create_api_token(self, token_hash, empresa, descricao, criado_em):
+        self._write("INSERT INTO api_tokens (token_hash, empresa, descricao, criado_em) VALUES (?, ?, ?, ?)",
+                    (token_hash, empresa, descricao, criado_em))
+
+    def revoke_api_token(self, token_hash):
+        return self._write("DELETE FROM api_tokens WHERE token_hash = ?", (token_hash,))
+
+    # Sessões
+    def load_session(self, key):
+        return self._one(SESSION_LOAD_QUERY, (key,))
+
+    def save_session(self, key, usuario_id, dados, expira_em):
+        self._write('''
+            INSERT INTO sessoes (id, usuario_id, dados, expira_em) VALUES (?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                usuario_id = excluded.usuario_id, dados = excluded.dados, expira_em = excluded.expira_em
+        ''', (key, usuario_id, dados, expira_em))
+
+    def delete_session(self, key):
+        self._write(SESSION_DELETE_SQL, (key,))
+
+    def revoke_sessions(self, usuario_id):
+        self._write(USER_SESSIONS_DELETE_SQL, (usuario_id,))
+
+    def sweep_sessions(self, agora):
+        self._write(EXPIRED_SESSIONS_DELETE_SQL, (agora,))
+
+    # Tarefas em segundo plano
+    def create_job(self, job_id, tipo, empresa, criado_em, remover_antes_de):
+        with self.connection() as conn:
+            conn.execute("DELETE FROM tarefas WHERE criado_em < ?", (remover_antes_de,))
+            conn.execute("INSERT INTO tarefas (id, tipo, empresa, status, criado_em, atualizado_em) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", (job_id, tipo, empresa, 'Pendente', criado_em, criado_em))
+            conn.commit()
+
+    def update_job(self, job_id, **fields):
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        self._write(f"UPDATE tarefas SET {assignments} WHERE id = ?", list(fields.values()) + [job_id])
+
+    def fail_stale_jobs(self, atualizado_antes_de, mensagem, agora):
+        return self._write("UPDATE tarefas SET status = 'Erro', mensagem = ?, atualizado_em = ? "
+                           "WHERE status IN ('Pendente', 'Executando') AND atualizado_em < ?",
+                           (mensagem, agora, atualizado_antes_de))
+
+    def tenant_job(self, job_id, empresa):
+        return self._one("SELECT * FROM tarefas WHERE id = ? AND empresa = ?", (job_id, empresa))
+
+    # Exportações
+    def _export_cursor(self, conn):
+        return conn.cursor()
+
+    def _stream(self, query, params):
+        """Percorre o resultado em lotes, sem carregar tudo na memória."""
+        with self.connection() as conn:
+            cursor = self._export_cursor(conn)
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                yield from rows
+
+    def iter_export(self, tipo, empresa):
+        query, _ = EXPORTS[tipo]
+        consultas = [query]
+        # Depois da tabela de aluguéis vêm os arquivos, do ano mais recente para o mais antigo
+        if tipo in ARCHIVE_EXPORTS:
+            consultas += [ARCHIVE_EXPORTS[tipo].format(tabela=tabela) for tabela in self._archive_tables()]
+        for consulta in consultas:
+            for row in self._stream(consulta, (empresa,)):
+                yield tuple(row)
+
+    # Log de alterações
+    def iter_changes(self, empresa, desde, limite):
+        return self._stream(CHANGES_QUERY, (empresa, desde, limite))
+
+class PostgresRepository(SQLiteRepository):
+    BEGIN_WRITE = None  # a transação começa no primeiro comando
+    LOCK_ROWS = " FOR UPDATE"  # as linhas verificadas ficam travadas até o commit
+    RENTALS_COLUMNS = POSTGRES_RENTALS_COLUMNS
+    UTILIZATION_TENANT_QUERY = POSTGRES_UTILIZATION_TENANT_QUERY
+    UTILIZATION_VEHICLES_QUERY = POSTGRES_UTILIZATION_VEHICLES_QUERY
+    UTILIZATION_REBUILD = POSTGRES_UTILIZATION_REBUILD
+    UTILIZATION_TENANT_DELTA_SQL = POSTGRES_UTILIZATION_TENANT_DELTA_SQL
+    UTILIZATION_RENTAL_STARTED_SQL = POSTGRES_UTILIZATION_RENTAL_STARTED_SQL
+    UTILIZATION_RENTAL_FINISHED_SQL = POSTGRES_UTILIZATION_RENTAL_FINISHED_SQL
+    ARCHIVE_TABLE_SQL = POSTGRES_ARCHIVE_TABLE_SQL
+    ARCHIVING_START_SQL = f"SELECT set_config('{POSTGRES_ARCHIVING_SETTING}', 'on', true)"
+    ARCHIVING_END_SQL = f"SELECT set_config('{POSTGRES_ARCHIVING_SETTING}', 'off', true)"
+
+    def __init__(self):
+        self.IntegrityError = psycopg2.IntegrityError
+        self.Error = psycopg2.Error
+
+    SCHEMA_VERSION = POSTGRES_SCHEMA_MIGRATIONS[-1][0]
+
+    def schema_version(self):
+        if self._one("SELECT to_regclass('versao_esquema')")[0] is None:
+            return 0
+        return self._one("SELECT COALESCE(MAX(versao), 0) FROM versao_esquema")[0]
+
+    def init_schema(self):
+        with self.connection() as conn:
+            migrate_postgres(conn)
+
+    def _placa_filter(self, placa_search):
+        termo = normalize_placa(placa_search)
+        if termo:
+            return POSTGRES_PLACA_SEARCH_FILTER, [like_contains(termo)]
+        if placa_search:
+            return POSTGRES_PLACA_FILTER, [like_contains(placa_search)]
+        return '', []
+
+    def _vehicles_query(self, empresa, placa_search):
+        filtro, params = self._placa_filter(placa_search)
+        return VEHICLES_QUERY + filtro, [empresa] + params
+
+    def _typeahead_query(self, empresa, termo):
+        padrao = like_contains(termo)
+        return POSTGRES_TYPEAHEAD_SEARCH_QUERY, (empresa, padrao, padrao, TYPEAHEAD_LIMIT)
+
+    def _rentals_query(self, empresa, placa_search, possuidor_search):
+        filtro, params = self._placa_filter(placa_search)
+        query, params = self.RENTALS_COLUMNS + RENTALS_FROM + filtro, [empresa] + params
+        possuidor = possuidor_search.strip() or possuidor_search
+        if possuidor:
+            query += POSTGRES_POSSUIDOR_FILTER
+            params.append(like_contains(possuidor))
+        return query, params
+
+    def _export_cursor(self, conn):
+        # Cursor no servidor: as linhas chegam em lotes em vez de todas de uma vez
+        return conn.cursor(f"exportacao_{uuid.uuid4().hex}")
 
-init_db()
+repository = PostgresRepository() if DB_BACKEND == 'postgres' else SQLiteRepository()
+
+# ---------------------- Sessões no Servidor ----------------------
+# O cookie leva só um id aleatório; os dados (usuário, empresa, mensagens flash) ficam no
+# servidor. Ao abrir a sessão o usuário é carregado uma vez em g.user, junto com os dados
+# da sessão; se o papel ou a empresa mudaram desde o login a sessão deixa de valer.
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'database')  # 'database' (tabela sessoes) ou 'memory'
+SESSION_LIFETIME_S = int(os.environ.get('SESSION_LIFETIME_S', 12 * 3600))  # expira após inatividade
+SESSION_SWEEP_INTERVAL_S = 300
+SESSION_LOAD_QUERY = '''
+    SELECT s.dados, s.expira_em, u.id AS usuario_id, u.login, u.role, u.empresa
+    FROM sessoes s
+    LEFT JOIN usuarios u ON u.id = s.usuario_id
+    WHERE s.id = ?
+'''
+USER_CONTEXT_QUERY = "SELECT id AS usuario_id, login, role, empresa FROM usuarios WHERE id = ?"
+SESSION_DELETE_SQL = "DELETE FROM sessoes WHERE id = ?"
+USER_SESSIONS_DELETE_SQL = "DELETE FROM sessoes WHERE usuario_id = ?"
+EXPIRED_SESSIONS_DELETE_SQL = "DELETE FROM sessoes WHERE expira_em < ?"
+
+def _user_context(row):
+    if row is None or row['usuario_id'] is None:
+        return None
+    return {'id': row['usuario_id'], 'login': row['login'], 'role': row['role'], 'empresa': row['empresa']}
+
+class DatabaseSessionStore:
+    """Sessões na tabela sessoes, compartilhadas entre os workers (e servidores, no PostgreSQL)."""
+
+    def load(self, key):
+        row = repository.load_session(key)
+        if row is None:
+            return None
+        return json.loads(row['dados']), row['expira_em'], _user_context(row)
+
+    def save(self, key, dados, usuario_id, expira_em):
+        repository.save_session(key, usuario_id, json.dumps(dados), expira_em)
+
+    def delete(self, key):
+        repository.delete_session(key)
+
+    def revoke_user(self, usuario_id):
+        repository.revoke_sessions(usuario_id)
+
+    def sweep(self, agora):
+        repository.sweep_sessions(agora)
+
+class MemorySessionStore:
+    """Sessões em memória, por processo (um único worker ou desenvolvimento)."""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def load(self, key):
+        with self._lock:
+            entry = self._sessions.get(key)
+        if entry is None:
+            return None
+        dados, usuario_id, expira_em = entry
+        user = None
+        if usuario_id is not None:
+            user = _user_context(repository.user_context(usuario_id))
+        return dict(dados), expira_em, user
+
+    def save(self, key, dados, usuario_id, expira_em):
+        with self._lock:
+            self._sessions[key] = (dados, usuario_id, expira_em)
+
+    def delete(self, key):
+        with self._lock:
+            self._sessions.pop(key, None)
+
+    def revoke_user(self, usuario_id):
+        with self._lock:
+            for key in [k for k, entry in self._sessions.items() if entry[1] == usuario_id]:
+                del self._sessions[key]
+
+    def sweep(self, agora):
+        with self._lock:
+            for key in [k for k, entry in self._sessions.items() if entry[2] < agora]:
+                del self._sessions[key]
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expira_em=0):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expira_em = expira_em
+        self.modified = False
+        self.previous_sid = None
+
+    def regenerate(self):
+        """Troca o id da sessão (no login), para que um id obtido antes não passe a valer."""
+        if self.sid:
+            self.previous_sid = self.sid
+        self.sid = None
+        self.modified = True
+
+def session_key(sid):
+    return hashlib.sha256(sid.encode()).hexdigest()
+
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store):
+        self.store = store
+        self._last_sweep = 0
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            loaded = self.store.load(session_key(sid))
+            if loaded:
+                dados, expira_em, user = loaded
+                logado = dados.get('user_id') is not None
+                valida = expira_em > time.time() and (
+                    not logado or (user is not None and user['role'] == dados.get('role')
+                                   and user['empresa'] == dados.get('empresa')))
+                if valida:
+                    g.user = user if logado else None
+                    return ServerSession(dados, sid, expira_em)
+                self.store.delete(session_key(sid))
+        g.user = None
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.previous_sid:
+            self.store.delete(session_key(session.previous_sid))
+            session.previous_sid = None
+        if not session:
+            if session.sid:
+                self.store.delete(session_key(session.sid))
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        agora = time.time()
+        # Sem alteração, a validade só é estendida quando já passou da metade
+        if not session.modified and session.expira_em - agora > SESSION_LIFETIME_S / 2:
+            return
+        novo = session.sid is None
+        if novo:
+            session.sid = secrets.token_urlsafe(32)
+        session.expira_em = agora + SESSION_LIFETIME_S
+        self.store.save(session_key(session.sid), dict(session), session.get('user_id'), session.expira_em)
+        if novo:
+            response.set_cookie(name, session.sid, domain=domain, path=path,
+                                httponly=self.get_cookie_httponly(app), secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
+        if agora - self._last_sweep > SESSION_SWEEP_INTERVAL_S:
+            self._last_sweep = agora
+            self.store.sweep(agora)
+
+    def revoke_user(self, usuario_id):
+        self.store.revoke_user(usuario_id)
+
+app.session_interface = ServerSessionInterface(MemorySessionStore() if SESSION_BACKEND == 'memory'
+                                               else DatabaseSessionStore())
+
+# ---------------------- Templates, Arquivos Estáticos e Compressão ----------------------
+# Templates compilados ficam num cache de bytecode em disco (preenchido por
+# "flask precompile-templates" no deploy); arquivos em static/ recebem ?v=<hash do conteúdo>
+# e cache de um ano; respostas de texto acima de COMPRESS_MIN_BYTES saem com gzip/brotli.
+JINJA_CACHE_DIR = os.environ.get('JINJA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'carretas_jinja'))
+STATIC_MAX_AGE_S = 365 * 24 * 3600
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+COMPRESS_LEVEL = 6
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/x-ndjson', 'application/javascript')
+STREAM_CHUNK_BYTES = 8192
+
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
+def precompile_templates():
+    nomes = app.jinja_env.list_templates(extensions=['html'])
+    for nome in nomes:
+        app.jinja_env.get_template(nome)
+    return len(nomes)
+
+_asset_fingerprints = {}
+
+def asset_fingerprint(filename):
+    path = os.path.join(app.static_folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    cached = _asset_fingerprints.get(filename)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            cached = (mtime, hashlib.sha256(f.read()).hexdigest()[:12])
+        _asset_fingerprints[filename] = cached
+    return cached[1]
+
+@app.url_defaults
+def add_asset_fingerprint(endpoint, values):
+    if endpoint == 'static' and 'v' not in values:
+        fingerprint = asset_fingerprint(values.get('filename', ''))
+        if fingerprint:
+            values['v'] = fingerprint
+
+def _accepted_encoding():
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def _compress_stream(chunks, encoding):
+    """Comprime cada parte assim que chega, com flush, para o navegador já ir exibindo a página."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=5)
+        compress, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)  # 31 = formato gzip
+        compress, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+    try:
+        for chunk in chunks:
+            data = compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+@app.after_request
+def static_and_compression(response):
+    if request.endpoint == 'static' and request.args.get('v'):
+        # A URL muda quando o conteúdo muda, então o navegador pode guardar por um ano
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE_S
+        response.cache_control.immutable = True
+    if (request.method == 'HEAD' or response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or not (response.mimetype or '').startswith(COMPRESSIBLE_TYPES)):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = _accepted_encoding()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return response
+        if encoding == 'br':
+            response.set_data(brotli.compress(data, quality=5))
+        else:
+            response.set_data(zlib.compress(data, COMPRESS_LEVEL, wbits=31))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def _buffered(chunks):
+    buffer, tamanho = [], 0
+    try:
+        for chunk in chunks:
+            buffer.append(chunk)
+            tamanho += len(chunk)
+            if tamanho >= STREAM_CHUNK_BYTES:
+                yield ''.join(buffer)
+                buffer, tamanho = [], 0
+        if buffer:
+            yield ''.join(buffer)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+def render_list_page(template_name, **context):
+    """Renderiza em partes (stream_template): o cabeçalho da página sai antes das linhas da tabela."""
+    # A sessão é salva antes do corpo ser gerado; as mensagens flash precisam ser lidas agora
+    get_flashed_messages(with_categories=True)
+    return Response(_buffered(stream_template(template_name, **context)), mimetype='text/html')
 
 # ---------------------- Decorators ----------------------
 def login_required(f):
     def wrapper(*args, **kwargs):
-        if 'user_id' not in session:
+        if g.get('user') is None:
             flash("Você precisa fazer login.", "danger")
             return redirect(url_for('login'))
         return f(*args, **kwargs)
@@ -91,25 +2574,126 @@ def login_required(f):
 
 def admin_required(f):
     def wrapper(*args, **kwargs):
-        if 'role' not in session or session['role'] != 'admin':
+        if g.get('user') is None or g.user['role'] != 'admin':
             flash("Acesso restrito a administradores.", "danger")
             return redirect(url_for('index'))
         return f(*args, **kwargs)
     wrapper.__name__ = f.__name__
     return wrapper
 
+# ---------------------- Verificação de Senha e Limite de Tentativas ----------------------
+# A verificação do hash (scrypt/pbkdf2, que liberam o GIL) roda num pool limitado de threads;
+# com a fila cheia o login responde 503 em vez de empilhar trabalho de CPU no worker.
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', os.cpu_count() or 2))
+HASH_MAX_PENDING = int(os.environ.get('HASH_MAX_PENDING', HASH_WORKERS * 4))
+# Tentativas por minuto (0 desativa); baldes em memória, por processo
+LOGIN_RATE_PER_MIN_IP = float(os.environ.get('LOGIN_RATE_PER_MIN_IP', 60))
+LOGIN_RATE_PER_MIN_USER = float(os.environ.get('LOGIN_RATE_PER_MIN_USER', 10))
+LOGIN_BURST = int(os.environ.get('LOGIN_BURST', 10))
+# Quantos proxies (ex.: roteador do Heroku) acrescentam o IP do cliente ao X-Forwarded-For
+PROXY_COUNT = int(os.environ.get('PROXY_COUNT', 0))
+
+class PasswordVerifierBusy(Exception):
+    pass
+
+class PasswordVerifier:
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.recusadas = 0
+
+    def _get_executor(self):
+        with self._lock:
+            # Threads não sobrevivem ao fork dos workers do gunicorn
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='senha')
+                self._pid = os.getpid()
+            return self._executor
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.recusadas += 1
+            raise PasswordVerifierBusy()
+        try:
+            return self._get_executor().submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def verify(self, senha_hash, senha):
+        return self._run(check_password_hash, senha_hash, senha)
+
+    def hash(self, senha):
+        """Gera o hash no mesmo pool limitado (atualização do hash no login)."""
+        return self._run(hash_password, senha)
+
+password_verifier = PasswordVerifier(HASH_WORKERS, HASH_MAX_PENDING)
+# Login inexistente também paga uma verificação, para não revelar quais logins existem
+@functools.lru_cache(maxsize=1)
+def dummy_password_hash():
+    return hash_password(secrets.token_urlsafe(16))
+
+class TokenBucketLimiter:
+    """Balde de fichas por chave: `burst` tentativas imediatas, repostas a `rate_per_min`."""
+
+    def __init__(self, rate_per_min, burst, max_keys=10000):
+        self.rate = rate_per_min / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """Consome uma ficha; devolve 0 se permitido, senão os segundos até a próxima ficha."""
+        if self.rate <= 0:
+            return 0
+        agora = time.monotonic()
+        with self._lock:
+            fichas, ultimo = self._buckets.pop(key, (self.burst, agora))
+            fichas = min(self.burst, fichas + (agora - ultimo) * self.rate)
+            espera = 0 if fichas >= 1 else (1 - fichas) / self.rate
+            if not espera:
+                fichas -= 1
+            self._buckets[key] = (fichas, agora)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return espera
+
+login_ip_limiter = TokenBucketLimiter(LOGIN_RATE_PER_MIN_IP, LOGIN_BURST * 3)
+login_user_limiter = TokenBucketLimiter(LOGIN_RATE_PER_MIN_USER, LOGIN_BURST)
+
+def client_ip():
+    route = request.access_route
+    if PROXY_COUNT and len(route) >= PROXY_COUNT:
+        return route[-PROXY_COUNT]
+    return request.remote_addr
+
 # ---------------------- Rotas de Autenticação ----------------------
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         login_input = request.form['login']
         senha_input = request.form['senha']
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM usuarios WHERE login = ?", (login_input,))
-        user = cursor.fetchone()
-        conn.close()
-        if user and check_password_hash(user['senha'], senha_input):
+        espera = login_ip_limiter.take(client_ip()) or login_user_limiter.take(login_input.lower())
+        if espera:
+            flash(f"Muitas tentativas de login. Tente novamente em {int(espera) + 1} segundos.", "danger")
+            return render_template('login.html'), 429, {'Retry-After': str(int(espera) + 1)}
+        user = repository.user_by_login(login_input)
+        try:
+            senha_ok = password_verifier.verify(user['senha'] if user else dummy_password_hash(), senha_input)
+        except PasswordVerifierBusy:
+            flash("Servidor ocupado. Tente novamente em instantes.", "warning")
+            return render_template('login.html'), 503, {'Retry-After': '2'}
+        if user and senha_ok and password_needs_rehash(user['senha']):
+            try:
+                repository.update_user(user['id'], senha=password_verifier.hash(senha_input))
+            except PasswordVerifierBusy:
+                pass  # com o pool cheio o hash é atualizado num próximo login
+        if user and senha_ok:
+            session.regenerate()
             session['user_id'] = user['id']
             session['login'] = user['login']
             session['role'] = user['role']
@@ -133,61 +2717,269 @@ def logout():
 def index():
     placa_search = request.args.get('placa', '')
     empresa = session.get('empresa')
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    query = '''
-        SELECT v.*, COALESCE(a.status, 'Livre') as status
-        FROM veiculos v
-        LEFT JOIN alugueis a ON v.id = a.veiculo_id AND a.status = 'Ativo'
-        WHERE v.placa LIKE ? AND v.empresa = ?
-        ORDER BY v.frota
-    '''
-    cursor.execute(query, ('%' + placa_search + '%', empresa))
-    vehicles = cursor.fetchall()
-    conn.close()
-    return render_template('index.html', vehicles=vehicles, placa_search=placa_search)
+    cache_key = ('veiculos', placa_search, request.args.get('apos'), request.args.get('antes'), get_page_size())
+
+    def load_vehicles():
+        return fetch_page(lambda page: repository.vehicles_page(empresa, placa_search, page), VEHICLES_KEYSET)
+
+    vehicles, pagination = tenant_cache.get_or_load(empresa, cache_key, load_vehicles)
+    return render_list_page('index.html', vehicles=vehicles, placa_search=placa_search, pagination=pagination)
+
+@app.route('/busca/veiculos')
+@login_required
+def vehicle_typeahead():
+    """Sugestões de placa/frota para o campo de busca (JSON)."""
+    termo = normalize_placa(request.args.get('q', ''))
+    if not termo:
+        return jsonify([])
+    rows = repository.vehicle_suggestions(session.get('empresa'), termo)
+    return jsonify([{'id': r['id'], 'frota': r['frota'], 'placa': r['placa']} for r in rows])
+
+# ---------------------- Artefatos (relatórios e arquivos gerados) ----------------------
+# Com vários servidores (DB_BACKEND=postgres), ARTIFACT_DIR precisa estar num volume compartilhado
+ARTIFACT_DIR = os.environ.get('ARTIFACT_DIR', os.path.join(tempfile.gettempdir(), 'carretas_artefatos'))
+ARTIFACT_MAX_AGE_S = 24 * 3600
+
+def cleanup_artifacts():
+    limite = time.time() - ARTIFACT_MAX_AGE_S
+    for entry in os.scandir(ARTIFACT_DIR):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < limite:
+                os.remove(entry.path)
+        except OSError:
+            pass  # removido por outro worker
+
+def new_artifact_name(suffix):
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    cleanup_artifacts()
+    return uuid.uuid4().hex + suffix
+
+def artifact_path(name):
+    return os.path.join(ARTIFACT_DIR, os.path.basename(name))
+
+# ---------------------- Importação de Veículos ----------------------
+IMPORT_COLUMNS = ["Frota", "Placa", "Eixos", "Piso", "Tipo de Carreta", "Comprimento"]
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 10000))
+INSERT_VEHICLE_SQL = "INSERT INTO veiculos (frota, placa, eixos, piso, tipo_carreta, comprimento, documento, empresa) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+# Sincronização: a placa é única no sistema todo, mas só é atualizada se for da mesma empresa
+UPSERT_VEHICLE_SQL = '''
+    INSERT INTO veiculos (frota, placa, eixos, piso, tipo_carreta, comprimento, documento, empresa, hash_importacao)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (placa) DO UPDATE SET
+        frota = excluded.frota, eixos = excluded.eixos, piso = excluded.piso, tipo_carreta = excluded.tipo_carreta,
+        comprimento = excluded.comprimento, documento = excluded.documento,
+        hash_importacao = excluded.hash_importacao, ausente_importacao = NULL
+    WHERE veiculos.empresa = excluded.empresa
+'''
+# Chave em maiúsculas, como as placas da planilha; com duas placas que só diferem nas
+# maiúsculas, fica a que já está em maiúsculas (ordenada por último)
+IMPORT_SYNC_STATE_QUERY = '''
+    SELECT UPPER(placa), hash_importacao, ausente_importacao, placa FROM veiculos
+    WHERE empresa = ?
+    ORDER BY placa = UPPER(placa)
+'''
+
+def iter_excel_chunks(file, chunk_size):
+    import openpyxl
+    import pandas as pd
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    rows = workbook.active.iter_rows(values_only=True)
+    header = [str(c).strip() if c is not None else '' for c in next(rows, ())]
+    batch = []
+    start = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) == chunk_size:
+            yield pd.DataFrame(batch, columns=header, index=range(start, start + len(batch)))
+            start += len(batch)
+            batch = []
+    if batch or start == 0:
+        yield pd.DataFrame(batch, columns=header, index=range(start, start + len(batch)))
+    workbook.close()
+
+def read_import_chunks(file, filename, chunked):
+    """Lê a planilha como DataFrames; no modo em lotes, IMPORT_CHUNK_SIZE linhas por vez."""
+    # pandas só é carregado por quem importa planilhas (o worker de tarefas), não pelos workers web
+    import pandas as pd
+    if (filename or '').lower().endswith('.csv'):
+        if chunked:
+            yield from pd.read_csv(file, sep=None, engine='python', dtype=str, chunksize=IMPORT_CHUNK_SIZE)
+        else:
+            yield pd.read_csv(file, sep=None, engine='python', dtype=str)
+    elif chunked:
+        yield from iter_excel_chunks(file, IMPORT_CHUNK_SIZE)
+    else:
+        yield pd.read_excel(file, dtype=str)
+
+def _as_text(series):
+    text = series.astype('string').str.strip()
+    present = (text.notna() & (text != '')).fillna(False).astype(bool)
+    return text.astype(object).where(present, None)
+
+def validate_import_chunk(df, existing_placas, existing_reason='Placa já cadastrada', repeated_placas=()):
+    """Valida as linhas de uma vez; devolve as colunas normalizadas e o motivo de rejeição de cada linha ('' = ok)."""
+    import pandas as pd
+    placa = _as_text(df['Placa']).str.upper()
+    frota = _as_text(df['Frota'])
+    eixos = pd.to_numeric(df['Eixos'], errors='coerce')
+    comprimento_text = _as_text(df['Comprimento']).str.replace(',', '.', regex=False)
+    comprimento = pd.to_numeric(comprimento_text, errors='coerce')
+    reasons = pd.Series('', index=df.index, dtype=object)
+
+    def reject(mask, reason):
+        reasons[mask & (reasons == '')] = reason
+
+    reject(placa.isna(), 'Placa vazia')
+    reject(frota.isna(), 'Frota vazia')
+    reject(eixos.isna() | (eixos % 1 != 0), 'Eixos inválido')
+    reject(comprimento.isna() & comprimento_text.notna(), 'Comprimento inválido')
+    reject(placa.isin(existing_placas), existing_reason)
+    reject(placa.isin(repeated_placas), 'Placa repetida na planilha')
+    valid = reasons == ''
+    reject(placa.where(valid).duplicated(keep='first') & valid, 'Placa repetida na planilha')
+    documento = _as_text(df['Documento']).fillna('Não') if 'Documento' in df.columns else pd.Series('Não', index=df.index)
+    columns = {
+        'frota': frota,
+        'placa': placa,
+        'eixos': eixos,
+        'piso': _as_text(df['Piso']),
+        'tipo_carreta': _as_text(df['Tipo de Carreta']),
+        'comprimento': comprimento.astype(object).where(comprimento.notna(), None),
+        'documento': documento,
+    }
+    return columns, reasons
+
+def import_row_hash(record):
+    """Hash do conteúdo normalizado de uma linha da planilha, guardado em veiculos.hash_importacao."""
+    texto = '\x1f'.join('' if valor is None else str(valor) for valor in record)
+    return hashlib.blake2b(texto.encode(), digest_size=16).hexdigest()
+
+def import_vehicles(file, filename, empresa, chunked=False, progress=None, sync=False, mark_absent=False):
+    """Importa a planilha com executemany; linhas rejeitadas vão para um relatório CSV em ARTIFACT_DIR.
+
+    Cada lote é gravado numa transação própria, para não segurar a trava de escrita durante
+    o arquivo todo; sem o modo em lotes a planilha inteira é um único lote.
+
+    No modo de sincronização as placas já cadastradas na empresa são atualizadas, mas só as
+    linhas cujo hash mudou desde a última sincronização são gravadas; com mark_absent, os
+    veículos da empresa que não estão na planilha ficam marcados como ausentes.
+    """
+    if sync:
+        sync_state = repository.import_sync_state(empresa)
+        # Placas de outras empresas continuam rejeitadas
+        existing_placas = repository.existing_placas() - sync_state.keys()
+        existing_reason = 'Placa cadastrada em outra empresa'
+    else:
+        existing_placas = repository.existing_placas()
+        existing_reason = 'Placa já cadastrada'
+    seen_placas = set()
+    imported = 0
+    updated = 0
+    unchanged = 0
+    rejected = 0
+    report_name = None
+    report = None
+    try:
+        for chunk in read_import_chunks(file, filename, chunked):
+            if not set(IMPORT_COLUMNS).issubset(set(chunk.columns)):
+                raise ValueError("Arquivo Excel não possui todas as colunas necessárias!")
+            columns, reasons = validate_import_chunk(chunk, existing_placas, existing_reason,
+                                                     seen_placas if sync else ())
+            valid = reasons == ''
+            records = list(zip(
+                columns['frota'][valid].tolist(),
+                columns['placa'][valid].tolist(),
+                columns['eixos'][valid].astype(int).tolist(),
+                columns['piso'][valid].tolist(),
+                columns['tipo_carreta'][valid].tolist(),
+                columns['comprimento'][valid].tolist(),
+                columns['documento'][valid].tolist(),
+                [empresa] * int(valid.sum()),
+            ))
+            if sync:
+                changed = []
+                reappeared = []
+                for record in records:
+                    row_hash = import_row_hash(record[:7])
+                    stored_hash, absent, stored_placa = sync_state.get(record[1], (None, False, record[1]))
+                    if row_hash != stored_hash:
+                        # Atualiza a linha com a placa como está gravada (o ON CONFLICT compara exato)
+                        changed.append(record[:1] + (stored_placa,) + record[2:] + (row_hash,))
+                        updated += record[1] in sync_state
+                    elif absent:
+                        reappeared.append(stored_placa)
+                repository.upsert_vehicles(changed)
+                repository.mark_import_absence(empresa, reappeared, None)
+                # Linhas rejeitadas também contam como presentes na planilha
+                seen_placas.update(columns['placa'].dropna())
+                imported += len(changed)
+                unchanged += len(records) - len(changed)
+            else:
+                repository.insert_vehicles(records)
+                existing_placas.update(columns['placa'][valid])
+                imported += len(records)
+            if chunked and progress:
+                progress(imported + unchanged + rejected + int((~valid).sum()))
+            if not valid.all():
+                if report is None:
+                    report_name = new_artifact_name('.csv')
+                    report = open(artifact_path(report_name), 'w', newline='', encoding='utf-8-sig')
+                rejects = chunk[~valid].astype(object)
+                rejects.insert(0, 'Motivo', reasons[~valid])
+                # Número da linha no Excel: cabeçalho na linha 1
+                rejects.insert(0, 'Linha', chunk.index[~valid] + 2)
+                rejects.to_csv(report, sep=';', index=False, header=rejected == 0)
+                rejected += len(rejects)
+        absent_count = 0
+        if sync and mark_absent:
+            absent = [stored_placa for placa, (_, marked, stored_placa) in sync_state.items()
+                      if placa not in seen_placas and not marked]
+            repository.mark_import_absence(empresa, absent, datetime.now().strftime("%Y-%m-%d"))
+            absent_count = len(absent)
+        if progress:
+            progress(imported + unchanged + rejected)
+    finally:
+        if report is not None:
+            report.close()
+    return {'importadas': imported - updated, 'atualizadas': updated, 'inalteradas': unchanged,
+            'ausentes': absent_count, 'rejeitadas': rejected, 'relatorio': report_name}
 
 # ---------------------- Rotas de Veículos ----------------------
+def import_job(job_id, upload_name, filename, empresa, chunked, sync=False, mark_absent=False):
+    try:
+        with open(artifact_path(upload_name), 'rb') as file:
+            result = import_vehicles(file, filename, empresa, chunked,
+                                     progress=lambda linhas: update_job(job_id, progresso=linhas),
+                                     sync=sync, mark_absent=mark_absent)
+    finally:
+        os.remove(artifact_path(upload_name))
+    mensagem = f"{result['importadas']} veículos importados"
+    if sync:
+        mensagem += f"; {result['atualizadas']} atualizados; {result['inalteradas']} sem alteração"
+    if result['ausentes']:
+        mensagem += f"; {result['ausentes']} ausentes da planilha marcados"
+    if result['rejeitadas']:
+        mensagem += f"; {result['rejeitadas']} linhas rejeitadas"
+    return {'mensagem': mensagem + '.', 'artefato': result['relatorio'], 'nome_download': 'linhas_rejeitadas.csv'}
+
 @app.route('/import_excel', methods=['GET', 'POST'])
+@login_required
 def import_excel():
     if request.method == 'POST':
         file = request.files.get('excel_file')
         if not file:
             flash("Nenhum arquivo selecionado!", "danger")
             return redirect(url_for('import_excel'))
-        try:
-            df = pd.read_excel(file)
-            expected_columns = {"Frota", "Placa", "Eixos", "Piso", "Tipo de Carreta", "Comprimento"}
-            if not expected_columns.issubset(set(df.columns)):
-                flash("Arquivo Excel não possui todas as colunas necessárias!", "danger")
-                return redirect(url_for('import_excel'))
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            empresa = session.get('empresa') if 'empresa' in session else ''
-            for _, row in df.iterrows():
-                try:
-                    cursor.execute(
-                        "INSERT INTO veiculos (frota, placa, eixos, piso, tipo_carreta, comprimento, documento, empresa) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                        (
-                            row["Frota"],
-                            row["Placa"],
-                            int(row["Eixos"]),
-                            row["Piso"],
-                            row["Tipo de Carreta"],
-                            float(row["Comprimento"]),
-                            row.get("Documento", "Não"),
-                            empresa
-                        )
-                    )
-                except Exception as e:
-                    pass
-            conn.commit()
-            conn.close()
-            flash("Dados importados com sucesso!", "success")
-            return redirect(url_for('index'))
-        except Exception as e:
-            flash(f"Erro ao importar dados: {str(e)}", "danger")
-            return redirect(url_for('import_excel'))
+        empresa = session.get('empresa') if 'empresa' in session else ''
+        chunked = bool(request.form.get('modo_lotes'))
+        sync = bool(request.form.get('sincronizar'))
+        mark_absent = sync and bool(request.form.get('marcar_ausentes'))
+        # A planilha é processada por um worker de tarefas; a requisição só salva o arquivo
+        upload_name = new_artifact_name(os.path.splitext(file.filename or '')[1].lower())
+        file.save(artifact_path(upload_name))
+        job_id = submit_job('importacao', empresa, import_job, upload_name, file.filename, empresa, chunked,
+                            sync, mark_absent)
+        return redirect(url_for('job_page', job_id=job_id))
     return render_template('import_excel.html')
 
 @app.route('/add_vehicle', methods=['GET', 'POST'])
@@ -204,18 +2996,12 @@ def add_vehicle():
             flash('Frota e Placa são obrigatórios!', 'danger')
             return redirect(url_for('add_vehicle'))
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
             empresa = session.get('empresa')  # Atribui a empresa do usuário logado
-            cursor.execute(
-                "INSERT INTO veiculos (frota, placa, eixos, piso, tipo_carreta, comprimento, documento, empresa) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (frota, placa, int(eixos), piso, tipo_carreta, float(comprimento), documento, empresa)
-            )
-            conn.commit()
-            conn.close()
+            repository.add_vehicle(frota, placa, int(eixos), piso, tipo_carreta, float(comprimento), documento, empresa)
+            tenant_cache.invalidate(empresa)
             flash('Veículo cadastrado com sucesso!', 'success')
             return redirect(url_for('index'))
-        except sqlite3.IntegrityError:
+        except repository.IntegrityError:
             flash('Placa já cadastrada!', 'warning')
         except Exception as e:
             flash(f'Erro ao cadastrar veículo: {str(e)}', 'danger')
@@ -223,10 +3009,7 @@ def add_vehicle():
 
 @app.route('/edit_vehicle/<int:vehicle_id>', methods=['GET', 'POST'])
 def edit_vehicle(vehicle_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM veiculos WHERE id = ?", (vehicle_id,))
-    vehicle = cursor.fetchone()
+    vehicle = repository.vehicle(vehicle_id)
     if not vehicle:
         flash('Veículo não encontrado!', 'danger')
         return redirect(url_for('index'))
@@ -239,54 +3022,38 @@ def edit_vehicle(vehicle_id):
         comprimento = request.form['comprimento']
         documento = request.form.get('documento', 'Não')
         try:
-            cursor.execute('''
-                UPDATE veiculos 
-                SET frota = ?, placa = ?, eixos = ?, piso = ?, tipo_carreta = ?, comprimento = ?, documento = ?
-                WHERE id = ?
-            ''', (frota, placa, int(eixos), piso, tipo_carreta, float(comprimento), documento, vehicle_id))
-            conn.commit()
+            repository.update_vehicle(vehicle_id, frota, placa, int(eixos), piso, tipo_carreta, float(comprimento),
+                                      documento)
+            tenant_cache.invalidate(session.get('empresa'))
             flash('Veículo atualizado com sucesso!', 'success')
             return redirect(url_for('index'))
         except Exception as e:
             flash(f'Erro ao atualizar veículo: {str(e)}', 'danger')
-    conn.close()
     return render_template('edit_vehicle.html', vehicle=vehicle)
 
 @app.route('/delete_vehicle/<int:vehicle_id>', methods=['POST'])
 def delete_vehicle(vehicle_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM alugueis WHERE veiculo_id = ? AND status = 'Ativo'", (vehicle_id,))
-    if cursor.fetchone()[0] > 0:
+    if repository.has_active_rental(vehicle_id):
         flash('Não é possível excluir um veículo que está alugado!', 'danger')
-        conn.close()
         return redirect(url_for('index'))
     try:
-        cursor.execute("DELETE FROM veiculos WHERE id = ?", (vehicle_id,))
-        conn.commit()
+        repository.delete_vehicle(vehicle_id)
+        tenant_cache.invalidate(session.get('empresa'))
         flash('Veículo excluído com sucesso!', 'success')
     except Exception as e:
         flash(f'Erro ao excluir veículo: {str(e)}', 'danger')
-    conn.close()
     return redirect(url_for('index'))
 
 @app.route('/rent_vehicle/<int:vehicle_id>', methods=['GET', 'POST'])
 def rent_vehicle(vehicle_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM alugueis WHERE veiculo_id = ? AND status = 'Ativo'", (vehicle_id,))
-    if cursor.fetchone()[0] > 0:
+    if repository.has_active_rental(vehicle_id):
         flash('Este veículo já está alugado!', 'danger')
-        conn.close()
         return redirect(url_for('index'))
-    cursor.execute("SELECT frota, placa FROM veiculos WHERE id = ?", (vehicle_id,))
-    vehicle = cursor.fetchone()
+    vehicle = repository.vehicle(vehicle_id)
     if not vehicle:
         flash('Veículo não encontrado!', 'danger')
-        conn.close()
         return redirect(url_for('index'))
-    cursor.execute("SELECT id, razao_social FROM empresas ORDER BY razao_social")
-    companies = cursor.fetchall()
+    companies = tenant_cache.get_or_load(GLOBAL_CACHE_KEY, 'empresas', repository.company_names)
     if request.method == 'POST':
         possuidor = request.form['possuidor']
         local = request.form['local']
@@ -295,17 +3062,16 @@ def rent_vehicle(vehicle_id):
             flash('Todos os campos são obrigatórios!', 'danger')
             return redirect(url_for('rent_vehicle', vehicle_id=vehicle_id))
         try:
-            cursor.execute(
-                "INSERT INTO alugueis (veiculo_id, possuidor, local, data_locacao, status) VALUES (?, ?, ?, ?, ?)",
-                (vehicle_id, possuidor, local, data_locacao, "Ativo")
-            )
-            conn.commit()
+            repository.rent_vehicle(vehicle_id, possuidor, local, data_locacao)
+            tenant_cache.invalidate(session.get('empresa'))
             flash('Veículo alugado com sucesso!', 'success')
-            conn.close()
+            return redirect(url_for('index'))
+        except repository.IntegrityError:
+            # Outro usuário alugou o veículo depois da verificação acima
+            flash('Este veículo já está alugado!', 'danger')
             return redirect(url_for('index'))
         except Exception as e:
             flash(f'Erro ao registrar aluguel: {str(e)}', 'danger')
-    conn.close()
     return render_template('rent_vehicle.html', vehicle=vehicle, companies=companies)
 
 @app.route('/rentals')
@@ -313,73 +3079,132 @@ def rentals():
     placa_search = request.args.get('placa', '')
     possuidor_search = request.args.get('possuidor', '')
     empresa = session.get('empresa')
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    query = '''
-        SELECT a.*, v.frota, v.placa, a.data_locacao
-        FROM alugueis a
-        JOIN veiculos v ON a.veiculo_id = v.id
-        WHERE a.status = 'Ativo' AND v.empresa = ?
-    '''
-    params = [empresa]
-    if placa_search:
-        query += " AND v.placa LIKE ?"
-        params.append('%' + placa_search + '%')
-    if possuidor_search:
-        query += " AND a.possuidor LIKE ?"
-        params.append('%' + possuidor_search + '%')
-    query += " ORDER BY v.frota"
-    cursor.execute(query, params)
-    rentals = cursor.fetchall()
-    conn.close()
-    new_rentals = []
-    for rental in rentals:
-        rental_dict = dict(rental)
-        try:
-            rental_date = datetime.strptime(rental_dict['data_locacao'], "%Y-%m-%d")
-            dias = (datetime.now() - rental_date).days
-        except Exception:
-            dias = 0
-        rental_dict['dias_uso'] = dias
-        new_rentals.append(rental_dict)
-    return render_template('rentals.html', rentals=new_rentals, placa_search=placa_search, possuidor_search=possuidor_search)
+    rentals, pagination = fetch_page(
+        lambda page: repository.rentals_page(empresa, placa_search, possuidor_search, page), RENTALS_KEYSET)
+    return render_list_page('rentals.html', rentals=rentals, placa_search=placa_search,
+                           possuidor_search=possuidor_search, pagination=pagination)
 
 @app.route('/finish_rental/<int:rental_id>', methods=['POST'])
 def finish_rental(rental_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
     data_devolucao = datetime.now().strftime("%Y-%m-%d")
     try:
-        cursor.execute("UPDATE alugueis SET status = 'Finalizado', data_devolucao = ? WHERE id = ?", (data_devolucao, rental_id))
-        conn.commit()
+        repository.finish_rental(rental_id, data_devolucao)
+        tenant_cache.invalidate(session.get('empresa'))
         flash('Aluguel finalizado com sucesso!', 'success')
     except Exception as e:
         flash(f'Erro ao finalizar aluguel: {str(e)}', 'danger')
-    conn.close()
     return redirect(url_for('rentals'))
 
+# ---------------------- Aluguel e Devolução em Lote ----------------------
+# Cada lote é uma única transação: o pátio processa dezenas de carretas de uma vez.
+# Formulário (redireciona com flash) ou JSON (responde JSON).
+BULK_MAX_ITEMS = 500
+
+def parse_id_list(values):
+    ids = []
+    for value in values:
+        try:
+            ids.append(int(value))
+        except (TypeError, ValueError):
+            continue
+    return list(dict.fromkeys(ids))
+
+def bulk_request_values(lista):
+    """Lê os ids e os demais campos do lote, do formulário ou do corpo JSON."""
+    if request.is_json:
+        dados = request.get_json(silent=True) or {}
+        return parse_id_list(dados.get(lista) or []), dados
+    return parse_id_list(request.form.getlist(lista)), request.form
+
+def bulk_response(ok, mensagem, status, destino, **dados):
+    if request.is_json:
+        return jsonify(dict(dados, mensagem=mensagem)), status
+    flash(mensagem, 'success' if ok else 'danger')
+    return redirect(destino)
+
+@app.route('/rent_vehicles', methods=['GET', 'POST'])
+@login_required
+def rent_vehicles():
+    """Aluga vários veículos para o mesmo possuidor; se algum não puder ser alugado, nenhum é."""
+    empresa = session.get('empresa')
+    if request.method == 'POST':
+        ids, dados = bulk_request_values('veiculos')
+    else:
+        ids, dados = parse_id_list(request.args.getlist('veiculos')), {}
+    if not ids or len(ids) > BULK_MAX_ITEMS:
+        return bulk_response(False, f"Selecione de 1 a {BULK_MAX_ITEMS} veículos.", 400, url_for('index'))
+    if request.method == 'GET':
+        vehicles = repository.tenant_vehicles(empresa, ids)
+        companies = tenant_cache.get_or_load(GLOBAL_CACHE_KEY, 'empresas', repository.company_names)
+        return render_template('rent_vehicles.html', vehicles=vehicles, companies=companies)
+    possuidor, local, data_locacao = dados.get('possuidor'), dados.get('local'), dados.get('data_locacao')
+    if not possuidor or not local or not data_locacao:
+        return bulk_response(False, 'Todos os campos são obrigatórios!', 400, url_for('index'))
+    try:
+        recusados = repository.rent_vehicles(empresa, ids, possuidor, local, data_locacao)
+    except repository.IntegrityError:
+        # Outro usuário alugou um dos veículos ao mesmo tempo
+        recusados = ids
+    except repository.Error as e:
+        return bulk_response(False, f'Erro ao registrar aluguéis: {str(e)}', 500, url_for('index'))
+    if recusados:
+        return bulk_response(False, f"Nenhum veículo foi alugado: {len(recusados)} já alugado(s) ou não encontrado(s).",
+                             409, url_for('index'), recusados=recusados)
+    tenant_cache.invalidate(empresa)
+    return bulk_response(True, f"{len(ids)} veículos alugados com sucesso!", 200, url_for('index'), alugados=ids)
+
+@app.route('/finish_rentals', methods=['POST'])
+@login_required
+def finish_rentals():
+    """Finaliza vários aluguéis; os que já estavam finalizados são ignorados."""
+    empresa = session.get('empresa')
+    ids, _ = bulk_request_values('alugueis')
+    if not ids or len(ids) > BULK_MAX_ITEMS:
+        return bulk_response(False, f"Selecione de 1 a {BULK_MAX_ITEMS} aluguéis.", 400, url_for('rentals'))
+    data_devolucao = datetime.now().strftime("%Y-%m-%d")
+    try:
+        finalizados = repository.finish_rentals(empresa, ids, data_devolucao)
+    except repository.Error as e:
+        return bulk_response(False, f'Erro ao finalizar aluguéis: {str(e)}', 500, url_for('rentals'))
+    tenant_cache.invalidate(empresa)
+    mensagem = f"{len(finalizados)} aluguéis finalizados."
+    if len(finalizados) < len(ids):
+        mensagem += f" {len(ids) - len(finalizados)} ignorado(s): já finalizado(s) ou não encontrado(s)."
+    return bulk_response(True, mensagem, 200, url_for('rentals'), finalizados=finalizados)
+
 @app.route('/historico')
 def historico():
     data_inicial = request.args.get('data_inicial', '')
     data_final = request.args.get('data_final', '')
     empresa = session.get('empresa')
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    query = '''
-        SELECT a.*, v.frota, v.placa 
-        FROM alugueis a
-        JOIN veiculos v ON a.veiculo_id = v.id
-        WHERE a.status = 'Finalizado' AND v.empresa = ?
-    '''
-    params = [empresa]
-    if data_inicial and data_final:
-        query += " AND a.data_devolucao BETWEEN ? AND ?"
-        params.extend([data_inicial, data_final])
-    query += " ORDER BY a.data_devolucao DESC"
-    cursor.execute(query, params)
-    historico = cursor.fetchall()
-    conn.close()
-    return render_template('historico.html', historico=historico, data_inicial=data_inicial, data_final=data_final)
+    historico, pagination = fetch_page(
+        lambda page: repository.history_page(empresa, data_inicial, data_final, page), HISTORY_KEYSET)
+    return render_list_page('historico.html', historico=historico, data_inicial=data_inicial, data_final=data_final,
+                           pagination=pagination)
+
+# Rótulos das dimensões de contagem_frota na página /resumo, na ordem de exibição
+FLEET_SUMMARY_DIMENSIONS = [('tipo_carreta', 'Tipo de Carreta'), ('eixos', 'Eixos'), ('piso', 'Piso'),
+                            ('documento', 'Documento')]
+
+@app.route('/resumo')
+@login_required
+def resumo():
+    """Totais da frota (livres x alugados) por tipo, eixos, piso e documento."""
+    contagens = {}
+    for row in repository.fleet_counts(session.get('empresa')):
+        contagens.setdefault(row['dimensao'], []).append(row)
+    total = contagens.pop('total', [None])[0]
+    dimensoes = [(rotulo, sorted(contagens.get(dimensao, []), key=lambda r: (-r['veiculos'], r['valor'])))
+                 for dimensao, rotulo in FLEET_SUMMARY_DIMENSIONS]
+    return render_template('resumo.html', total=total, dimensoes=dimensoes)
+
+@app.route('/utilizacao')
+@login_required
+def utilizacao():
+    empresa = session.get('empresa')
+    resumo = repository.utilization_summary(empresa)
+    veiculos, pagination = fetch_page(lambda page: repository.utilization_page(empresa, page), VEHICLES_KEYSET)
+    return render_list_page('utilizacao.html', resumo=resumo, veiculos=veiculos, pagination=pagination)
 
 # ---------------------- Rotas de Gerenciamento de Usuários ----------------------
 @app.route('/dashboard')
@@ -387,12 +3212,7 @@ def historico():
 @admin_required
 def dashboard():
     empresa = session.get('empresa')
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM usuarios WHERE empresa = ? ORDER BY login", (empresa,))
-    users = cursor.fetchall()
-    conn.close()
-    return render_template('dashboard.html', users=users)
+    return render_template('dashboard.html', users=repository.users(empresa))
 
 @app.route('/create_user', methods=['GET', 'POST'])
 @login_required
@@ -406,17 +3226,12 @@ def create_user():
         if not login_new or not senha_new:
             flash("Login e senha são obrigatórios.", "danger")
             return redirect(url_for('create_user'))
-        senha_hash = generate_password_hash(senha_new)
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        senha_hash = hash_password(senha_new)
         try:
-            cursor.execute("INSERT INTO usuarios (login, senha, role, empresa) VALUES (?, ?, ?, ?)",
-                           (login_new, senha_hash, role_new, empresa_new))
-            conn.commit()
+            repository.create_user(login_new, senha_hash, role_new, empresa_new)
             flash("Usuário criado com sucesso.", "success")
         except Exception as e:
             flash(f"Erro ao criar usuário: {str(e)}", "danger")
-        conn.close()
         return redirect(url_for('dashboard'))
     return render_template('create_user.html')
 
@@ -425,8 +3240,6 @@ def create_user():
 @login_required
 @admin_required
 def cadastro_empresas():
-    conn = get_db_connection()
-    cursor = conn.cursor()
     if request.method == 'POST':
         cnpj = request.form['cnpj']
         razao_social = request.form['razao_social']
@@ -436,35 +3249,25 @@ def cadastro_empresas():
         telefone = request.form['telefone']
         email = request.form['email']
         try:
-            cursor.execute(
-                "INSERT INTO empresas (cnpj, razao_social, inscricao_estadual, local, numero, telefone, email) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (cnpj, razao_social, inscricao_estadual, local, numero, telefone, email)
-            )
-            conn.commit()
+            repository.create_company(cnpj, razao_social, inscricao_estadual, local, numero, telefone, email)
+            tenant_cache.invalidate(GLOBAL_CACHE_KEY)
             flash("Empresa cadastrada com sucesso!", "success")
         except Exception as e:
             flash(f"Erro ao cadastrar empresa: {str(e)}", "danger")
         return redirect(url_for('cadastro_empresas'))
-    cursor.execute("SELECT * FROM empresas")
-    empresas = cursor.fetchall()
-    conn.close()
-    return render_template('companies.html', empresas=empresas)
+    return render_list_page('companies.html', empresas=repository.companies())
 
 
 @app.route('/edit_user/<int:user_id>', methods=['GET', 'POST'])
 @login_required
 @admin_required
 def edit_user(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM usuarios WHERE id = ?", (user_id,))
-    user = cursor.fetchone()
+    user = repository.user(user_id)
     if not user:
         flash("Usuário não encontrado.", "danger")
         return redirect(url_for('dashboard'))
     if user['empresa'] != session.get('empresa'):
         flash("Você não tem permissão para editar esse usuário.", "danger")
-        conn.close()
         return redirect(url_for('dashboard'))
     if request.method == 'POST':
         login_new = request.form['login']
@@ -472,17 +3275,15 @@ def edit_user(user_id):
         role_new = request.form['role']
         empresa_new = session.get('empresa')  # A empresa permanece a mesma
         if senha_new:
-            senha_hash = generate_password_hash(senha_new)
-            cursor.execute("UPDATE usuarios SET login = ?, senha = ?, role = ?, empresa = ? WHERE id = ?",
-                           (login_new, senha_hash, role_new, empresa_new, user_id))
+            repository.update_user(user_id, login=login_new, senha=hash_password(senha_new), role=role_new,
+                                   empresa=empresa_new)
         else:
-            cursor.execute("UPDATE usuarios SET login = ?, role = ?, empresa = ? WHERE id = ?",
-                           (login_new, role_new, empresa_new, user_id))
-        conn.commit()
+            repository.update_user(user_id, login=login_new, role=role_new, empresa=empresa_new)
+        # Papel ou senha alterados: as sessões abertas desse usuário deixam de valer
+        if role_new != user['role'] or senha_new:
+            app.session_interface.revoke_user(user_id)
         flash("Usuário atualizado com sucesso.", "success")
-        conn.close()
         return redirect(url_for('dashboard'))
-    conn.close()
     return render_template('edit_user.html', user=user)
 
 @app.route('/delete_user/<int:user_id>', methods=['POST'])
@@ -492,17 +3293,12 @@ def delete_user(user_id):
     if user_id == session.get('user_id'):
         flash("Você não pode excluir seu próprio usuário.", "danger")
         return redirect(url_for('dashboard'))
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM usuarios WHERE id = ?", (user_id,))
-    user = cursor.fetchone()
+    user = repository.user(user_id)
     if not user or user['empresa'] != session.get('empresa'):
         flash("Você não tem permissão para excluir esse usuário.", "danger")
-        conn.close()
         return redirect(url_for('dashboard'))
-    cursor.execute("DELETE FROM usuarios WHERE id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    repository.delete_user(user_id)
+    app.session_interface.revoke_user(user_id)
     flash("Usuário excluído com sucesso.", "success")
     return redirect(url_for('dashboard'))
 
@@ -511,68 +3307,687 @@ def delete_user(user_id):
 @admin_required
 def meu_perfil():
     user_id = session.get('user_id')
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM usuarios WHERE id = ?", (user_id,))
-    user = cursor.fetchone()
+    user = repository.user(user_id)
     if request.method == 'POST':
         login_new = request.form['login']
         senha_new = request.form.get('senha', '')
         if senha_new:
-            senha_hash = generate_password_hash(senha_new)
-            cursor.execute("UPDATE usuarios SET login = ?, senha = ? WHERE id = ?", (login_new, senha_hash, user_id))
+            repository.update_user(user_id, login=login_new, senha=hash_password(senha_new))
         else:
-            cursor.execute("UPDATE usuarios SET login = ? WHERE id = ?", (login_new, user_id))
-        conn.commit()
-        conn.close()
+            repository.update_user(user_id, login=login_new)
         session['login'] = login_new
         flash("Perfil atualizado com sucesso.", "success")
         return redirect(url_for('dashboard'))
-    conn.close()
     return render_template('meu_perfil.html', user=user)
 
+# ---------------------- API JSON (somente leitura) ----------------------
+# Mesmas consultas das telas, sem renderizar HTML. Autenticação pela sessão ou por
+# "Authorization: Bearer <token>"; o ETag muda a cada escrita na empresa (e a cada dia,
+# por causa de dias_uso), então integrações que consultam com If-None-Match recebem 304
+# sem que a consulta da listagem rode.
+API_FIELDS = {
+    'veiculos': ['id', 'frota', 'placa', 'eixos', 'piso', 'tipo_carreta', 'comprimento', 'documento', 'status'],
+    'alugueis': ['id', 'veiculo_id', 'frota', 'placa', 'possuidor', 'local', 'data_locacao', 'dias_uso'],
+    'historico': ['id', 'veiculo_id', 'frota', 'placa', 'possuidor', 'local', 'data_locacao', 'data_devolucao'],
+}
+
+def hash_api_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def api_error(mensagem, status):
+    return jsonify({'erro': mensagem}), status
+
+def api_auth_required(f):
+    def wrapper(*args, **kwargs):
+        if g.get('user') is not None:
+            g.api_empresa = g.user['empresa']
+            return f(*args, **kwargs)
+        auth = request.headers.get('Authorization', '')
+        if auth.startswith('Bearer '):
+            empresa = repository.api_token_empresa(hash_api_token(auth[7:].strip()))
+            if empresa is not None:
+                g.api_empresa = empresa
+                return f(*args, **kwargs)
+        return api_error("Não autenticado.", 401)
+    wrapper.__name__ = f.__name__
+    return wrapper
+
+def api_list_response(recurso, load_page):
+    """Responde a listagem paginada de `recurso`, ou 304 se o cliente já tem a versão atual."""
+    campos = API_FIELDS[recurso]
+    if request.args.get('campos'):
+        pedidos = [c.strip() for c in request.args['campos'].split(',') if c.strip()]
+        invalidos = [c for c in pedidos if c not in campos]
+        if invalidos:
+            return api_error(f"Campos inválidos: {', '.join(invalidos)}", 400)
+        campos = pedidos
+    empresa = g.api_empresa
+    versao = repository.tenant_version(empresa)
+    hoje = datetime.now().strftime("%Y-%m-%d")
+    etag = f"{versao['versao'] if versao else 0}-{hoje}"
+    # Como o ETag, a data muda a cada escrita na empresa e a cada dia (meia-noite local)
+    last_modified = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).astimezone(timezone.utc)
+    if versao and versao['atualizado_em']:
+        last_modified = max(last_modified, datetime.strptime(versao['atualizado_em'], "%Y-%m-%d %H:%M:%S").replace(
+            tzinfo=timezone.utc))
+    # If-None-Match tem precedência; If-Modified-Since só vale sem ele (RFC 9110)
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        not_modified = request.if_modified_since is not None and last_modified <= request.if_modified_since
+    if not_modified:
+        response = Response(status=304)
+    else:
+        rows, pagination = load_page(empresa)
+        response = jsonify({
+            'dados': [{c: row[c] for c in campos} for row in rows],
+            'paginacao': pagination,
+            'versao': versao['versao'] if versao else 0,
+        })
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    # O cliente pode guardar a resposta, mas precisa revalidar a cada uso
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/api/v1/veiculos')
+@api_auth_required
+def api_vehicles():
+    def load_page(empresa):
+        placa = request.args.get('placa', '')
+        return fetch_page(lambda page: repository.vehicles_page(empresa, placa, page), VEHICLES_KEYSET)
+    return api_list_response('veiculos', load_page)
+
+@app.route('/api/v1/alugueis')
+@api_auth_required
+def api_rentals():
+    def load_page(empresa):
+        placa, possuidor = request.args.get('placa', ''), request.args.get('possuidor', '')
+        return fetch_page(lambda page: repository.rentals_page(empresa, placa, possuidor, page), RENTALS_KEYSET)
+    return api_list_response('alugueis', load_page)
+
+@app.route('/api/v1/historico')
+@api_auth_required
+def api_history():
+    def load_page(empresa):
+        data_inicial, data_final = request.args.get('data_inicial', ''), request.args.get('data_final', '')
+        return fetch_page(lambda page: repository.history_page(empresa, data_inicial, data_final, page),
+                          HISTORY_KEYSET)
+    return api_list_response('historico', load_page)
+
+# Alterações desde um seq: integrações buscam só o que mudou, em vez de exportar tudo de novo
+CHANGES_PAGE_SIZE = 10000
+CHANGES_MAX_PAGE_SIZE = 100000
+
+@app.route('/api/v1/alteracoes')
+@api_auth_required
+def api_changes():
+    """Alterações com seq maior que ?desde=, em ordem, uma por linha (JSON Lines).
+
+    Menos de ?limite= linhas indica que não há mais alterações por enquanto; a próxima
+    chamada usa o último seq recebido. Exclusões trazem dados = null.
+    """
+    if g.get('user') is not None and g.user['role'] != 'admin':
+        return api_error("Acesso restrito a administradores.", 403)
+    try:
+        desde = int(request.args.get('desde', 0))
+        limite = int(request.args.get('limite', CHANGES_PAGE_SIZE))
+    except ValueError:
+        return api_error("desde e limite devem ser números inteiros.", 400)
+    limite = max(1, min(limite, CHANGES_MAX_PAGE_SIZE))
+
+    def generate():
+        for row in repository.iter_changes(g.api_empresa, desde, limite):
+            yield json.dumps({
+                'seq': row['seq'], 'tabela': row['tabela'], 'operacao': row['operacao'],
+                'id': row['registro_id'], 'em': row['criado_em'],
+                'dados': json.loads(row['dados']) if row['dados'] else None,
+            }, ensure_ascii=False) + '\n'
+
+    response = Response(stream_with_context(_buffered(generate())), mimetype='application/x-ndjson')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.cli.command('create-api-token')
+@click.argument('empresa')
+@click.option('--descricao', default='', help="Identificação da integração.")
+def create_api_token(empresa, descricao):
+    """Cria um token de acesso à API para a empresa (exibido uma única vez)."""
+    token = secrets.token_urlsafe(32)
+    repository.create_api_token(hash_api_token(token), empresa, descricao,
+                                datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    click.echo(token)
+
+@app.cli.command('revoke-api-token')
+@click.argument('token')
+def revoke_api_token(token):
+    """Revoga um token de acesso à API."""
+    removidos = repository.revoke_api_token(hash_api_token(token))
+    click.echo("Token revogado." if removidos else "Token não encontrado.")
+
+# ---------------------- Métricas ----------------------
+@app.route('/admin/metrics')
+@login_required
+@admin_required
+def admin_metrics():
+    return jsonify({'db_pool': db_pool.stats(), 'cache': tenant_cache.stats(),
+                    'login': {'verificacoes_recusadas': password_verifier.recusadas}})
+
+# ---------------------- Perfil de Requisições ----------------------
+# Com PROFILING=1 cada requisição registra tempo total, tempo de SQL, número de consultas,
+# linhas lidas e tempo de renderização; consultas acima de SLOW_QUERY_MS vão para o log.
+PROFILE_SAMPLES = 1000  # últimas requisições guardadas por rota
+PROFILE_FIELDS = ('total_ms', 'sql_ms', 'consultas', 'linhas', 'template_ms')
+
+class RouteProfiler:
+    def __init__(self, samples):
+        self.samples = samples
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, sample):
+        with self._lock:
+            if endpoint not in self._routes:
+                self._routes[endpoint] = deque(maxlen=self.samples)
+            self._routes[endpoint].append(sample)
+
+    def summary(self):
+        with self._lock:
+            routes = {endpoint: list(samples) for endpoint, samples in self._routes.items()}
+        summary = {}
+        for endpoint, samples in routes.items():
+            totals = sorted(sample['total_ms'] for sample in samples)
+            summary[endpoint] = {
+                'requisicoes': len(samples),
+                'p50_ms': _percentile(totals, 50),
+                'p95_ms': _percentile(totals, 95),
+                'p99_ms': _percentile(totals, 99),
+                'max_ms': totals[-1],
+            }
+            for field in PROFILE_FIELDS[1:]:
+                summary[endpoint][f'media_{field}'] = sum(sample[field] for sample in samples) / len(samples)
+        return summary
+
+def _percentile(sorted_values, percent):
+    # nearest-rank
+    index = max(0, -(-len(sorted_values) * percent // 100) - 1)
+    return sorted_values[index]
+
+route_profiler = RouteProfiler(PROFILE_SAMPLES)
+
+def _start_profile():
+    g.profile = {'inicio': time.perf_counter(), 'sql_ms': 0.0, 'consultas': 0, 'linhas': 0, 'template_ms': 0.0}
+
+def _record_profile(endpoint, profile):
+    profile.pop('template_inicio', None)
+    profile['total_ms'] = (time.perf_counter() - profile.pop('inicio')) * 1000
+    route_profiler.record(endpoint, profile)
+
+def _finish_profile(response):
+    profile = g.get('profile')
+    if profile is None or not request.endpoint:
+        return response
+    if response.is_streamed:
+        # Corpo em streaming (stream_template, exportações): o template e as consultas do cursor
+        # rodam depois do after_request, então a amostra só é gravada quando a resposta termina
+        endpoint = request.endpoint
+        response.call_on_close(lambda: _record_profile(endpoint, profile))
+    else:
+        g.pop('profile')
+        _record_profile(request.endpoint, profile)
+    return response
+
+def _template_started(sender, template, context, **extra):
+    profile = _current_profile()
+    if profile is not None:
+        profile['template_inicio'] = time.perf_counter()
+
+def _template_finished(sender, template, context, **extra):
+    profile = _current_profile()
+    if profile is not None and 'template_inicio' in profile:
+        profile['template_ms'] += (time.perf_counter() - profile.pop('template_inicio')) * 1000
+
+if PROFILING_ENABLED:
+    app.before_request(_start_profile)
+    app.after_request(_finish_profile)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
+
+@app.route('/admin/profiling')
+@login_required
+@admin_required
+def admin_profiling():
+    return jsonify({'habilitado': PROFILING_ENABLED, 'consulta_lenta_ms': SLOW_QUERY_MS,
+                    'rotas': route_profiler.summary()})
+
 # ---------------------- Exportação para Excel ----------------------
+EXPORT_BATCH_SIZE = 1000
+XLSX_MAX_ROWS = 1048576  # limite de linhas por planilha do Excel
+RENTAL_EXPORT_COLUMNS = ["Frota", "Placa", "Eixos", "Piso", "Tipo de Carreta", "Comprimento",
+                         "Possuidor", "Local", "Data Locação", "Data Devolução"]
+EXPORTS = {
+    'veiculos': ('''
+        SELECT frota, placa, eixos, piso, tipo_carreta, comprimento
+        FROM veiculos
+        WHERE empresa = ?
+        ORDER BY frota
+    ''', ["Frota", "Placa", "Eixos", "Piso", "Tipo de Carreta", "Comprimento"]),
+    'alugados': ('''
+        SELECT v.frota, v.placa, v.eixos, v.piso, v.tipo_carreta, v.comprimento,
+               a.possuidor, a.local, a.data_locacao, a.data_devolucao
+        FROM veiculos v
+        CROSS JOIN alugueis a ON a.veiculo_id = v.id
+        WHERE a.status = 'Ativo' AND v.empresa = ?
+        ORDER BY v.frota
+    ''', RENTAL_EXPORT_COLUMNS),
+    'historico': ('''
+        SELECT v.frota, v.placa, v.eixos, v.piso, v.tipo_carreta, v.comprimento,
+               a.possuidor, a.local, a.data_locacao, a.data_devolucao
+        FROM alugueis a
+        JOIN veiculos v ON a.veiculo_id = v.id
+        WHERE a.status = 'Finalizado' AND a.empresa = ?
+        ORDER BY a.data_devolucao DESC
+    ''', RENTAL_EXPORT_COLUMNS),
+}
+# Mesmas colunas, lidas de cada tabela de arquivo (ARCHIVE_TABLE)
+ARCHIVE_EXPORTS = {
+    'historico': '''
+        SELECT v.frota, v.placa, v.eixos, v.piso, v.tipo_carreta, v.comprimento,
+               a.possuidor, a.local, a.data_locacao, a.data_devolucao
+        FROM {tabela} a
+        JOIN veiculos v ON a.veiculo_id = v.id
+        WHERE a.empresa = ?
+        ORDER BY a.data_devolucao DESC
+    ''',
+}
+
+def write_xlsx_export(tipo, empresa, path, progress=None):
+    import xlsxwriter
+    _, columns = EXPORTS[tipo]
+    # constant_memory grava cada linha no disco assim que a próxima começa
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    sheet = None
+    row_number = XLSX_MAX_ROWS
+    exported = 0
+    for row in repository.iter_export(tipo, empresa):
+        if row_number == XLSX_MAX_ROWS:
+            sheet = workbook.add_worksheet()
+            sheet.write_row(0, 0, columns)
+            row_number = 1
+        sheet.write_row(row_number, 0, row)
+        row_number += 1
+        exported += 1
+        if progress and exported % EXPORT_BATCH_SIZE == 0:
+            progress(exported)
+    if sheet is None:
+        workbook.add_worksheet().write_row(0, 0, columns)
+    workbook.close()
+
+def iter_csv_export(tipo, empresa):
+    _, columns = EXPORTS[tipo]
+    buffer = io.StringIO()
+    # BOM e ";" para o Excel em português abrir o arquivo direto
+    buffer.write('\ufeff')
+    writer = csv.writer(buffer, delimiter=';')
+    writer.writerow(columns)
+    for number, row in enumerate(repository.iter_export(tipo, empresa), start=1):
+        writer.writerow(row)
+        if number % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def export_job(job_id, tipo, empresa):
+    name = new_artifact_name('.xlsx')
+    write_xlsx_export(tipo, empresa, artifact_path(name), progress=lambda linhas: update_job(job_id, progresso=linhas))
+    return {'mensagem': 'Exportação concluída.', 'artefato': name, 'nome_download': f'{tipo}.xlsx'}
+
 @app.route('/export_excel/<string:tipo>')
+@login_required
 def export_excel(tipo):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    if tipo == 'veiculos':
-        cursor.execute("SELECT frota, placa, eixos, piso, tipo_carreta, comprimento FROM veiculos ORDER BY frota")
-        data = cursor.fetchall()
-        columns = ["Frota", "Placa", "Eixos", "Piso", "Tipo de Carreta", "Comprimento"]
-    elif tipo == 'alugados':
-        cursor.execute('''
-            SELECT v.frota, v.placa, v.eixos, v.piso, v.tipo_carreta, v.comprimento,
-                   a.possuidor, a.local, a.data_locacao, a.data_devolucao
-            FROM alugueis a
-            JOIN veiculos v ON a.veiculo_id = v.id
-            WHERE a.status = 'Ativo'
-            ORDER BY v.frota
-        ''')
-        data = cursor.fetchall()
-        columns = ["Frota", "Placa", "Eixos", "Piso", "Tipo de Carreta", "Comprimento",
-                   "Possuidor", "Local", "Data Locação", "Data Devolução"]
-    elif tipo == 'historico':
-        cursor.execute('''
-            SELECT v.frota, v.placa, v.eixos, v.piso, v.tipo_carreta, v.comprimento,
-                   a.possuidor, a.local, a.data_locacao, a.data_devolucao
-            FROM alugueis a
-            JOIN veiculos v ON a.veiculo_id = v.id
-            WHERE a.status = 'Finalizado'
-            ORDER BY a.data_devolucao DESC
-        ''')
-        data = cursor.fetchall()
-        columns = ["Frota", "Placa", "Eixos", "Piso", "Tipo de Carreta", "Comprimento",
-                   "Possuidor", "Local", "Data Locação", "Data Devolução"]
-    else:
+    if tipo not in EXPORTS:
         flash("Tipo de exportação inválido", 'danger')
-        conn.close()
         return redirect(url_for('index'))
-    df = pd.DataFrame(data, columns=columns)
-    filename = f"{tipo}.xlsx"
-    df.to_excel(filename, index=False)
+    empresa = session.get('empresa')
+    if request.args.get('formato') == 'csv':
+        response = Response(stream_with_context(iter_csv_export(tipo, empresa)), mimetype='text/csv')
+        response.headers['Content-Disposition'] = f'attachment; filename="{tipo}.csv"'
+        return response
+    # O xlsx é gerado por um worker de tarefas, num arquivo próprio em ARTIFACT_DIR
+    job_id = submit_job('exportacao', empresa, export_job, tipo, empresa)
+    return redirect(url_for('job_page', job_id=job_id))
+
+# ---------------------- Tarefas em Segundo Plano ----------------------
+# Importações e exportações rodam num pool de processos separado dos workers web; o estado
+# fica na tabela tarefas, então qualquer worker do gunicorn responde ao acompanhamento.
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 1))
+JOB_NICENESS = 10  # prioridade menor que a das requisições interativas
+# Tarefas Pendentes/Executando sem atualização há mais que isso são de um processo que morreu
+# (worker reiniciado, deploy); "flask migrate" as marca como Erro
+JOB_STALE_AFTER_S = int(os.environ.get('JOB_STALE_AFTER_S', 3600))
+
+_job_executor = None
+_job_executor_pid = None
+_job_executor_lock = threading.Lock()
+
+def _job_worker_init():
+    if hasattr(os, 'nice'):
+        os.nice(JOB_NICENESS)
+
+def get_job_executor(quebrado=None):
+    """Pool de processos das tarefas; `quebrado` é um pool que falhou no submit e deve ser trocado."""
+    global _job_executor, _job_executor_pid
+    with _job_executor_lock:
+        # Um processo de tarefa que morre (falta de memória, segfault) quebra o pool inteiro:
+        # todo submit seguinte falharia até o worker web reiniciar
+        if (_job_executor is None or _job_executor_pid != os.getpid() or _job_executor is quebrado
+                or getattr(_job_executor, '_broken', False)):
+            if _job_executor is not None and _job_executor_pid == os.getpid():
+                _job_executor.shutdown(wait=False)
+            # spawn: fork de um worker com threads pode herdar travas em uso
+            _job_executor = ProcessPoolExecutor(max_workers=JOB_WORKERS,
+                                                mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=_job_worker_init)
+            _job_executor_pid = os.getpid()
+        return _job_executor
+
+def update_job(job_id, **fields):
+    fields['atualizado_em'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    repository.update_job(job_id, **fields)
+
+def run_job(job_id, func, *args):
+    update_job(job_id, status='Executando')
+    try:
+        result = func(job_id, *args)
+    except Exception as e:
+        update_job(job_id, status='Erro', mensagem=str(e))
+        return
+    update_job(job_id, status='Finalizado', **result)
+
+def fail_stale_jobs():
+    """Marca como Erro as tarefas que ficaram Pendente/Executando num processo que morreu."""
+    agora = datetime.now()
+    limite = datetime.fromtimestamp(agora.timestamp() - JOB_STALE_AFTER_S).strftime("%Y-%m-%d %H:%M:%S")
+    return repository.fail_stale_jobs(limite, "Tarefa interrompida (o processo que a executava terminou).",
+                                      agora.strftime("%Y-%m-%d %H:%M:%S"))
+
+def _job_done(job_id, empresa, future):
+    # A importação grava em outro processo; o cache deste worker é invalidado ao final
+    tenant_cache.invalidate(empresa)
+    # O processo do worker morreu antes de registrar o resultado
+    if future.exception() is not None:
+        update_job(job_id, status='Erro', mensagem=str(future.exception()))
+
+def submit_job(tipo, empresa, func, *args):
+    job_id = uuid.uuid4().hex
+    agora = datetime.now()
+    limite = datetime.fromtimestamp(agora.timestamp() - ARTIFACT_MAX_AGE_S).strftime("%Y-%m-%d %H:%M:%S")
+    repository.create_job(job_id, tipo, empresa, agora.strftime("%Y-%m-%d %H:%M:%S"), limite)
+    try:
+        executor = get_job_executor()
+        try:
+            future = executor.submit(run_job, job_id, func, *args)
+        except BrokenProcessPool:
+            future = get_job_executor(quebrado=executor).submit(run_job, job_id, func, *args)
+    except Exception as e:
+        # Sem isso a tarefa ficaria Pendente para sempre
+        app.logger.exception("Falha ao iniciar a tarefa %s", job_id)
+        update_job(job_id, status='Erro', mensagem=f"Falha ao iniciar a tarefa: {e}")
+        return job_id
+    future.add_done_callback(lambda f: _job_done(job_id, empresa, f))
+    return job_id
+
+def get_tenant_job(job_id):
+    return repository.tenant_job(job_id, session.get('empresa'))
+
+@app.route('/tarefas/<job_id>')
+@login_required
+def job_page(job_id):
+    job = get_tenant_job(job_id)
+    if not job:
+        flash("Tarefa não encontrada.", "danger")
+        return redirect(url_for('index'))
+    return render_template('tarefa.html', job=job)
+
+@app.route('/tarefas/<job_id>/status')
+@login_required
+def job_status(job_id):
+    job = get_tenant_job(job_id)
+    if not job:
+        return jsonify({'erro': 'Tarefa não encontrada'}), 404
+    if job['tipo'] == 'importacao' and job['status'] == 'Finalizado':
+        # O worker que atende o acompanhamento pode não ser o que enviou a tarefa
+        tenant_cache.invalidate(job['empresa'])
+    status = {k: job[k] for k in ('id', 'tipo', 'status', 'progresso', 'mensagem', 'atualizado_em')}
+    status['download'] = url_for('job_download', job_id=job_id) if job['artefato'] else None
+    return jsonify(status)
+
+@app.route('/tarefas/<job_id>/download')
+@login_required
+def job_download(job_id):
+    job = get_tenant_job(job_id)
+    if not job or not job['artefato'] or not os.path.exists(artifact_path(job['artefato'])):
+        flash("Arquivo da tarefa não encontrado.", "danger")
+        return redirect(url_for('index'))
+    return send_file(artifact_path(job['artefato']), as_attachment=True, download_name=job['nome_download'])
+
+# ---------------------- Verificação dos Planos de Consulta ----------------------
+# (nome, sql, parâmetros, tabelas em que a leitura de todas as empresas é esperada)
+PLAN_CHECK_ARCHIVE = ARCHIVE_TABLE.format(ano=2000)  # tabela de arquivo criada só para a verificação
+QUERY_PLAN_CHECKS = [
+    ('login', USER_BY_LOGIN_QUERY, ('PCM',), ()),
+    ('index', keyset_query(VEHICLES_QUERY, VEHICLES_KEYSET)[0], ('PCM', 50), ()),
+    ('index: página seguinte', keyset_query(VEHICLES_QUERY + PLACA_FILTER, VEHICLES_KEYSET, ['F10', 10])[0],
+     ('PCM', '%AB%', 'F10', 10, 50), ()),
+    ('index: busca', keyset_query(VEHICLES_SEARCH_QUERY, VEHICLES_KEYSET, ['F10', 10])[0],
+     ('placa : "ABC"', 'PCM', 'F10', 10, 50), ()),
+    ('busca/veiculos', TYPEAHEAD_SEARCH_QUERY, ('{placa frota} : "ABC"', 'PCM', 10), ()),
+    ('busca/veiculos: frota', TYPEAHEAD_FROTA_PREFIX_QUERY, ('PCM', '1', '1\uffff', 10), ()),
+    ('rent_vehicle/delete_vehicle: aluguel ativo', ACTIVE_RENTAL_COUNT_QUERY, (1,), ()),
+    ('rent_vehicles: veículos da empresa', TENANT_VEHICLES_IN_QUERY.format('?, ?'), ('PCM', 1, 2), ()),
+    ('rent_vehicles: já alugados', ACTIVE_RENTALS_IN_QUERY.format('?, ?'), (1, 2), ()),
+    ('finish_rentals', TENANT_ACTIVE_RENTALS_IN_QUERY.format('?, ?'), (1, 2, 'PCM'), ()),
+    ('edit_vehicle', VEHICLE_QUERY, (1,), ()),
+    ('import_excel: sincronização', IMPORT_SYNC_STATE_QUERY, ('PCM',), ()),
+    # Lista completa de empresas, percorrida pelo índice de razao_social
+    ('rent_vehicle: empresas', COMPANIES_QUERY, (), ('empresas',)),
+    ('rentals', keyset_query(RENTALS_QUERY, RENTALS_KEYSET)[0], ('PCM', 50), ()),
+    ('rentals: filtros curtos', keyset_query(RENTALS_QUERY + PLACA_FILTER + RENTALS_POSSUIDOR_FILTER,
+                                             RENTALS_KEYSET, ['F10', 10], backward=True)[0],
+     ('PCM', '%AB%', '%X%', 'F10', 10, 50), ()),
+    ('rentals: busca placa e possuidor',
+     keyset_query(RENTALS_PLACA_SEARCH_QUERY + RENTALS_POSSUIDOR_SEARCH_FILTER, RENTALS_KEYSET)[0],
+     ('placa : "ABC"', 'PCM', 'possuidor : "Transp"', 50), ()),
+    ('rentals: busca possuidor', keyset_query(RENTALS_POSSUIDOR_SEARCH_QUERY, RENTALS_KEYSET)[0],
+     ('possuidor : "Transp"', 'PCM', 50), ()),
+    ('historico', keyset_query(HISTORY_QUERY, HISTORY_KEYSET)[0], ('PCM', 50), ()),
+    ('historico: período', keyset_query(HISTORY_QUERY + HISTORY_PERIOD_FILTER, HISTORY_KEYSET,
+                                        ['2024-06-01', 10])[0],
+     ('PCM', '2024-01-01', '2024-12-31', '2024-06-01', 10, 50), ()),
+    ('historico: arquivo', keyset_query(ARCHIVE_HISTORY_QUERY.format(tabela=PLAN_CHECK_ARCHIVE),
+                                        HISTORY_KEYSET)[0], ('PCM', 50), ()),
+    ('historico: arquivo, período',
+     keyset_query(ARCHIVE_HISTORY_QUERY.format(tabela=PLAN_CHECK_ARCHIVE) + HISTORY_PERIOD_FILTER,
+                  HISTORY_KEYSET, ['2024-06-01', 10])[0],
+     ('PCM', '2024-01-01', '2024-12-31', '2024-06-01', 10, 50), ()),
+    # Manutenção global: percorre os aluguéis finalizados e as sessões vencidas de todas as empresas
+    ('archive-rentals', ARCHIVE_CANDIDATES_QUERY, ('2024-01-01', 1000), ('alugueis',)),
+    ('finish_rental', ACTIVE_RENTAL_QUERY, (1,), ()),
+    ('utilizacao: resumo', UTILIZATION_TENANT_QUERY, ('PCM',), ()),
+    ('resumo', FLEET_COUNTS_QUERY, ('PCM',), ()),
+    ('utilizacao', keyset_query(UTILIZATION_VEHICLES_QUERY, VEHICLES_KEYSET)[0], ('PCM', 50), ()),
+    ('api: versão da empresa', TENANT_VERSION_QUERY, ('PCM',), ()),
+    ('cache: versão dos dados compartilhados', SHARED_DATA_VERSION_QUERY, (), ()),
+    ('api: token', API_TOKEN_QUERY, ('0' * 64,), ()),
+    ('api: alterações', CHANGES_QUERY, ('PCM', 0, 100), ()),
+    ('sessão', SESSION_LOAD_QUERY, ('0' * 64,), ()),
+    ('sessão: usuário', USER_CONTEXT_QUERY, (1,), ()),
+    ('sessão: fim', SESSION_DELETE_SQL, ('0' * 64,), ()),
+    ('sessão: revogação', USER_SESSIONS_DELETE_SQL, (1,), ()),
+    ('sessão: expiradas', EXPIRED_SESSIONS_DELETE_SQL, (0,), ('sessoes',)),
+    ('dashboard', TENANT_USERS_QUERY, ('PCM',), ()),
+    ('edit_user/delete_user/meu_perfil', USER_QUERY, (1,), ()),
+    ('cadastro_empresas', ALL_COMPANIES_QUERY, (), ('empresas',)),
+    ('export_excel: veiculos', EXPORTS['veiculos'][0], ('PCM',), ()),
+    ('export_excel: alugados', EXPORTS['alugados'][0], ('PCM',), ()),
+    ('export_excel: historico', EXPORTS['historico'][0], ('PCM',), ()),
+    ('export_excel: historico arquivado', ARCHIVE_EXPORTS['historico'].format(tabela=PLAN_CHECK_ARCHIVE),
+     ('PCM',), ()),
+]
+
+# Colunas que, como primeira igualdade do índice, já restringem a leitura a uma empresa (ou a um único veículo/usuário)
+PLAN_SCOPED_COLUMNS = ('empresa', 'veiculo_id', 'usuario_id', 'rowid')
+PLAN_SEARCH = re.compile(r"^SEARCH (\S+) USING (?:COVERING |PRIMARY KEY )?(?:INDEX (\S+) |INTEGER PRIMARY KEY )?\((.*)\)")
+
+def unique_index_matched(conn, indice, condicoes):
+    """Indica se as igualdades cobrem todas as colunas de um índice único (no máximo uma linha lida)."""
+    tabela = conn.execute("SELECT tbl_name FROM sqlite_master WHERE type = 'index' AND name = ?", (indice,)).fetchone()
+    if not tabela:
+        return False
+    unico = conn.execute("SELECT \"unique\" FROM pragma_index_list(?) WHERE name = ?", (tabela[0], indice)).fetchone()
+    colunas = conn.execute("SELECT COUNT(*) FROM pragma_index_info(?)", (indice,)).fetchone()[0]
+    igualdades = sum(1 for c in condicoes if c.endswith('=?') and not c.endswith(('>=?', '<=?')))
+    return bool(unico and unico[0]) and igualdades >= colunas
+
+def find_plan_problems(conn, sql, params):
+    """Passos do plano que leem linhas de todas as empresas.
+
+    Além do "SCAN tabela" sem índice, o laço externo de cada consulta (o primeiro SEARCH de cada nível) precisa
+    entrar por um índice cuja primeira igualdade seja a empresa (ou um único veículo/usuário), pela chave primária
+    ou por um índice único completo; um SEARCH por status, por exemplo, ainda percorre as linhas de todas as
+    empresas. Os laços internos e as subconsultas correlacionadas já estão amarrados à linha externa.
+    """
+    plano = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    correlacionadas = {row[0] for row in plano if row[3].startswith('CORRELATED')}
+    externos = set()
+    problemas = []
+    for id_, parent, _, detail in plano:
+        # "SCAN tabela" sem índice = leitura da tabela inteira; nas tabelas FTS, ":M" indica uso do MATCH
+        if detail.startswith('SCAN ') and 'CONSTANT ROW' not in detail and ':M' not in detail:
+            problemas.append(detail)
+        if not detail.startswith(('SCAN ', 'SEARCH ')) or parent in externos:
+            continue
+        externos.add(parent)
+        busca = PLAN_SEARCH.match(detail)
+        if not busca or parent in correlacionadas:
+            continue
+        indice, condicoes = busca.group(2), busca.group(3).split(' AND ')
+        if condicoes[0].split('=')[0] in PLAN_SCOPED_COLUMNS and condicoes[0].endswith('=?'):
+            continue
+        if indice and unique_index_matched(conn, indice, condicoes):
+            continue
+        problemas.append(detail)
+    return problemas
+
+def prepare_plan_check(conn):
+    """Esquema atual e a tabela de arquivo usada pelas consultas do histórico arquivado."""
+    create_schema(conn)
+    for comando in ARCHIVE_TABLE_SQL:
+        conn.execute(comando.format(tabela=PLAN_CHECK_ARCHIVE))
+
+def plan_check_failures(conn, sql, params, permitidas):
+    """Problemas do plano, exceto nas tabelas em que a leitura de todas as empresas é esperada."""
+    return [d for d in find_plan_problems(conn, sql, params) if d.split()[1] not in permitidas]
+
+@app.cli.command('check-query-plans')
+@click.option('--database', default=':memory:', help="Banco a verificar (padrão: esquema novo em memória).")
+def check_query_plans(database):
+    """Falha se alguma consulta das rotas ler linhas de todas as empresas (varredura ou índice sem a empresa)."""
+    conn = sqlite3.connect(database)
+    prepare_plan_check(conn)
+    falhas = 0
+    for nome, sql, params, permitidas in QUERY_PLAN_CHECKS:
+        scans = plan_check_failures(conn, sql, params, permitidas)
+        if scans:
+            falhas += 1
+            click.echo(f"FALHA {nome}: {'; '.join(scans)}")
+        else:
+            click.echo(f"ok    {nome}")
     conn.close()
-    return send_file(filename, as_attachment=True)
+    if falhas:
+        raise SystemExit(1)
+
+@app.cli.command('precompile-templates')
+def precompile_templates_command():
+    """Compila os templates para o cache de bytecode (JINJA_CACHE_DIR)."""
+    click.echo(f"{precompile_templates()} templates compilados em {JINJA_CACHE_DIR}.")
+
+@app.cli.command('rebuild-utilization')
+def rebuild_utilization_command():
+    """Recalcula os totais de utilização a partir do histórico de aluguéis."""
+    repository.rebuild_utilization()
+    click.echo("Totais de utilização recalculados.")
+
+@app.cli.command('check-fleet-counters')
+@click.option('--rebuild', is_flag=True, help="Refaz as contagens a partir da recontagem.")
+def check_fleet_counters_command(rebuild):
+    """Compara as contagens da página /resumo com uma recontagem completa da frota."""
+    if rebuild:
+        repository.rebuild_fleet_counters()
+        click.echo("Contagens da frota recalculadas.")
+        return
+    diferencas = repository.fleet_counter_differences()
+    for (empresa, dimensao, valor), gravado, recontado in diferencas:
+        click.echo(f"DIVERGE {empresa} {dimensao}={valor!r}: gravado (veículos, alugados) = {gravado}, "
+                   f"recontado = {recontado}")
+    if diferencas:
+        click.echo(f"{len(diferencas)} contagens divergentes; corrija com --rebuild.")
+        raise SystemExit(1)
+    click.echo("Contagens da frota conferem com a recontagem.")
+
+# Aluguéis devolvidos há mais de ARCHIVE_AFTER_DAYS saem da tabela usada pelas telas de
+# aluguéis ativos; o histórico e a exportação continuam lendo os arquivos
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 365))
+ARCHIVE_BATCH_SIZE = 1000
+
+@app.cli.command('archive-rentals')
+@click.option('--dias', default=ARCHIVE_AFTER_DAYS, show_default=True,
+              help="Arquiva os aluguéis devolvidos há mais de N dias.")
+def archive_rentals_command(dias):
+    """Move os aluguéis finalizados antigos para as tabelas de arquivo por ano."""
+    antes_de = (datetime.now() - timedelta(days=dias)).strftime("%Y-%m-%d")
+    movidos = repository.archive_rentals(antes_de)
+    click.echo(f"{movidos} aluguéis arquivados (devolução antes de {antes_de}).")
+
+# ---------------------- Inicialização ----------------------
+# Importar o App não toca no banco: esquema e usuários master são criados por "flask migrate"
+# (no deploy), e create_app() só confere a versão do esquema, sem rodar DDL quando ela já é
+# a atual. Com AUTO_MIGRATE=0 um esquema desatualizado impede a subida em vez de migrar.
+AUTO_MIGRATE = os.environ.get('AUTO_MIGRATE', '1') == '1'
+MASTER_USERS = [('JTD', 'JTD'), ('PCM', 'PCM')]  # (login, empresa), senha inicial "123"
+
+def migrate():
+    """Aplica as migrações pendentes e cria os usuários master; devolve (versão anterior, atual)."""
+    anterior = repository.schema_version()
+    repository.init_schema()
+    for login_val, empresa in MASTER_USERS:
+        if repository.user_by_login(login_val) is None:
+            try:
+                repository.create_user(login_val, hash_password("123"), "admin", empresa)
+            except repository.IntegrityError:
+                pass  # criado ao mesmo tempo por outro servidor
+    fail_stale_jobs()
+    return anterior, repository.schema_version()
+
+def create_app():
+    """Devolve o app pronto para servir (gunicorn "App:create_app()")."""
+    versao = repository.schema_version()
+    if versao < repository.SCHEMA_VERSION:
+        if not AUTO_MIGRATE:
+            raise RuntimeError(f"Esquema do banco na versão {versao}, esperada {repository.SCHEMA_VERSION}: "
+                               f"rode 'flask --app App migrate'.")
+        migrate()
+    return app
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Cria ou atualiza o esquema do banco e os usuários master."""
+    anterior, atual = migrate()
+    if anterior == atual:
+        click.echo(f"Esquema já na versão {atual}.")
+    else:
+        click.echo(f"Esquema migrado da versão {anterior} para {atual}.")
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
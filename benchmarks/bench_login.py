@@ -0,0 +1,95 @@
+"""Vazão de login (requisições por segundo e por núcleo) para cada método de hash.
+
+Cada método roda num subprocesso com banco temporário próprio, usuários criados com
+aquele método e limite de tentativas desativado:
+
+    python benchmarks/bench_login.py --method scrypt --method pbkdf2:sha256:600000 --threads 4
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import common
+
+DEFAULT_METHODS = ['scrypt', 'pbkdf2:sha256:600000', 'pbkdf2:sha256:100000']
+
+
+def run_method(method, threads, duration, users):
+    """Executado no subprocesso: mede logins concorrentes com o método informado."""
+    os.environ.update(PASSWORD_HASH_METHOD=method, LOGIN_RATE_PER_MIN_IP='0', LOGIN_RATE_PER_MIN_USER='0')
+    database = os.path.join(tempfile.mkdtemp(), 'login_bench.db')
+    App = common.load_migrated_app(database)
+    conn = App.db_pool.checkout()
+    senha_hash = App.hash_password('123')
+    conn.executemany("INSERT INTO usuarios (login, senha, role, empresa) VALUES (?, ?, 'user', 'BENCH')",
+                     [(f"motorista{i}", senha_hash) for i in range(users)])
+    conn.commit()
+    conn.close()
+
+    latencies, lock = [], threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(offset):
+        client = App.app.test_client()
+        local, i = [], offset
+        while time.monotonic() < deadline:
+            inicio = time.perf_counter()
+            response = client.post('/login', data={'login': f"motorista{i % users}", 'senha': '123'})
+            if response.status_code != 302:
+                raise RuntimeError(f"login falhou: {response.status_code}")
+            local.append(time.perf_counter() - inicio)
+            i += threads
+        with lock:
+            latencies.extend(local)
+
+    inicio = time.monotonic()
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    decorrido = time.monotonic() - inicio
+    nucleos = min(threads, App.HASH_WORKERS, os.cpu_count() or 1)
+    resultado = common.summarize(latencies)
+    resultado.update(logins_por_s=len(latencies) / decorrido, nucleos=nucleos,
+                     logins_por_s_por_nucleo=len(latencies) / decorrido / nucleos)
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--method', action='append', dest='methods', help="método do werkzeug (repetível)")
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--output', help="arquivo JSON de saída (padrão: benchmarks/results/)")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_method(args.worker, args.threads, args.duration, args.users)))
+        return
+
+    resultados = {}
+    for method in args.methods or DEFAULT_METHODS:
+        saida = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', method,
+                                '--threads', str(args.threads), '--duration', str(args.duration),
+                                '--users', str(args.users)], check=True, capture_output=True, text=True).stdout
+        resultados[method] = json.loads(saida.strip().splitlines()[-1])
+        r = resultados[method]
+        print(f"{method:<24} {r['logins_por_s']:8.1f} logins/s  {r['logins_por_s_por_nucleo']:7.1f}/núcleo  "
+              f"p50={r['p50_ms']:.1f} ms  p99={r['p99_ms']:.1f} ms")
+    output = common.save_results('login', {
+        'meta': {'threads': args.threads, 'duration': args.duration, 'users': args.users},
+        'metodos': resultados,
+    }, args.output)
+    print(f"Resultados em {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Micro-benchmarks das rotas principais pelo test client do Flask.
+
+Mede o tempo de cada rota dentro do processo (sem rede), logado como admin da
+maior empresa do banco sintético:
+
+    python benchmarks/generate_fleet.py
+    python benchmarks/bench_routes.py --repeat 50
+
+A importação grava veículos novos no banco de benchmark a cada execução.
+"""
+import argparse
+import io
+import time
+import uuid
+
+import common
+
+IMPORT_HEADER = "Frota;Placa;Eixos;Piso;Tipo de Carreta;Comprimento;Documento\n"
+
+
+def timed(func, repeat, warmup=2):
+    for _ in range(warmup):
+        func()
+    latencies = []
+    for _ in range(repeat):
+        inicio = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - inicio)
+    return latencies
+
+
+def check(response, expected=200):
+    if response.status_code != expected:
+        raise RuntimeError(f"{response.request.path}: status {response.status_code}")
+    return response
+
+
+def import_sheet(rows):
+    prefix = uuid.uuid4().hex[:4].upper()
+    lines = [f"B{i:05d};{prefix}{i:06d};3;FERRO;Sider;12.5;Sim" for i in range(rows)]
+    return (IMPORT_HEADER + '\n'.join(lines)).encode('utf-8')
+
+
+def wait_job(client, location, timeout=300):
+    status_url = location.rstrip('/') + '/status'
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        status = check(client.get(status_url)).get_json()
+        if status['status'] in ('Finalizado', 'Erro'):
+            if status['status'] == 'Erro':
+                raise RuntimeError(f"tarefa falhou: {status['mensagem']}")
+            return status
+        time.sleep(0.05)
+    raise RuntimeError("tarefa não terminou a tempo")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', default=common.DEFAULT_DATABASE)
+    parser.add_argument('--login', help="usuário (padrão: admin da empresa com mais veículos)")
+    parser.add_argument('--senha', default='123')
+    parser.add_argument('--repeat', type=int, default=30)
+    parser.add_argument('--import-rows', type=int, default=2000)
+    parser.add_argument('--output', help="arquivo JSON de saída (padrão: benchmarks/results/)")
+    args = parser.parse_args()
+
+    App = common.load_migrated_app(args.database)
+    app = App.app
+    conn = App.db_pool.checkout()
+    if args.login:
+        login = args.login
+    else:
+        maior = conn.execute("SELECT empresa FROM veiculos GROUP BY empresa ORDER BY COUNT(*) DESC LIMIT 1").fetchone()
+        login = f"admin_{maior['empresa']}"
+    conn.close()
+
+    client = app.test_client()
+    form = {'login': login, 'senha': args.senha}
+    check(client.post('/login', data=form), 302)
+
+    # Cursor de uma página intermediária para medir a navegação além da primeira página
+    meio = None
+    pagina = check(client.get('/?por_pagina=500')).get_data(as_text=True)
+    if 'apos=' in pagina:
+        meio = pagina.split('apos=', 1)[1].split('"', 1)[0].split('&', 1)[0]
+
+    def export_csv():
+        response = check(client.get('/export_excel/historico?formato=csv'))
+        for _ in response.response:
+            pass
+        response.close()
+
+    def import_xlsx_job():
+        response = check(client.post('/import_excel', data={'excel_file': (io.BytesIO(import_sheet(args.import_rows)),
+                                                                              'bench.csv')},
+                                     content_type='multipart/form-data'), 302)
+        wait_job(client, response.headers['Location'])
+
+    def export_xlsx_job():
+        response = check(client.get('/export_excel/veiculos'), 302)
+        wait_job(client, response.headers['Location'])
+
+    def login_post():
+        check(app.test_client().post('/login', data=form), 302)
+
+    rotas = {
+        'index': lambda: check(client.get('/')),
+        'index_pagina_seguinte': lambda: check(client.get(f'/?apos={meio}' if meio else '/')),
+        'index_busca_placa': lambda: check(client.get('/?placa=A')),
+        'rentals': lambda: check(client.get('/rentals')),
+        'historico': lambda: check(client.get('/historico')),
+        'export_csv_historico': export_csv,
+        'login': login_post,
+    }
+    resultados = {}
+    for nome, func in rotas.items():
+        resultados[nome] = common.summarize(timed(func, args.repeat))
+    # Tarefas em segundo plano: mede do envio até o término do worker
+    job_repeat = max(1, args.repeat // 10)
+    resultados['export_xlsx_veiculos'] = common.summarize(timed(export_xlsx_job, job_repeat, warmup=1))
+    resultados['import_excel'] = common.summarize(timed(import_xlsx_job, job_repeat, warmup=1))
+
+    common.print_table(resultados)
+    output = common.save_results('rotas', {
+        'meta': {'database': args.database, 'login': login, 'repeat': args.repeat, 'import_rows': args.import_rows},
+        'rotas': resultados,
+    }, args.output)
+    print(f"Resultados em {output}")
+
+
+if __name__ == '__main__':
+    main()
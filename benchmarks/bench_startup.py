@@ -0,0 +1,82 @@
+"""Tempo de subida de um worker: importação do App, create_app() e primeira requisição.
+
+Cada amostra roda num processo novo, como um worker do gunicorn ao subir, contra um banco
+já migrado (por padrão um banco temporário criado com "flask migrate"):
+
+    python benchmarks/bench_startup.py --repeat 20
+    python benchmarks/bench_startup.py --database benchmarks/carretas_bench.db
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+
+
+def run_worker(database):
+    """Executado no subprocesso: mede cada etapa da subida."""
+    inicio = time.perf_counter()
+    App = common.load_app(database)
+    importado = time.perf_counter()
+    app = App.create_app()
+    criado = time.perf_counter()
+    response = app.test_client().get('/login')
+    if response.status_code != 200:
+        raise RuntimeError(f"/login respondeu {response.status_code}")
+    respondido = time.perf_counter()
+    return {
+        'importacao_ms': (importado - inicio) * 1000,
+        'create_app_ms': (criado - importado) * 1000,
+        'primeira_requisicao_ms': (respondido - criado) * 1000,
+        'total_ms': (respondido - inicio) * 1000,
+        'rss_max_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'pandas_carregado': 'pandas' in sys.modules,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', help="banco já existente (padrão: banco temporário novo)")
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--output', help="arquivo JSON de saída (padrão: benchmarks/results/)")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.worker)))
+        return
+
+    database = args.database or os.path.join(tempfile.mkdtemp(), 'startup_bench.db')
+    env = dict(os.environ, DATABASE=database)
+    # O esquema é criado antes das medições: a subida medida é a de um deploy já migrado
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'App', 'migrate'], cwd=common.ROOT, env=env,
+                   check=True, capture_output=True)
+
+    amostras = []
+    for _ in range(args.repeat):
+        saida = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', database],
+                               check=True, capture_output=True, text=True, env=env).stdout
+        amostras.append(json.loads(saida.strip().splitlines()[-1]))
+
+    etapas = ('importacao_ms', 'create_app_ms', 'primeira_requisicao_ms', 'total_ms')
+    resultados = {etapa: common.summarize([a[etapa] / 1000 for a in amostras]) for etapa in etapas}
+    common.print_table(resultados)
+    rss = sorted(a['rss_max_mb'] for a in amostras)
+    print(f"RSS máximo: p50={common.percentile(rss, 50):.1f} MB  "
+          f"pandas carregado na subida: {any(a['pandas_carregado'] for a in amostras)}")
+    output = common.save_results('startup', {
+        'meta': {'database': database, 'repeat': args.repeat},
+        'etapas': resultados,
+        'rss_max_mb': rss,
+        'pandas_carregado': any(a['pandas_carregado'] for a in amostras),
+    }, args.output)
+    print(f"Resultados em {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""Vazão do gunicorn com cada tipo de worker (sync, gthread, gevent) sob a mesma carga.
+
+Para cada tipo sobe um gunicorn com gunicorn.conf.py contra o banco de benchmark, roda o
+teste de carga de load_test.py nas rotas de listagem e de exportação e derruba o servidor.
+Enquanto isso, --slow-clients clientes baixam a exportação do histórico devagar (tablets em
+rede ruim), ocupando o worker ou a thread que os atende:
+
+    python benchmarks/generate_fleet.py
+    python benchmarks/bench_workers.py --concurrency 32 --duration 20 --slow-clients 4
+
+Workers gevent exigem o pacote gevent; sem ele o tipo é pulado.
+"""
+import argparse
+import importlib.util
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import common
+import load_test
+
+DEFAULT_PATHS = ['/', '/rentals', '/historico', '/export_excel/alugados?formato=csv']
+WORKER_CLASSES = ['sync', 'gthread', 'gevent']
+SLOW_CLIENT_PATH = '/export_excel/historico?formato=csv'
+SLOW_CLIENT_CHUNK = 4096
+SLOW_CLIENT_DELAY_S = 0.01  # ~400 KB/s por cliente lento
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(worker_class, database, workers, threads):
+    port = free_port()
+    env = dict(os.environ, DATABASE=database, AUTO_MIGRATE='0', WEB_CONCURRENCY=str(workers),
+               GUNICORN_WORKER_CLASS=worker_class, GUNICORN_THREADS=str(threads),
+               # Todas as sessões da carga entram com o mesmo login
+               LOGIN_BURST='100000')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '-b', f'127.0.0.1:{port}',
+                               'App:create_app()'], cwd=common.ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn ({worker_class}) terminou: {server.stderr.read().decode()[-2000:]}")
+        try:
+            urllib.request.urlopen(url + '/login', timeout=5).read()
+            return server, url
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f"gunicorn ({worker_class}) não respondeu em 60 s")
+
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+def session_cookie(opener):
+    jar = next(h.cookiejar for h in opener.handlers if isinstance(h, urllib.request.HTTPCookieProcessor))
+    return '; '.join(f"{c.name}={c.value}" for c in jar)
+
+
+def slow_client(url, cookie, deadline, downloads):
+    """Baixa a exportação em pedaços pequenos, com uma janela TCP pequena, até o fim do tempo."""
+    host, port = url.rsplit('//', 1)[1].split(':')
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            # Sem isso os buffers do loopback absorvem a resposta inteira e o servidor não espera
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SLOW_CLIENT_CHUNK)
+            sock.settimeout(60)
+            try:
+                sock.connect((host, int(port)))
+                sock.sendall(f"GET {SLOW_CLIENT_PATH} HTTP/1.0\r\nHost: {host}\r\nCookie: {cookie}\r\n\r\n".encode())
+                while time.monotonic() < deadline:
+                    if not sock.recv(SLOW_CLIENT_CHUNK):
+                        downloads.append(1)
+                        break
+                    time.sleep(SLOW_CLIENT_DELAY_S)
+            except OSError:
+                time.sleep(0.1)
+
+
+def run_with_slow_clients(url, args, paths):
+    cookie = session_cookie(load_test.open_session(url, args.login, args.senha))
+    deadline = time.monotonic() + args.duration + 1
+    downloads = []
+    lentos = [threading.Thread(target=slow_client, args=(url, cookie, deadline, downloads), daemon=True)
+              for _ in range(args.slow_clients)]
+    for t in lentos:
+        t.start()
+    geral, por_rota = load_test.run_load(url, args.login, args.senha, paths, args.concurrency, args.duration)
+    for t in lentos:
+        t.join()
+    geral['downloads_lentos'] = len(downloads)
+    return geral, por_rota
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', default=common.DEFAULT_DATABASE)
+    parser.add_argument('--login', default='admin_EMP001')
+    parser.add_argument('--senha', default='123')
+    parser.add_argument('--workers', type=int, default=2, help="processos do gunicorn")
+    parser.add_argument('--threads', type=int, default=8, help="threads por processo (gthread)")
+    parser.add_argument('--concurrency', type=int, default=32, help="clientes simultâneos")
+    parser.add_argument('--slow-clients', type=int, default=0, help="clientes baixando a exportação devagar")
+    parser.add_argument('--duration', type=float, default=20, help="segundos de carga por tipo de worker")
+    parser.add_argument('--worker-class', action='append', dest='classes', choices=WORKER_CLASSES,
+                        help="tipo de worker a medir (repetível; padrão: todos)")
+    parser.add_argument('--path', action='append', dest='paths', help="rota a exercitar (repetível)")
+    parser.add_argument('--output', help="arquivo JSON de saída (padrão: benchmarks/results/)")
+    args = parser.parse_args()
+    if not os.path.exists(args.database):
+        raise SystemExit(f"{args.database} não existe: rode benchmarks/generate_fleet.py antes.")
+    paths = args.paths or DEFAULT_PATHS
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'App', 'migrate'], cwd=common.ROOT,
+                   env=dict(os.environ, DATABASE=args.database), check=True, capture_output=True)
+
+    resultados = {}
+    for worker_class in args.classes or WORKER_CLASSES:
+        if worker_class == 'gevent' and importlib.util.find_spec('gevent') is None:
+            print("gevent não instalado; pulando.")
+            continue
+        server, url = start_server(worker_class, args.database, args.workers, args.threads)
+        try:
+            geral, por_rota = run_with_slow_clients(url, args, paths)
+        finally:
+            stop_server(server)
+        resultados[worker_class] = {'geral': geral, 'rotas': por_rota}
+        print(f"\n{worker_class}: {geral['vazao_rps']:.1f} req/s, erros: {geral['erros']}")
+        common.print_table(dict(por_rota, geral=geral))
+
+    print()
+    for worker_class, resultado in resultados.items():
+        geral = resultado['geral']
+        print(f"{worker_class:<8} {geral['vazao_rps']:8.1f} req/s  p50={geral.get('p50_ms', 0):8.2f} ms  "
+              f"p99={geral.get('p99_ms', 0):8.2f} ms  erros={geral['erros']}")
+    output = common.save_results('workers', {
+        'meta': {'database': args.database, 'workers': args.workers, 'threads': args.threads,
+                 'concurrency': args.concurrency, 'slow_clients': args.slow_clients, 'duration': args.duration,
+                 'paths': paths},
+        'resultados': resultados,
+    }, args.output)
+    print(f"Resultados em {output}")
+
+
+if __name__ == '__main__':
+    main()
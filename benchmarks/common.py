@@ -0,0 +1,75 @@
+"""Funções compartilhadas pelos scripts de benchmark."""
+import json
+import os
+import platform
+import sys
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+DEFAULT_DATABASE = os.path.join(ROOT, 'benchmarks', 'carretas_bench.db')
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def load_app(database):
+    """Importa App apontando para o banco informado (DATABASE é lido na importação)."""
+    os.environ['DATABASE'] = database
+    import App
+    return App
+
+
+def load_migrated_app(database):
+    """Como load_app, criando ou atualizando o esquema do banco antes."""
+    App = load_app(database)
+    App.migrate()
+    return App
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    index = max(0, -(-len(sorted_values) * percent // 100) - 1)
+    return sorted_values[index]
+
+
+def summarize(latencies_s):
+    values = sorted(v * 1000 for v in latencies_s)
+    if not values:
+        return {'n': 0}
+    return {
+        'n': len(values),
+        'media_ms': sum(values) / len(values),
+        'min_ms': values[0],
+        'p50_ms': percentile(values, 50),
+        'p95_ms': percentile(values, 95),
+        'p99_ms': percentile(values, 99),
+        'max_ms': values[-1],
+    }
+
+
+def save_results(kind, data, output=None):
+    """Grava o resultado em JSON (por padrão em benchmarks/results/<tipo>-<data>.json) e devolve o caminho."""
+    data = dict(data)
+    data['meta'] = dict(data.get('meta', {}),
+                        tipo=kind,
+                        data=datetime.now().isoformat(timespec='seconds'),
+                        python=platform.python_version(),
+                        plataforma=platform.platform(),
+                        cpus=os.cpu_count())
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{kind}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    return output
+
+
+def print_table(rows):
+    for name, stats in rows.items():
+        if stats.get('n'):
+            print(f"{name:<28} n={stats['n']:<5} p50={stats['p50_ms']:8.2f} ms  p95={stats['p95_ms']:8.2f} ms  "
+                  f"p99={stats['p99_ms']:8.2f} ms")
+        else:
+            print(f"{name:<28} sem amostras")
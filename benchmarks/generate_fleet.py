@@ -0,0 +1,120 @@
+"""Gera um banco sintético com várias empresas, frota e histórico de aluguéis.
+
+O tamanho das empresas segue uma distribuição de Zipf: poucas empresas concentram a
+maior parte da frota, como na base real. Cada empresa ganha um usuário admin
+"admin_<empresa>" com senha "123".
+
+    python benchmarks/generate_fleet.py --tenants 20 --vehicles 50000 --rentals 500000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+import common
+
+PISOS = ['FERRO', 'MADEIRA', 'MISTO']
+TIPOS = ['Sider', 'Baú', 'Graneleira', 'Prancha', 'Porta-contêiner', 'Tanque']
+BATCH = 10000
+
+
+def tenant_weights(count, skew):
+    weights = [1 / (rank ** skew) for rank in range(1, count + 1)]
+    total = sum(weights)
+    return [w / total for w in weights]
+
+
+def plate(number):
+    letters = ''.join(chr(65 + (number // 26 ** i) % 26) for i in (2, 1, 0))
+    return f"{letters}-{number // 17576 % 10000:04d}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default=common.DEFAULT_DATABASE)
+    parser.add_argument('--tenants', type=int, default=10)
+    parser.add_argument('--vehicles', type=int, default=20000, help="total de veículos (todas as empresas)")
+    parser.add_argument('--rentals', type=int, default=200000, help="total de aluguéis finalizados")
+    parser.add_argument('--active-ratio', type=float, default=0.35, help="fração da frota alugada agora")
+    parser.add_argument('--years', type=int, default=5, help="anos de histórico")
+    parser.add_argument('--skew', type=float, default=1.1, help="expoente de Zipf do tamanho das empresas")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--force', action='store_true', help="sobrescreve o arquivo de saída")
+    args = parser.parse_args()
+
+    if os.path.exists(args.output):
+        if not args.force:
+            sys.exit(f"{args.output} já existe; use --force para sobrescrever.")
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.output + suffix):
+                os.remove(args.output + suffix)
+
+    inicio = time.perf_counter()
+    App = common.load_migrated_app(args.output)
+    from werkzeug.security import generate_password_hash
+
+    rng = random.Random(args.seed)
+    conn = App.db_pool.checkout()
+    tenants = [f"EMP{i:03d}" for i in range(1, args.tenants + 1)]
+    weights = tenant_weights(args.tenants, args.skew)
+
+    senha_hash = generate_password_hash('123')
+    conn.executemany("INSERT INTO usuarios (login, senha, role, empresa) VALUES (?, ?, 'admin', ?)",
+                     [(f"admin_{t}", senha_hash, t) for t in tenants])
+    conn.executemany("INSERT INTO empresas (cnpj, razao_social, local) VALUES (?, ?, ?)",
+                     [(f"{i:014d}", f"Cliente {i:04d} Ltda", f"Cidade {i % 97}") for i in range(1, 201)])
+    clientes = [f"Cliente {i:04d} Ltda" for i in range(1, 201)]
+
+    vehicle_tenants = rng.choices(tenants, weights=weights, k=args.vehicles)
+    next_frota = {t: 0 for t in tenants}
+    rows = []
+    for number, tenant in enumerate(vehicle_tenants):
+        next_frota[tenant] += 1
+        rows.append((f"{next_frota[tenant]:05d}", plate(number), rng.choice([2, 3, 3, 3, 4]), rng.choice(PISOS),
+                     rng.choice(TIPOS), round(rng.uniform(7.5, 15.0), 1), rng.choice(['Sim', 'Sim', 'Não']), tenant))
+        if len(rows) == BATCH:
+            conn.executemany(App.INSERT_VEHICLE_SQL, rows)
+            rows = []
+    conn.executemany(App.INSERT_VEHICLE_SQL, rows)
+    conn.commit()
+    vehicle_tenant = dict(conn.execute("SELECT id, empresa FROM veiculos ORDER BY id"))
+    vehicle_ids = list(vehicle_tenant)
+
+    hoje = date.today()
+    dias_historico = 365 * args.years
+    insert_rental = ("INSERT INTO alugueis (veiculo_id, possuidor, local, data_locacao, data_devolucao, status, "
+                     "empresa) VALUES (?, ?, ?, ?, ?, ?, ?)")
+    rows = []
+    for _ in range(args.rentals):
+        saida = hoje - timedelta(days=rng.randint(2, dias_historico))
+        volta = min(saida + timedelta(days=rng.randint(1, 90)), hoje - timedelta(days=1))
+        veiculo_id = rng.choice(vehicle_ids)
+        rows.append((veiculo_id, rng.choice(clientes), f"Pátio {rng.randint(1, 30)}",
+                     saida.isoformat(), volta.isoformat(), 'Finalizado', vehicle_tenant[veiculo_id]))
+        if len(rows) == BATCH:
+            conn.executemany(insert_rental, rows)
+            rows = []
+    # Um aluguel ativo por veículo, no máximo
+    for veiculo_id in rng.sample(vehicle_ids, int(len(vehicle_ids) * args.active_ratio)):
+        saida = hoje - timedelta(days=rng.randint(0, 120))
+        rows.append((veiculo_id, rng.choice(clientes), f"Pátio {rng.randint(1, 30)}", saida.isoformat(), None, 'Ativo',
+                     vehicle_tenant[veiculo_id]))
+        if len(rows) == BATCH:
+            conn.executemany(insert_rental, rows)
+            rows = []
+    conn.executemany(insert_rental, rows)
+    conn.commit()
+    App.repository.rebuild_utilization()
+    conn.execute("PRAGMA optimize")
+    conn.close()
+
+    print(f"{args.output}: {args.tenants} empresas, {args.vehicles} veículos, {args.rentals} aluguéis finalizados "
+          f"em {time.perf_counter() - inicio:.1f}s")
+    for tenant, weight in list(zip(tenants, weights))[:3]:
+        print(f"  {tenant}: ~{weight:.0%} da frota (login admin_{tenant} / 123)")
+
+
+if __name__ == '__main__':
+    main()
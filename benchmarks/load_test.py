@@ -0,0 +1,110 @@
+"""Teste de carga concorrente contra um servidor em execução.
+
+Cada thread mantém sua própria sessão (cookie), faz login e dispara requisições
+às rotas escolhidas até o fim do tempo. Reporta vazão e p50/p95/p99 geral e por rota:
+
+    gunicorn -c gunicorn.conf.py 'App:create_app()' -b 127.0.0.1:8000
+    python benchmarks/load_test.py --url http://127.0.0.1:8000 --login admin_EMP001 --concurrency 32
+"""
+import argparse
+import http.cookiejar
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import common
+
+DEFAULT_PATHS = ['/', '/rentals', '/historico', '/?placa=A']
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def open_session(url, login, senha):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect)
+    data = urllib.parse.urlencode({'login': login, 'senha': senha}).encode()
+    try:
+        opener.open(url + '/login', data=data, timeout=30)
+    except urllib.error.HTTPError as e:
+        if e.code != 302:
+            raise
+    return opener
+
+
+def worker(url, opener, paths, deadline, rng, samples, errors, lock):
+    local = []
+    falhas = 0
+    while time.monotonic() < deadline:
+        path = rng.choice(paths)
+        inicio = time.perf_counter()
+        try:
+            with opener.open(url + path, timeout=60) as response:
+                response.read()
+                ok = response.status == 200
+        except (urllib.error.URLError, OSError):
+            ok = False
+        if ok:
+            local.append((path, time.perf_counter() - inicio))
+        else:
+            falhas += 1
+    with lock:
+        samples.extend(local)
+        errors[0] += falhas
+
+
+def run_load(url, login, senha, paths, concurrency, duration, seed=42):
+    """Dispara a carga e devolve (geral, por_rota) com latências e vazão."""
+    openers = [open_session(url, login, senha) for _ in range(concurrency)]
+    samples, errors, lock = [], [0], threading.Lock()
+    deadline = time.monotonic() + duration
+    inicio = time.monotonic()
+    threads = [threading.Thread(target=worker,
+                                args=(url, opener, paths, deadline, random.Random(seed + i), samples, errors, lock))
+               for i, opener in enumerate(openers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    decorrido = time.monotonic() - inicio
+
+    por_rota = {path: common.summarize([d for p, d in samples if p == path]) for path in paths}
+    for path in paths:
+        por_rota[path]['vazao_rps'] = por_rota[path]['n'] / decorrido
+    geral = common.summarize([d for _, d in samples])
+    geral['vazao_rps'] = len(samples) / decorrido
+    geral['erros'] = errors[0]
+    return geral, por_rota
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--login', required=True)
+    parser.add_argument('--senha', default='123')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30, help="segundos de carga")
+    parser.add_argument('--path', action='append', dest='paths', help="rota a exercitar (repetível)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="arquivo JSON de saída (padrão: benchmarks/results/)")
+    args = parser.parse_args()
+    url = args.url.rstrip('/')
+    paths = args.paths or DEFAULT_PATHS
+
+    geral, por_rota = run_load(url, args.login, args.senha, paths, args.concurrency, args.duration, args.seed)
+    common.print_table(dict(por_rota, geral=geral))
+    print(f"vazão: {geral['vazao_rps']:.1f} req/s, erros: {geral['erros']}")
+    output = common.save_results('carga', {
+        'meta': {'url': url, 'login': args.login, 'concurrency': args.concurrency, 'duration': args.duration},
+        'geral': geral,
+        'rotas': por_rota,
+    }, args.output)
+    print(f"Resultados em {output}")
+
+
+if __name__ == '__main__':
+    main()
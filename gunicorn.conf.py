@@ -0,0 +1,32 @@
+"""Configuração do gunicorn, lida do diretório atual (gunicorn -c gunicorn.conf.py 'App:create_app()').
+
+Workers gthread: cada processo atende GUNICORN_THREADS requisições ao mesmo tempo, então
+uma exportação longa ou uma espera pela trava de escrita do SQLite ocupa uma thread, e não
+o processo inteiro. As chamadas ao banco (sqlite3/psycopg2) liberam o GIL, e o estado
+compartilhado do App (pool de conexões, caches, limitadores) é protegido por travas.
+Comparação com sync e gevent: benchmarks/bench_workers.py.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+# WEB_CONCURRENCY é a variável usada pelas plataformas (Heroku etc.) para o número de processos
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+# Uma conexão do pool por thread; com menos, as threads ficam esperando conexão livre
+os.environ.setdefault('DB_POOL_SIZE', str(threads))
+
+# Com gthread o timeout vale para o worker travado, não para a requisição: exportações em
+# streaming continuam mesmo passando disso
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = 30
+keepalive = 5  # tablets reaproveitam a conexão entre as requisições de uma tela
+# Recicla os workers aos poucos, com variação para não reiniciarem todos juntos
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 5000))
+max_requests_jitter = max_requests // 10
+# Sem preload: cada worker abre as próprias conexões depois do fork
+preload_app = False
+# Heartbeat dos workers em memória, não no disco (que pode travar em containers)
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG')  # '-' para o stdout
@@ -0,0 +1,73 @@
+// Scripts compartilhados pelas páginas (servidos com fingerprint e cache longo)
+
+function formatPlaca(input) {
+  let value = input.value.toUpperCase().replace(/[^A-Z0-9]/g, '');
+  if (value.length > 7) {
+    value = value.substring(0, 7);
+  }
+  if (value.length > 3) {
+    value = value.substring(0, 3) + '-' + value.substring(3);
+  }
+  input.value = value;
+}
+
+function formatCNPJ(input) {
+  let value = input.value.replace(/\D/g, '');
+  if (value.length > 14) value = value.substring(0, 14);
+  if (value.length > 2)
+    value = value.slice(0, 2) + '.' + value.slice(2);
+  if (value.length > 6)
+    value = value.slice(0, 6) + '.' + value.slice(6);
+  if (value.length > 10)
+    value = value.slice(0, 10) + '/' + value.slice(10);
+  if (value.length > 15)
+    value = value.slice(0, 15) + '-' + value.slice(15);
+  input.value = value;
+}
+
+// Sugestões de placa: <input data-typeahead-url="..." list="...">
+document.querySelectorAll('[data-typeahead-url]').forEach(function (campo) {
+  var lista = document.getElementById(campo.getAttribute('list'));
+  var espera;
+  campo.addEventListener('input', function () {
+    clearTimeout(espera);
+    espera = setTimeout(function () {
+      if (!campo.value.trim()) { lista.innerHTML = ''; return; }
+      fetch(campo.dataset.typeaheadUrl + '?q=' + encodeURIComponent(campo.value))
+        .then(function (response) { return response.json(); })
+        .then(function (veiculos) {
+          lista.innerHTML = '';
+          veiculos.forEach(function (v) {
+            var opcao = document.createElement('option');
+            opcao.value = v.placa;
+            opcao.label = 'Frota ' + v.frota;
+            lista.appendChild(opcao);
+          });
+        });
+    }, 200);
+  });
+});
+
+// Acompanhamento de tarefa em segundo plano: <div data-job-status-url="...">
+document.querySelectorAll('[data-job-status-url]').forEach(function (painel) {
+  (function poll() {
+    fetch(painel.dataset.jobStatusUrl)
+      .then(function (response) { return response.json(); })
+      .then(function (job) {
+        document.getElementById('job-status').textContent = job.status;
+        document.getElementById('job-progresso').textContent = job.progresso || 0;
+        var mensagem = document.getElementById('job-mensagem');
+        if (job.mensagem) {
+          mensagem.textContent = job.mensagem;
+          mensagem.className = 'alert ' + (job.status === 'Erro' ? 'alert-danger' : 'alert-info');
+          mensagem.style.display = '';
+        }
+        if (job.download) {
+          document.getElementById('job-download').style.display = '';
+        }
+        if (job.status === 'Pendente' || job.status === 'Executando') {
+          setTimeout(poll, 1000);
+        }
+      });
+  })();
+});
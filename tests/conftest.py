@@ -0,0 +1,75 @@
+"""Fixtures dos testes: o repositório em cada banco suportado.
+
+O PostgreSQL só é testado com DATABASE_URL definido. Cada teste roda num schema próprio,
+removido no fim, então as tabelas do banco apontado não são tocadas.
+"""
+import os
+import queue
+import sys
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import App
+
+POSTGRES_URL = os.environ.get('DATABASE_URL')
+
+BACKENDS = [
+    'sqlite',
+    pytest.param('postgres', marks=pytest.mark.skipif(not POSTGRES_URL, reason="DATABASE_URL não definido")),
+]
+
+
+def _discard_idle(pool):
+    while True:
+        try:
+            pool._idle.get_nowait().discard()
+        except queue.Empty:
+            return
+
+
+@pytest.fixture(params=BACKENDS)
+def repository(request, tmp_path, monkeypatch):
+    """Repositório com o esquema migrado num banco vazio (um arquivo novo ou um schema novo)."""
+    admin = schema = None
+    if request.param == 'sqlite':
+        pool = App.ConnectionPool(str(tmp_path / 'carretas.db'), 4, 5)
+        repo = App.SQLiteRepository()
+    else:
+        psycopg2 = pytest.importorskip('psycopg2')
+        schema = f"teste_{uuid.uuid4().hex[:12]}"
+        admin = psycopg2.connect(POSTGRES_URL)
+        admin.autocommit = True
+        admin.cursor().execute(f"CREATE SCHEMA {schema}")
+        # public continua no caminho por causa das extensões (pg_trgm) já instaladas nele
+        dsn = psycopg2.extensions.make_dsn(POSTGRES_URL, options=f"-c search_path={schema},public")
+        pool = App.PostgresConnectionPool(dsn, 4, 5)
+        repo = App.PostgresRepository()
+    monkeypatch.setattr(App, 'db_pool', pool)
+    repo.init_schema()
+    yield repo
+    _discard_idle(pool)
+    if admin is not None:
+        admin.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+        admin.close()
+
+
+@pytest.fixture
+def client(repository, monkeypatch):
+    """Cliente de teste logado como admin da empresa PCM; as rotas usam o repositório do teste."""
+    monkeypatch.setattr(App, 'repository', repository)
+    monkeypatch.setattr(App, 'tenant_cache', App.TenantCache(App.CACHE_MAX_ENTRIES, App.CACHE_TTL_S,
+                                                             version=App.cache_version))
+    # Um login por teste, todos do mesmo IP: limites novos a cada cliente
+    monkeypatch.setattr(App, 'login_ip_limiter', App.TokenBucketLimiter(App.LOGIN_RATE_PER_MIN_IP, App.LOGIN_BURST))
+    monkeypatch.setattr(App, 'login_user_limiter', App.TokenBucketLimiter(App.LOGIN_RATE_PER_MIN_USER,
+                                                                          App.LOGIN_BURST))
+    repository.create_user('admin_teste', App.hash_password('123'), 'admin', 'PCM')
+    client = App.app.test_client()
+    resposta = client.post('/login', data={'login': 'admin_teste', 'senha': '123'})
+    assert resposta.status_code == 302
+    return client
@@ -0,0 +1,35 @@
+"""Paginação por cursor (?apos= / ?antes=) nas listagens."""
+import pytest
+
+import App
+
+
+@pytest.mark.parametrize('valores', [
+    [{'a': 1}, 1],
+    ['ABC', {'a': 1}],
+    [['x'], 1],
+    ['ABC', 'não é id'],
+    ['ABC', True],
+    ['ABC', 2 ** 70],
+    [1, 2, 3],
+    {'a': 1},
+])
+def test_decode_cursor_rejects_tampered_values(valores):
+    assert App.decode_cursor(App.encode_cursor(valores)) is None
+
+
+@pytest.mark.parametrize('valores', [['ABC', 1], [None, 1], [12.5, 3], [7, 7]])
+def test_decode_cursor_round_trip(valores):
+    assert App.decode_cursor(App.encode_cursor(valores)) == valores
+
+
+def test_decode_cursor_rejects_garbage():
+    assert App.decode_cursor('não é base64!') is None
+    assert App.decode_cursor(App.encode_cursor('x')[:-1] + '@') is None
+
+
+@pytest.mark.parametrize('rota', ['/', '/rentals', '/historico'])
+@pytest.mark.parametrize('parametro', ['apos', 'antes'])
+def test_tampered_cursor_falls_back_to_first_page(client, rota, parametro):
+    cursor = App.encode_cursor([{'a': 1}, 1])
+    assert client.get(f'{rota}?{parametro}={cursor}').status_code == 200
@@ -0,0 +1,42 @@
+"""Tradução do SQL do app (escrito para o SQLite) para o PostgreSQL."""
+import App
+
+
+def test_positional_parameters():
+    assert App.postgres_sql("SELECT * FROM veiculos WHERE empresa = ? AND id IN (?, ?)") == \
+        "SELECT * FROM veiculos WHERE empresa = %s AND id IN (%s, %s)"
+
+
+def test_named_parameters():
+    assert App.postgres_sql("UPDATE t SET n = n + :s WHERE id = :id") == "UPDATE t SET n = n + %(s)s WHERE id = %(id)s"
+
+
+def test_casts_are_not_parameters():
+    assert App.postgres_sql("SELECT x::text, :a::integer FROM t") == "SELECT x::text, %(a)s::integer FROM t"
+
+
+def test_percent_is_escaped():
+    assert App.postgres_sql("SELECT * FROM t WHERE placa LIKE '%' || ? || '%'") == \
+        "SELECT * FROM t WHERE placa LIKE '%%' || %s || '%%'"
+
+
+def test_question_mark_inside_literal_is_kept():
+    assert App.postgres_sql("SELECT '?' AS a, ? AS b") == "SELECT '?' AS a, %s AS b"
+    assert App.postgres_sql("SELECT 'Livre?' FROM t WHERE c = ? AND d = 'x?y'") == \
+        "SELECT 'Livre?' FROM t WHERE c = %s AND d = 'x?y'"
+
+
+def test_name_inside_literal_is_kept():
+    assert App.postgres_sql("SELECT 'às 10 :hora' WHERE id = :id") == "SELECT 'às 10 :hora' WHERE id = %(id)s"
+
+
+def test_escaped_quote_inside_literal():
+    assert App.postgres_sql("SELECT 'd''água ?', ?") == "SELECT 'd''água ?', %s"
+
+
+def test_comments_are_kept():
+    assert App.postgres_sql("SELECT ? -- o quê?\nFROM t WHERE id = ?") == "SELECT %s -- o quê?\nFROM t WHERE id = %s"
+
+
+def test_cross_join():
+    assert App.postgres_sql("SELECT * FROM a CROSS JOIN b ON b.id = a.id") == "SELECT * FROM a JOIN b ON b.id = a.id"
@@ -0,0 +1,30 @@
+"""Planos das consultas das rotas (SQLite): nenhuma pode voltar a ler as linhas de todas as empresas."""
+import pytest
+
+import App
+
+
+@pytest.fixture
+def plan_conn(repository):
+    with repository.connection() as conn:
+        App.prepare_plan_check(conn)
+        yield conn
+
+
+@pytest.mark.parametrize('repository', ['sqlite'], indirect=True)
+@pytest.mark.parametrize('nome, sql, params, permitidas', App.QUERY_PLAN_CHECKS,
+                         ids=[check[0] for check in App.QUERY_PLAN_CHECKS])
+def test_query_plan(plan_conn, nome, sql, params, permitidas):
+    assert App.plan_check_failures(plan_conn, sql, params, permitidas) == []
+
+
+@pytest.mark.parametrize('repository', ['sqlite'], indirect=True)
+def test_status_index_is_a_problem(plan_conn):
+    # Entrar pelo índice de status percorre os aluguéis de todas as empresas, mesmo sem SCAN
+    sql = "SELECT * FROM alugueis WHERE status = 'Finalizado' ORDER BY data_devolucao DESC LIMIT 50"
+    assert App.find_plan_problems(plan_conn, sql, ())
+
+
+@pytest.mark.parametrize('repository', ['sqlite'], indirect=True)
+def test_full_scan_is_a_problem(plan_conn):
+    assert App.find_plan_problems(plan_conn, "SELECT * FROM veiculos WHERE frota = ?", ('1',))
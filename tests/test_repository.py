@@ -0,0 +1,182 @@
+"""Repositório: as mesmas operações e os mesmos triggers no SQLite e no PostgreSQL."""
+import json
+
+import pytest
+
+import App
+
+PAGE = App.Page(None, False, 50)
+
+
+def _vehicle_id(repository, placa):
+    return repository._one("SELECT id FROM veiculos WHERE placa = ?", (placa,))['id']
+
+
+def _active_rental_id(repository, vehicle_id):
+    return repository._one("SELECT id FROM alugueis WHERE veiculo_id = ? AND status = 'Ativo'", (vehicle_id,))['id']
+
+
+def _add(repository, placa, tipo='Baú', empresa='PCM'):
+    repository.add_vehicle('001', placa, 3, 'MADEIRA', tipo, 12.5, 'CRLV', empresa)
+    return _vehicle_id(repository, placa.strip().upper())
+
+
+def _changes(repository, empresa):
+    return [(row['tabela'], row['operacao'], row['registro_id'], json.loads(row['dados']) if row['dados'] else None)
+            for row in repository.iter_changes(empresa, 0, 1000)]
+
+
+def _counts(repository, empresa):
+    return {(row['dimensao'], row['valor']): (row['veiculos'], row['alugados'])
+            for row in repository.fleet_counts(empresa)}
+
+
+def test_schema_is_current(repository):
+    assert repository.schema_version() == repository.SCHEMA_VERSION
+
+
+def test_vehicle_crud(repository):
+    vehicle_id = _add(repository, ' abc1d23 ')
+    vehicle = repository.vehicle(vehicle_id)
+    assert (vehicle['placa'], vehicle['tipo_carreta'], vehicle['empresa']) == ('ABC1D23', 'Baú', 'PCM')
+    assert repository.existing_placas() == {'ABC1D23'}
+
+    repository.update_vehicle(vehicle_id, '002', 'xyz9a87', 2, 'MISTO', 'Prancha', 10.0, '')
+    vehicle = repository.vehicle(vehicle_id)
+    assert (vehicle['frota'], vehicle['placa'], vehicle['eixos'], vehicle['tipo_carreta']) == \
+        ('002', 'XYZ9A87', 2, 'Prancha')
+
+    repository.delete_vehicle(vehicle_id)
+    assert repository.vehicle(vehicle_id) is None
+    assert repository.existing_placas() == set()
+
+
+def test_duplicate_placa_is_rejected(repository):
+    _add(repository, 'ABC1D23')
+    with pytest.raises(repository.IntegrityError):
+        _add(repository, 'ABC1D23', empresa='OUTRA')
+
+
+def test_rent_and_finish(repository):
+    vehicle_id = _add(repository, 'ABC1D23')
+    repository.rent_vehicle(vehicle_id, 'Transportes X', 'Pátio 1', '2024-05-01')
+    assert repository.has_active_rental(vehicle_id)
+    rental_id = _active_rental_id(repository, vehicle_id)
+    # A empresa do veículo é copiada no aluguel (índice do histórico por empresa)
+    assert repository._one("SELECT empresa FROM alugueis WHERE id = ?", (rental_id,))['empresa'] == 'PCM'
+
+    repository.finish_rental(rental_id, '2024-05-10')
+    assert not repository.has_active_rental(vehicle_id)
+    historico = repository.history_page('PCM', None, None, PAGE)
+    assert [(r['id'], r['possuidor'], r['data_devolucao']) for r in historico] == \
+        [(rental_id, 'Transportes X', '2024-05-10')]
+    assert repository.history_page('OUTRA', None, None, PAGE) == []
+
+
+def test_second_active_rental_is_rejected(repository):
+    vehicle_id = _add(repository, 'ABC1D23')
+    repository.rent_vehicle(vehicle_id, 'Transportes X', 'Pátio 1', '2024-05-01')
+    with pytest.raises(repository.IntegrityError):
+        repository.rent_vehicle(vehicle_id, 'Transportes Y', 'Pátio 2', '2024-05-02')
+    assert repository._one("SELECT COUNT(*) FROM alugueis")[0] == 1
+
+    # Depois da devolução o veículo pode ser alugado de novo
+    repository.finish_rental(_active_rental_id(repository, vehicle_id), '2024-05-10')
+    repository.rent_vehicle(vehicle_id, 'Transportes Y', 'Pátio 2', '2024-05-11')
+    assert repository.has_active_rental(vehicle_id)
+
+
+def test_rent_vehicles_is_all_or_nothing(repository):
+    livre = _add(repository, 'ABC1D23')
+    alugado = _add(repository, 'XYZ9A87')
+    de_outra = _add(repository, 'QWE4R56', empresa='OUTRA')
+    repository.rent_vehicle(alugado, 'Transportes X', 'Pátio 1', '2024-05-01')
+
+    assert repository.rent_vehicles('PCM', [livre, alugado, de_outra], 'Y', 'Pátio 2', '2024-05-02') == \
+        [alugado, de_outra]
+    assert not repository.has_active_rental(livre)
+    assert repository.rent_vehicles('PCM', [livre], 'Y', 'Pátio 2', '2024-05-02') == []
+    assert repository.has_active_rental(livre)
+
+    # Só os aluguéis da empresa são finalizados
+    repository.rent_vehicle(de_outra, 'Z', 'Pátio 3', '2024-05-02')
+    alugueis = [_active_rental_id(repository, i) for i in (livre, alugado, de_outra)]
+    assert sorted(repository.finish_rentals('PCM', alugueis, '2024-05-10')) == sorted(alugueis[:2])
+    assert repository.has_active_rental(de_outra)
+    assert not repository.has_active_rental(alugado)
+
+
+def test_fleet_counters_follow_writes(repository):
+    bau = _add(repository, 'ABC1D23')
+    prancha = _add(repository, 'XYZ9A87', tipo='Prancha')
+    _add(repository, 'QWE4R56', empresa='OUTRA')
+    repository.rent_vehicle(bau, 'Transportes X', 'Pátio 1', '2024-05-01')
+    counts = _counts(repository, 'PCM')
+    assert counts[('total', '')] == (2, 1)
+    assert counts[('tipo_carreta', 'Baú')] == (1, 1)
+    assert counts[('tipo_carreta', 'Prancha')] == (1, 0)
+    assert counts[('eixos', '3')] == (2, 1)
+    assert _counts(repository, 'OUTRA')[('total', '')] == (1, 0)
+    assert repository.fleet_counter_differences() == []
+
+    # Mudança de dimensão de um veículo alugado, devolução e exclusão
+    repository.update_vehicle(bau, '001', 'ABC1D23', 3, 'MADEIRA', 'Prancha', 12.5, 'CRLV')
+    assert _counts(repository, 'PCM')[('tipo_carreta', 'Prancha')] == (2, 1)
+    repository.finish_rental(_active_rental_id(repository, bau), '2024-05-10')
+    repository.delete_vehicle(prancha)
+    counts = _counts(repository, 'PCM')
+    assert counts[('total', '')] == (1, 0)
+    assert ('tipo_carreta', 'Baú') not in counts
+    assert repository.fleet_counter_differences() == []
+
+
+def test_fleet_counters_follow_batch_writes(repository):
+    # Lotes da importação: no PostgreSQL os triggers por comando recebem várias linhas de uma vez
+    repository.insert_vehicles([(f'{i:03d}', f'AAA{i:04d}', 3, 'MADEIRA', 'Baú' if i % 2 else 'Sider', 12.5, '', 'PCM')
+                                for i in range(40)])
+    repository.upsert_vehicles([(f'{i:03d}', f'AAA{i:04d}', 2, 'MADEIRA', 'Prancha', 12.5, '', 'PCM', 'h')
+                                for i in range(30, 50)])
+    counts = _counts(repository, 'PCM')
+    assert counts[('total', '')] == (50, 0)
+    assert counts[('tipo_carreta', 'Prancha')] == (20, 0)
+    assert counts[('eixos', '2')] == (20, 0)
+    assert repository.fleet_counter_differences() == []
+
+
+def test_change_log_records_tenant_writes(repository):
+    vehicle_id = _add(repository, 'ABC1D23')
+    _add(repository, 'XYZ9A87', empresa='OUTRA')
+    repository.rent_vehicle(vehicle_id, 'Transportes X', 'Pátio 1', '2024-05-01')
+    rental_id = _active_rental_id(repository, vehicle_id)
+    repository.finish_rental(rental_id, '2024-05-10')
+
+    changes = _changes(repository, 'PCM')
+    assert [c[:3] for c in changes] == [
+        ('veiculos', 'INSERT', vehicle_id),
+        ('alugueis', 'INSERT', rental_id),
+        ('alugueis', 'UPDATE', rental_id),
+    ]
+    assert changes[0][3]['placa'] == 'ABC1D23'
+    assert (changes[2][3]['status'], changes[2][3]['data_devolucao']) == ('Finalizado', '2024-05-10')
+
+    repository.delete_vehicle(vehicle_id)
+    assert _changes(repository, 'PCM')[-1][:3] == ('veiculos', 'DELETE', vehicle_id)
+    assert [c[:2] for c in _changes(repository, 'OUTRA')] == [('veiculos', 'INSERT')]
+
+
+def test_change_log_skips_unlogged_columns(repository):
+    repository.create_user('fulano', 'hash', 'comum', 'PCM')
+    user_id = repository.user_by_login('fulano')['id']
+    vehicle_id = _add(repository, 'ABC1D23')
+    antes = _changes(repository, 'PCM')
+
+    # Senha, marcas da importação e o hash da sincronização ficam fora do log
+    repository.update_user(user_id, senha='outro hash')
+    repository.mark_import_absence('PCM', ['ABC1D23'], '2024-05-01')
+    repository._write("UPDATE veiculos SET hash_importacao = ? WHERE id = ?", ('h', vehicle_id))
+    assert _changes(repository, 'PCM') == antes
+    assert repository.vehicle(vehicle_id)['ausente_importacao'] == '2024-05-01'
+
+    repository.update_user(user_id, role='admin')
+    assert _changes(repository, 'PCM')[-1][:3] == ('usuarios', 'UPDATE', user_id)
+    assert 'senha' not in _changes(repository, 'PCM')[-1][3]
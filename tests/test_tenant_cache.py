@@ -0,0 +1,78 @@
+"""Cache por empresa: TTL, versão conferida no banco e invalidação."""
+import pytest
+
+import App
+
+
+class Relogio:
+    def __init__(self):
+        self.agora = 1000.0
+
+    def __call__(self):
+        return self.agora
+
+
+@pytest.fixture
+def relogio(monkeypatch):
+    relogio = Relogio()
+    monkeypatch.setattr(App.time, 'monotonic', relogio)
+    return relogio
+
+
+@pytest.fixture
+def versoes():
+    return {'PCM': 1}
+
+
+@pytest.fixture
+def cache(versoes):
+    return App.TenantCache(16, 30, version=lambda empresa: versoes[empresa], version_check=2)
+
+
+def test_hits_inside_the_check_window_skip_the_version_read(cache, relogio):
+    cargas = []
+    for _ in range(5):
+        assert cache.get_or_load('PCM', 'k', lambda: cargas.append(1) or len(cargas)) == 1
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['versoes_lidas']) == (4, 1, 1)
+
+
+def test_write_from_another_worker_shows_after_the_check_window(cache, relogio, versoes):
+    valores = iter(['antigo', 'novo'])
+    assert cache.get_or_load('PCM', 'k', lambda: next(valores)) == 'antigo'
+    versoes['PCM'] = 2  # escrita em outro processo: nada foi invalidado aqui
+    relogio.agora += 1
+    assert cache.get_or_load('PCM', 'k', lambda: next(valores)) == 'antigo'
+    relogio.agora += 1.5
+    assert cache.get_or_load('PCM', 'k', lambda: next(valores)) == 'novo'
+    assert cache.stats()['desatualizadas'] == 1
+
+
+def test_unchanged_version_renews_the_check(cache, relogio):
+    cache.get_or_load('PCM', 'k', lambda: 'valor')
+    relogio.agora += 5
+    assert cache.get_or_load('PCM', 'k', lambda: 'outro') == 'valor'
+    relogio.agora += 1
+    assert cache.get_or_load('PCM', 'k', lambda: 'outro') == 'valor'
+    assert cache.stats()['versoes_lidas'] == 2
+
+
+def test_ttl_expires_entries(cache, relogio):
+    cache.get_or_load('PCM', 'k', lambda: 'valor')
+    relogio.agora += 31
+    assert cache.get_or_load('PCM', 'k', lambda: 'outro') == 'outro'
+    assert cache.stats()['expiradas'] == 1
+
+
+def test_invalidate_is_immediate(cache, relogio):
+    cache.get_or_load('PCM', 'k', lambda: 'valor')
+    cache.invalidate('PCM')
+    assert cache.get_or_load('PCM', 'k', lambda: 'outro') == 'outro'
+
+
+def test_load_started_before_invalidate_is_not_stored(cache, relogio):
+    def carrega():
+        cache.invalidate('PCM')  # escrita no meio do carregamento
+        return 'velho'
+    assert cache.get_or_load('PCM', 'k', carrega) == 'velho'
+    assert cache.get_or_load('PCM', 'k', lambda: 'novo') == 'novo'